@@ -9,7 +9,17 @@ from routes.ai_route import ai_bp
 from routes.messages import messages_bp
 from routes.notifications import notifications_bp
 from routes.presence import presence_bp
+from routes.events import events_bp
+from routes.transcripts import transcripts_bp
+from routes.broadcasts import broadcasts_bp
+from routes.user_import import user_import_bp
 import os
+import event_bus
+import notification_dispatcher
+import retention
+import presence_store
+import password_hasher
+import search_index
 from flask import send_from_directory
 
 
@@ -19,12 +29,43 @@ def create_app(config=None):
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f'sqlite:///{db_path}')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-    app.config['JWT_EXPIRATION_HOURS'] = 24  # Token expires in 24 hours
+    # Access tokens are short-lived; clients renew them with the refresh token at /auth/refresh
+    app.config['JWT_ACCESS_MINUTES'] = int(os.environ.get('JWT_ACCESS_MINUTES', 15))
+    app.config['REFRESH_TOKEN_DAYS'] = int(os.environ.get('REFRESH_TOKEN_DAYS', 30))
+    # Cross-worker pub/sub backplane: memory:// | sqlite:////path/bus.sqlite | redis://host:port/db
+    app.config['EVENT_BUS_URL'] = os.environ.get('EVENT_BUS_URL', 'memory://')
+    # Notifications: 'async' queues them for a background writer, 'sync' commits inline
+    app.config['NOTIFICATION_DISPATCH'] = os.environ.get('NOTIFICATION_DISPATCH', 'async')
+    app.config['NOTIFICATION_QUEUE_PATH'] = os.environ.get(
+        'NOTIFICATION_QUEUE_PATH', os.path.join(app.instance_path, 'notification_queue.sqlite'))
+    # Heartbeats are kept in memory and written to users.last_seen every N seconds; 0 = on every call
+    app.config['PRESENCE_FLUSH_SECONDS'] = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 10))
+    # Retention job (retention.py) on a background thread every N hours; 0 = run it from cron instead
+    app.config['RETENTION_INTERVAL_HOURS'] = float(os.environ.get('RETENTION_INTERVAL_HOURS', 0))
+    # Password hashing: werkzeug method string (algorithm and cost) and process pool size; 0 = inline
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', password_hasher.DEFAULT_METHOD)
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', password_hasher.DEFAULT_WORKERS))
+    app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', password_hasher.MAX_PENDING))
+    # Hosts attachment URLs may redirect to (comma-separated), e.g. the upload bucket
+    app.config['ATTACHMENT_HOSTS'] = [h.strip() for h in os.environ.get('ATTACHMENT_HOSTS', '').split(',') if h.strip()]
+    if config:
+        app.config.update(config)
 
     CORS(app, origins=os.environ.get('CORS_ORIGINS', '*').split(','),
          expose_headers=['user_id', 'Authorization'],
          allow_headers=['Content-Type', 'user_id', 'Authorization'])
     db.init_app(app)
+    # First: the hashing pool forks its processes, which must happen before other threads start
+    password_hasher.configure(app)
+    event_bus.configure(app.config['EVENT_BUS_URL'])
+    notification_dispatcher.configure(app)
+    retention.configure(app)
+    presence_store.configure(app)
+    with app.app_context():
+        # The default SQLite file lives there; the search index is created on it now
+        os.makedirs(app.instance_path, exist_ok=True)
+        search_index.ensure_schema(db.session)
+        db.session.remove()
 
     # Register blueprints
     app.register_blueprint(auth_bp)
@@ -34,6 +75,10 @@ def create_app(config=None):
     app.register_blueprint(messages_bp)
     app.register_blueprint(notifications_bp)
     app.register_blueprint(presence_bp)
+    app.register_blueprint(events_bp)
+    app.register_blueprint(transcripts_bp)
+    app.register_blueprint(broadcasts_bp)
+    app.register_blueprint(user_import_bp)
 
     @app.route('/')
     def root():
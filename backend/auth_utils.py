@@ -1,49 +1,186 @@
 """
 JWT Authentication utilities for AgroMedicana.
 Provides token generation, verification, and route protection.
+
+A login opens a session with two tokens:
+  - a short-lived access token (JWT_ACCESS_MINUTES). It carries the user's
+    role and display names, so requests authenticate without loading the
+    user, and the session id ('sid');
+  - a long-lived opaque refresh token (REFRESH_TOKEN_DAYS), stored only
+    as a hash. POST /auth/refresh exchanges it for a new pair and
+    retires it (rotation).
+Revoked sessions are refused on every request by revocation_filter.py.
 """
 
+import hashlib
 import jwt
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import request, jsonify, current_app, g
-from models import User
+from sqlalchemy.orm import defer
+import event_bus
+import revocation_filter
+from models import db, User, RefreshToken
+
+IDENTITY_TTL_SECONDS = 60  # safety net; changes are normally pushed via invalidate_identity()
+MAX_CACHED_IDENTITIES = 50000
+
+_identities = OrderedDict()  # user_id -> ((username, role, full_name), expires_at)
+_identities_lock = threading.Lock()
+_identity_changed = OrderedDict()  # user_id -> epoch of the last change; older token claims are stale
+_claims_stale_before = 0.0  # epoch of the last bus resync; any change before it may have been missed
+
+MAX_CACHED_TOKENS = 50000
+
+# Tokens that passed jwt.decode, so a client polling with the same token for a
+# day pays for signature and claim checks once per worker
+_tokens = OrderedDict()  # sha256(token) -> payload, dropped at the token's exp
+_revoked_before = {}  # user_id -> (epoch, keep_until); tokens issued before epoch are refused
+_tokens_lock = threading.Lock()
+_token_stats = {'hits': 0, 'misses': 0, 'rejected': 0}
+
+
+class Principal:
+    """The authenticated user as most routes need it: id, username, role, full_name.
+
+    Built from the access token's claims or the identity cache, so
+    authenticating costs no query. Reading
+    any other User attribute loads the row once per request, without the
+    profile picture unless it is used. Routes that change the user call
+    load() and modify the returned User.
+    """
+    __slots__ = ('id', 'username', 'role', 'full_name', 'session_id', '_user')
+
+    def __init__(self, id, username, role, full_name, session_id=None):
+        self.id, self.username, self.role, self.full_name = id, username, role, full_name
+        self.session_id = session_id
+        self._user = None
 
+    def load(self):
+        """The full User row, loaded once per request."""
+        if self._user is None:
+            self._user = db.session.get(User, self.id, options=[defer(User.profile_picture)])
+        return self._user
 
-def generate_token(user_id: int) -> str:
-    """Generate a JWT token for a user.
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f'<Principal {self.id} {self.role}>'
+
+
+def generate_token(user_id: int, session_id: str | None = None) -> str:
+    """Generate a short-lived access token for a user.
     
     Args:
         user_id: The database ID of the user
+        session_id: The login session the token belongs to, if any
         
     Returns:
         Encoded JWT token string
     """
-    expiration_hours = current_app.config.get('JWT_EXPIRATION_HOURS', 24)
+    principal = get_principal(user_id)
+    if principal is None:
+        raise ValueError(f'no user {user_id}')
+    now = datetime.now(timezone.utc)
     payload = {
         'user_id': user_id,
-        'iat': datetime.now(timezone.utc),
-        'exp': datetime.now(timezone.utc) + timedelta(hours=expiration_hours)
+        'name': principal.username,
+        'role': principal.role,
+        'full_name': principal.full_name,
+        'iat': now.timestamp(),  # sub-second, so revoke_tokens() can tell tokens from the same second apart
+        'exp': now + timedelta(minutes=access_minutes())
     }
+    if session_id:
+        payload['sid'] = session_id
     return jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 
+def access_minutes():
+    return current_app.config.get('JWT_ACCESS_MINUTES', 15)
+
+
 def verify_token(token: str) -> dict | None:
     """Verify and decode a JWT token.
     
+    A token is fully decoded the first time a worker sees it; after that its
+    payload comes from the verified-token cache until the token expires.
+    
     Args:
         token: The JWT token string
         
     Returns:
-        Decoded payload dict if valid, None if invalid
+        Decoded payload dict if valid, None if invalid. The dict is shared
+        with the cache; don't modify it.
     """
+    key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    with _tokens_lock:
+        payload = _tokens.get(key)
+        if payload is not None:
+            if now < payload['exp'] and not _is_revoked(payload):
+                _tokens.move_to_end(key)
+                _token_stats['hits'] += 1
+                return payload
+            del _tokens[key]
+            _token_stats['rejected'] += 1
+            return None
+        _token_stats['misses'] += 1
     try:
         payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    with _tokens_lock:
+        if _is_revoked(payload):
+            _token_stats['rejected'] += 1
+            return None
+        if 'exp' in payload:  # only tokens that expire can be cached until they do
+            _tokens[key] = payload
+            while len(_tokens) > MAX_CACHED_TOKENS:
+                _tokens.popitem(last=False)
+    return payload
+
+
+def _is_revoked(payload):
+    revoked = _revoked_before.get(payload.get('user_id'))
+    return revoked is not None and payload.get('iat', 0) < revoked[0]
+
+
+def revoke_tokens(user_id):
+    """Refuse every token issued to user_id until now, in every worker (e.g. after a password change).
+
+    Ends the user's sessions (see end_sessions), and also refuses tokens that
+    belong to no session. That cut-off is kept in memory for as long as the
+    tokens it covers can live; a restarted worker forgets it.
+    """
+    end_sessions(user_id)
+    now = time.time()
+    lifetime = access_minutes() * 60
+    event_bus.publish('token_revocation', {'user_id': user_id, 'before': now, 'keep_until': now + lifetime})
+
+
+def _on_revoke_tokens(event_id, payload):
+    now = time.time()
+    with _tokens_lock:
+        for user_id in [u for u, (_, keep_until) in _revoked_before.items() if keep_until < now]:
+            del _revoked_before[user_id]
+        before, keep_until = _revoked_before.get(payload['user_id'], (0, 0))
+        _revoked_before[payload['user_id']] = (max(before, payload['before']), max(keep_until, payload['keep_until']))
+
+
+def token_cache_stats():
+    """Verified-token cache counters for this worker."""
+    with _tokens_lock:
+        return dict(_token_stats, size=len(_tokens), revoked_users=len(_revoked_before))
+
+
+event_bus.subscribe('token_revocation', _on_revoke_tokens)
 
 
 def get_token_from_header() -> str | None:
@@ -63,7 +200,7 @@ def get_token_from_header() -> str | None:
 def require_auth(f):
     """Decorator to protect routes with JWT authentication.
     
-    Sets g.current_user to the authenticated User object.
+    Sets g.current_user to the authenticated Principal.
     Returns 401 if token is missing, invalid, or expired.
     
     Usage:
@@ -75,20 +212,9 @@ def require_auth(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = get_token_from_header()
-        
-        if not token:
-            return jsonify({'error': 'Authentication required', 'code': 'NO_TOKEN'}), 401
-        
-        payload = verify_token(token)
-        if not payload:
-            return jsonify({'error': 'Invalid or expired token', 'code': 'INVALID_TOKEN'}), 401
-        
-        user_id = payload.get('user_id')
-        user = User.query.get(user_id)
-        
-        if not user:
-            return jsonify({'error': 'User not found', 'code': 'USER_NOT_FOUND'}), 401
+        user, error = authenticate(get_token_from_header())
+        if error:
+            return error
         
         # Store user in Flask's g object for access in the route
         g.current_user = user
@@ -98,10 +224,98 @@ def require_auth(f):
     return decorated
 
 
+def authenticate(token: str | None):
+    """Resolve a JWT to its Principal.
+    
+    Returns:
+        (principal, None) on success, or (None, error_response) with a 401
+        response ready to return from a route.
+    """
+    if not token:
+        return None, (jsonify({'error': 'Authentication required', 'code': 'NO_TOKEN'}), 401)
+    
+    payload = verify_token(token)
+    if not payload:
+        return None, (jsonify({'error': 'Invalid or expired token', 'code': 'INVALID_TOKEN'}), 401)
+    
+    session_id = payload.get('sid')
+    if session_id and revocation_filter.is_revoked(session_id):
+        return None, (jsonify({'error': 'Session has ended', 'code': 'TOKEN_REVOKED'}), 401)
+    
+    principal = principal_from_claims(payload) or get_principal(payload.get('user_id'))
+    
+    if not principal:
+        return None, (jsonify({'error': 'User not found', 'code': 'USER_NOT_FOUND'}), 401)
+    
+    principal.session_id = session_id
+    return principal, None
+
+
+def principal_from_claims(payload):
+    """Principal from an access token's claims; None if it has none or they predate a profile change."""
+    if 'role' not in payload:
+        return None  # issued before tokens carried claims
+    user_id = payload['user_id']
+    with _identities_lock:
+        changed = _identity_changed.get(user_id)
+    if payload['iat'] < _claims_stale_before or (changed is not None and payload['iat'] < changed):
+        return None
+    return Principal(user_id, payload['name'], payload['role'], payload['full_name'])
+
+
+def get_principal(user_id):
+    """Principal for user_id from the identity cache, loading it on a miss; None if no such user."""
+    if not isinstance(user_id, int):
+        return None
+    now = time.monotonic()
+    with _identities_lock:
+        entry = _identities.get(user_id)
+        if entry and entry[1] > now:
+            _identities.move_to_end(user_id)
+            return Principal(user_id, *entry[0])
+    row = db.session.query(User.username, User.role, User.full_name).filter(User.id == user_id).first()
+    if row is None:  # don't cache misses
+        return None
+    with _identities_lock:
+        _identities[user_id] = (tuple(row), now + IDENTITY_TTL_SECONDS)
+        _identities.move_to_end(user_id)
+        while len(_identities) > MAX_CACHED_IDENTITIES:
+            _identities.popitem(last=False)
+    return Principal(user_id, *row)
+
+
+def invalidate_identity(user_id):
+    """Drop a user's cached identity in every worker. Call after committing the change."""
+    event_bus.publish('identity', {'user_id': user_id})
+
+
+def _on_invalidate_identity(event_id, payload):
+    with _identities_lock:
+        _identities.pop(payload['user_id'], None)
+        _identity_changed[payload['user_id']] = time.time()
+        _identity_changed.move_to_end(payload['user_id'])
+        while len(_identity_changed) > MAX_CACHED_IDENTITIES:
+            _identity_changed.popitem(last=False)
+
+
+def _on_resync(event_id, payload):
+    # Identity and revocation events may have been lost: forget what was cached from them
+    global _claims_stale_before
+    with _identities_lock:
+        _identities.clear()
+        _claims_stale_before = time.time()
+    with _tokens_lock:
+        _tokens.clear()
+
+
+event_bus.subscribe('identity', _on_invalidate_identity)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
+
+
 def optional_auth(f):
     """Decorator that attempts auth but doesn't require it.
     
-    Sets g.current_user to User if authenticated, None otherwise.
+    Sets g.current_user to a Principal if authenticated, None otherwise.
     Useful for routes that behave differently for logged-in users.
     """
     @wraps(f)
@@ -110,11 +324,88 @@ def optional_auth(f):
         token = get_token_from_header()
         
         if token:
-            payload = verify_token(token)
-            if payload:
-                user_id = payload.get('user_id')
-                g.current_user = User.query.get(user_id)
+            g.current_user, _ = authenticate(token)
         
         return f(*args, **kwargs)
     
     return decorated
+
+
+class RefreshError(Exception):
+    """A refresh token that can't be exchanged; code is returned to the client."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def _token_digest(raw):
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _add_refresh_token(user_id, session_id):
+    raw = secrets.token_urlsafe(32)
+    days = current_app.config.get('REFRESH_TOKEN_DAYS', 30)
+    db.session.add(RefreshToken(user_id=user_id, session_id=session_id, token_hash=_token_digest(raw),
+                                expires_at=datetime.utcnow() + timedelta(days=days)))
+    return raw
+
+
+def start_session(user_id):
+    """Open a login session. Returns (access_token, refresh_token); commits."""
+    session_id = secrets.token_hex(16)
+    refresh_token = _add_refresh_token(user_id, session_id)
+    db.session.commit()
+    return generate_token(user_id, session_id), refresh_token
+
+
+def refresh_session(raw):
+    """Exchange a refresh token for (access_token, refresh_token), retiring the old one.
+
+    Raises RefreshError. Presenting a retired token again means two clients
+    hold the same token, which points to theft, so the whole session ends.
+    The exception is a retry within REFRESH_REUSE_GRACE_SECONDS, which is
+    how two tabs sharing storage race each other.
+    """
+    if not isinstance(raw, str) or not raw:
+        raise RefreshError('INVALID_REFRESH_TOKEN')
+    now = datetime.utcnow()
+    row = RefreshToken.query.filter_by(token_hash=_token_digest(raw)).first()
+    if row is None or row.expires_at <= now or get_principal(row.user_id) is None:
+        raise RefreshError('INVALID_REFRESH_TOKEN')
+    if row.revoked_at is None:
+        # Conditional UPDATE: of two concurrent refreshes with this token, one wins
+        claimed = RefreshToken.query.filter_by(id=row.id, revoked_at=None).update(
+            {'revoked_at': now}, synchronize_session=False)
+        if claimed:
+            refresh_token = _add_refresh_token(row.user_id, row.session_id)
+            db.session.commit()
+            return generate_token(row.user_id, row.session_id), refresh_token
+        db.session.rollback()
+        db.session.refresh(row)
+    live = RefreshToken.query.filter_by(session_id=row.session_id, revoked_at=None).first()
+    if live is None:
+        raise RefreshError('INVALID_REFRESH_TOKEN')  # the session was ended
+    grace = current_app.config.get('REFRESH_REUSE_GRACE_SECONDS', 30)
+    if row.revoked_at >= now - timedelta(seconds=grace):
+        raise RefreshError('REFRESH_TOKEN_ROTATED')
+    end_sessions(row.user_id, row.session_id)
+    raise RefreshError('REFRESH_TOKEN_REUSED')
+
+
+def end_sessions(user_id, session_id=None):
+    """End one of a user's sessions, or all of them; commits.
+
+    Their refresh tokens stop working, and their access tokens are refused in
+    every worker from now on.
+    """
+    now = datetime.utcnow()
+    query = RefreshToken.query.filter(RefreshToken.user_id == user_id, RefreshToken.revoked_at.is_(None))
+    if session_id:
+        query = query.filter(RefreshToken.session_id == session_id)
+    session_ids = {sid for (sid,) in query.with_entities(RefreshToken.session_id).distinct()}
+    if session_id:
+        session_ids.add(session_id)
+    query.update({'revoked_at': now}, synchronize_session=False)
+    # Nothing issued before now outlives its access tokens
+    revocation_filter.revoke(session_ids, until=now + timedelta(minutes=access_minutes()))
@@ -0,0 +1,24 @@
+"""
+Build the message full-text search index for an existing database.
+Safe to re-run: only messages missing from the index are added.
+
+Usage: python backfill_search_index.py [batch_size]
+"""
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app import create_app
+from models import db
+import search_index
+
+app = create_app()
+
+with app.app_context():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    mode = search_index.ensure_schema(db.session)
+    print(f"Search mode: {mode}")
+    if mode == 'fts5':
+        added = search_index.backfill(db.session, batch_size=batch_size)
+        print(f"Indexed {added} messages.")
+    else:
+        print("Nothing to backfill: PostgreSQL indexes messages itself, LIKE mode needs no index.")
@@ -0,0 +1,115 @@
+"""
+Benchmark: authentication overhead per request.
+
+Compares resolving a bearer token to the current user:
+  - before: jwt.decode on every request, then load the full User row
+    (what authenticate() did with the 24-hour tokens);
+  - claims: jwt.decode, then build the user from the access token's
+    claims plus a revocation-filter check (no cache);
+  - after: authenticate() as shipped, with the verified-token cache,
+    claims and revocation filter;
+then times the revocation filter itself with `revoked` sessions in it, and
+an end-to-end request (GET /notifications/unread-count) each way.
+
+Usage: python bench_auth.py [iterations] [revoked]
+"""
+import os, sys, time, secrets
+from datetime import datetime, timedelta
+
+from bench_utils import make_bench_app, percentile, time_calls, print_table
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+REVOKED = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+PICTURE = 'data:image/jpeg;base64,' + 'A' * 60_000  # a typical uploaded avatar
+
+
+def main():
+    app, path = make_bench_app()
+    import jwt
+    from models import db, User, RevokedSession
+    import auth_utils
+    import revocation_filter
+
+    rows = []
+    try:
+        with app.app_context():
+            user = User(username='bench_farmer', password='x', role='Client', full_name='Bench Farmer',
+                        profile_picture=PICTURE)
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            access, _ = auth_utils.start_session(user_id)
+            until = datetime.utcnow() + timedelta(minutes=15)
+            db.session.execute(RevokedSession.__table__.insert(),
+                               [{'session_id': secrets.token_hex(16), 'expires_at': until} for _ in range(REVOKED)])
+            db.session.commit()
+            revocation_filter.get_filter().rebuild()
+        secret = app.config['SECRET_KEY']
+
+        def before():
+            payload = jwt.decode(access, secret, algorithms=['HS256'])
+            db.session.get(User, payload['user_id'])
+            db.session.expunge_all()  # a new request starts with an empty session
+
+        def claims():
+            payload = jwt.decode(access, secret, algorithms=['HS256'])
+            assert not revocation_filter.is_revoked(payload['sid'])
+            auth_utils.principal_from_claims(payload)
+
+        def after():
+            principal, error = auth_utils.authenticate(access)
+            assert error is None
+
+        with app.test_request_context():
+            for name, fn in [('before: decode + load User row', before),
+                             ('decode + claims + revocation filter', claims),
+                             ('after: authenticate()', after)]:
+                fn()
+                samples = time_calls(fn, ITERATIONS)
+                rows.append((name, f'{percentile(samples, 50) * 1000:.1f}', f'{percentile(samples, 99) * 1000:.1f}'))
+
+            bloom = revocation_filter.get_filter()
+            revoked_id = db.session.query(RevokedSession.session_id).first()[0]
+            live = [secrets.token_hex(16) for _ in range(ITERATIONS)]
+            start = time.perf_counter()
+            for session_id in live:
+                bloom.is_revoked(session_id)
+            live_us = (time.perf_counter() - start) / len(live) * 1e6
+            revoked_us = percentile(time_calls(lambda: bloom.is_revoked(revoked_id), 1000), 50) * 1000
+            stats = bloom.stats()
+
+        # End to end, through the test client
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {access}'}
+
+        def badge():
+            assert client.get('/api/v1/notifications/unread-count', headers=headers).status_code == 200
+        badge()
+        request_after = time_calls(badge, 2000)
+        original = auth_utils.authenticate
+
+        def authenticate_before(token):
+            # The old path: decode every time, load the row
+            payload = jwt.decode(token, secret, algorithms=['HS256'])
+            user = db.session.get(User, payload['user_id'])
+            return auth_utils.Principal(user.id, user.username, user.role, user.full_name), None
+        auth_utils.authenticate = authenticate_before
+        try:
+            badge()
+            request_before = time_calls(badge, 2000)
+        finally:
+            auth_utils.authenticate = original
+    finally:
+        os.remove(path)
+
+    print(f'{ITERATIONS:,} authentications per variant, one user with a {len(PICTURE) // 1000} KB avatar\n')
+    print_table(['auth path', 'p50 us', 'p99 us'], rows)
+    print(f'\nrevocation filter: {stats["entries"]:,} revoked sessions in {stats["size_bytes"] / 1024:.0f} KiB; '
+          f'live sid {live_us:.1f} us, revoked sid {revoked_us:.1f} us (confirmed in the table), '
+          f'{stats["false_positives"]} false positives in {len(live):,} live checks')
+    print(f'unread badge request p50: before {percentile(request_before, 50):.2f} ms, '
+          f'after {percentile(request_after, 50):.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark: admin broadcast to a large segment.
+
+Seeds `users` users (80% Clients across a few regions), then:
+  - delivers a broadcast to every Client with broadcaster.run() (chunked
+    INSERT ... SELECT), reporting rows/s;
+  - times create_notification() per recipient, the old way, on a sample
+    and extrapolates it to the same segment;
+  - runs a second broadcast on its background thread while the test client
+    polls the unread badge, to show requests keep being served.
+
+Usage: python bench_broadcast.py [users] [sample]
+"""
+import os, sys, json, time
+
+from bench_utils import make_bench_app, percentile, time_calls, print_table
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+SAMPLE = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+REGIONS = ['Mashonaland East', 'Masvingo', 'Manicaland', 'Matabeleland North']
+
+
+def seed(db, size):
+    from models import User, ADMIN_ROLE
+
+    db.drop_all()
+    db.create_all()
+    admin = User(username='bench_admin', password='x', role=ADMIN_ROLE)
+    db.session.add(admin)
+    db.session.commit()
+    rows = [{'username': f'bench_user_{i}', 'password': 'x', 'role': 'Expert' if i % 5 == 0 else 'Client',
+             'location': REGIONS[i % len(REGIONS)], 'primary_crops': 'maize, tobacco' if i % 2 else 'sorghum'}
+            for i in range(size)]
+    for chunk in range(0, size, 10_000):
+        db.session.execute(User.__table__.insert(), rows[chunk:chunk + 10_000])
+    db.session.commit()
+    return admin.id
+
+
+def queue(db, admin_id, title, segment):
+    from models import Broadcast
+    import broadcaster
+
+    b = Broadcast(created_by=admin_id, title=title, segment=json.dumps(segment),
+                  total=broadcaster.count_recipients(segment))
+    db.session.add(b)
+    db.session.commit()
+    return b.id, b.total
+
+
+def main():
+    os.environ['NOTIFICATION_DISPATCH'] = 'sync'  # the old per-row commit, not the write-behind queue
+    app, path = make_bench_app()
+    from models import db, Broadcast, Notification, User
+    from routes.notifications import create_notification
+    from auth_utils import generate_token
+    import broadcaster
+
+    rows = []
+    try:
+        with app.app_context():
+            admin_id = seed(db, SIZE)
+
+            # Chunked broadcast, synchronously
+            broadcast_id, total = queue(db, admin_id, 'Fall armyworm outbreak', {'role': 'Client'})
+            start = time.perf_counter()
+            status = broadcaster.run(app, broadcast_id)
+            elapsed = time.perf_counter() - start
+            sent = db.session.get(Broadcast, broadcast_id).sent
+            assert status == 'done' and sent == total == Notification.query.count(), (status, sent, total)
+            rows.append(('chunked INSERT ... SELECT', f'{total:,}', f'{elapsed:.2f}', f'{total / elapsed:,.0f}'))
+
+            # One create_notification() (and commit) per recipient
+            sample = [uid for (uid,) in db.session.query(User.id).filter_by(role='Client').limit(SAMPLE)]
+            start = time.perf_counter()
+            for uid in sample:
+                create_notification(uid, 'alert', 'Fall armyworm outbreak')
+            per_row = (time.perf_counter() - start) / len(sample)
+            rows.append((f'create_notification() x{len(sample):,}, extrapolated', f'{total:,}',
+                         f'{per_row * total:.2f}', f'{1 / per_row:,.0f}'))
+
+            # Badge latency while a broadcast runs in the background
+            headers = {'Authorization': f'Bearer {generate_token(sample[0])}'}
+            client = app.test_client()
+
+            def badge():
+                assert client.get('/api/v1/notifications/unread-count', headers=headers).status_code == 200
+            idle = time_calls(badge, 200)
+            broadcast_id, _ = queue(db, admin_id, 'Dip tank schedule', {'location': 'masvingo'})
+            db.session.remove()
+            thread = broadcaster.start(app, broadcast_id)
+            during = []
+            while thread.is_alive():
+                during += time_calls(badge, 10)
+            thread.join()
+    finally:
+        os.remove(path)
+
+    print(f'{SIZE:,} users, broadcast to every Client\n')
+    print_table(['method', 'recipients', 'seconds', 'rows/s'], rows)
+    print(f'\nunread badge p50/p99 ms: idle {percentile(idle, 50):.2f}/{percentile(idle, 99):.2f}, '
+          f'during a background broadcast {percentile(during, 50):.2f}/{percentile(during, 99):.2f} '
+          f'({len(during)} requests)')
+
+
+if __name__ == '__main__':
+    main()
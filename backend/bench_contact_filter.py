@@ -0,0 +1,94 @@
+"""
+Benchmark: contact-info detection over a synthetic corpus of chat messages.
+
+Compares the original implementation (11 uncompiled re.search calls per
+message) with ContactInfoDetector.check and ContactInfoDetector.scan_many,
+and verifies that all three return identical (blocked, reason) results.
+
+Usage: python bench_contact_filter.py [messages]
+"""
+import os, sys, re, time, random
+sys.path.insert(0, os.path.dirname(__file__))
+
+from contact_filter import BLOCKED_PATTERNS, ContactInfoDetector
+from bench_utils import print_table
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+CLEAN = [
+    'Hello doctor, my maize leaves are turning yellow from the bottom up.',
+    'Apply 200kg of compound D per hectare before planting and top dress at 6 weeks.',
+    'The broilers are 21 days old and two of them have watery droppings since Monday.',
+    'Check the dissolved oxygen in the pond early in the morning, tilapia gasp at dawn when it is low.',
+    'Fall armyworm damage looks like ragged holes in the whorl with sawdust-like frass.',
+    'Please send a photo of the lesions on the udder so I can see how far it has spread.',
+    'Thanks, I will spray the tomatoes with the copper fungicide this evening.',
+    'Vaccinate the calves against blackleg at 3 months and again at 6 months.',
+    'Soil pH was 5.2 on the last test, should I lime before the rains?',
+    'Rotate the beans with maize next season to break the disease cycle.',
+]
+VIOLATIONS = [
+    'Call me on 0771234567 anytime',
+    'Email me at farmer.john@gmail.com for the results',
+    'Let us chat on WhatsApp instead, it is easier',
+    'My number is +263 771234567',
+    'Find me on Instagram, same name as the farm',
+    'Follow @sunrise_farm_zw for pictures',
+    'Text me when you are free',
+    'Reach me at (077) 123-4567 after lunch',
+    'I am also on telegram',
+    'My mobile is off today, use the app',
+]
+
+
+def legacy_check(text):
+    """The original check_for_contact_info."""
+    text_lower = text.lower()
+    for pattern, reason in BLOCKED_PATTERNS:
+        if re.search(pattern, text_lower, re.IGNORECASE):
+            return True, reason
+    return False, None
+
+
+def build_corpus(size, violation_rate=0.05, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        if rng.random() < violation_rate:
+            text = rng.choice(VIOLATIONS)
+        else:
+            text = ' '.join(rng.sample(CLEAN, rng.randint(1, 3)))
+        corpus.append(text)
+    return corpus
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    corpus = build_corpus(SIZE)
+    detector = ContactInfoDetector()
+
+    legacy, legacy_s = timed(lambda: [legacy_check(t) for t in corpus])
+    single, single_s = timed(lambda: [detector.check(t) for t in corpus])
+    bulk, bulk_s = timed(lambda: detector.scan_many(corpus))
+
+    assert single == legacy, 'check() disagrees with the original implementation'
+    assert bulk == legacy, 'scan_many() disagrees with the original implementation'
+
+    blocked = sum(1 for b, _ in legacy if b)
+    rows = []
+    for name, seconds in [('original (11 x re.search)', legacy_s),
+                          ('ContactInfoDetector.check', single_s),
+                          ('ContactInfoDetector.scan_many', bulk_s)]:
+        rows.append((name, f'{seconds:.3f}', f'{SIZE / seconds:,.0f}',
+                     f'{seconds / SIZE * 1e6:.2f}', f'{legacy_s / seconds:.1f}x'))
+    print(f'{SIZE:,} messages, {blocked:,} blocked; results identical across implementations\n')
+    print_table(['implementation', 'seconds', 'msgs/s', 'us/msg', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark: GET /api/v1/notifications for a user with 100k notifications.
+
+Compares keyset pages (?before=<created_at>,<id>) with batch serialization
+and the counter-backed unread_count against the old LIMIT/OFFSET query with
+per-row to_dict() and a COUNT on every call, at the first page and deep into
+the feed. Also times the badge endpoint (counter vs COUNT). The old code is
+called directly, without the request round trip the new routes pay for.
+
+Usage: python bench_notifications.py [notifications] [iterations]
+"""
+import os, sys
+from datetime import datetime, timedelta
+
+from bench_utils import make_bench_app, QueryCounter, percentile, time_calls, print_table
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+PER_PAGE = 50
+
+
+def seed(db, size):
+    """`size` notifications (30% unread) for one user and as many for another as noise."""
+    from models import User, Notification
+
+    db.drop_all()
+    db.create_all()
+    user = User(username='bench_user', password='x', role='Client')
+    other = User(username='bench_other', password='x', role='Client')
+    db.session.add_all([user, other])
+    db.session.commit()
+
+    start = datetime.utcnow() - timedelta(days=90)
+    for owner in (user, other):
+        rows = [{'user_id': owner.id, 'type': 'message', 'title': f'New message #{i}',
+                 'description': 'Any news about the maize?', 'icon': 'ri-chat-3-line', 'color': 'teal',
+                 'read': i % 10 >= 3, 'link': '/chats', 'ref_id': i % 500,
+                 'created_at': start + timedelta(seconds=i * 60)} for i in range(size)]
+        for chunk in range(0, size, 10_000):
+            db.session.execute(Notification.__table__.insert(), rows[chunk:chunk + 10_000])
+    db.session.commit()
+    return user.id
+
+
+def legacy_page(user_id, page):
+    """The original implementation: OFFSET paging, to_dict() per row, COUNT per call."""
+    from models import Notification
+
+    notifications = Notification.query.filter_by(user_id=user_id).order_by(
+        Notification.created_at.desc()).limit(PER_PAGE).offset((page - 1) * PER_PAGE).all()
+    unread_count = Notification.query.filter_by(user_id=user_id, read=False).count()
+    return {'notifications': [n.to_dict() for n in notifications], 'unread_count': unread_count}
+
+
+def main():
+    app, path = make_bench_app()
+    from models import db, Notification
+    from auth_utils import generate_token
+
+    client = app.test_client()
+    rows = []
+    try:
+        with app.app_context():
+            user_id = seed(db, SIZE)
+            headers = {'Authorization': f'Bearer {generate_token(user_id)}'}
+            deep_page = SIZE // PER_PAGE // 2
+            # Cursor for the same deep page, as a client that paged there would hold
+            anchor = db.session.query(Notification.created_at, Notification.id).filter_by(
+                user_id=user_id).order_by(Notification.created_at.desc(), Notification.id.desc()
+                ).offset((deep_page - 1) * PER_PAGE - 1).first()
+            deep_cursor = f'{anchor.created_at.isoformat()},{anchor.id}'
+            client.get('/api/v1/notifications/unread-count', headers=headers)  # seed the counter
+
+            def route(url):
+                def call():
+                    r = client.get(url, headers=headers)
+                    assert r.status_code == 200, r.data
+                    return r.get_json()
+                return call
+
+            cases = [
+                ('keyset', 'page 1', route(f'/api/v1/notifications?per_page={PER_PAGE}')),
+                ('keyset', f'page {deep_page}', route(f'/api/v1/notifications?per_page={PER_PAGE}&before={deep_cursor}')),
+                ('offset (old)', 'page 1', lambda: legacy_page(user_id, 1)),
+                ('offset (old)', f'page {deep_page}', lambda: legacy_page(user_id, deep_page)),
+                ('counter', 'unread badge', route('/api/v1/notifications/unread-count')),
+                ('COUNT (old)', 'unread badge',
+                 lambda: {'unread_count': Notification.query.filter_by(user_id=user_id, read=False).count()}),
+            ]
+            results = {}
+            for name, what, fn in cases:
+                db.session.expunge_all()
+                with QueryCounter(db.engine) as qc:
+                    results[(name, what)] = fn()
+                samples = time_calls(fn, ITERATIONS)
+                rows.append((name, what, qc.count, f'{percentile(samples, 50):.2f}', f'{percentile(samples, 99):.2f}'))
+
+            # Both implementations must return the same page and count
+            for what in ('page 1', f'page {deep_page}'):
+                new, old = results[('keyset', what)], results[('offset (old)', what)]
+                assert [n['id'] for n in new['notifications']] == [n['id'] for n in old['notifications']], what
+                assert new['unread_count'] == old['unread_count'], what
+            db.session.remove()
+    finally:
+        os.remove(path)
+
+    print(f'{SIZE:,} notifications for the user ({SIZE:,} more for another user), {PER_PAGE} per page\n')
+    print_table(['implementation', 'request', 'queries', 'p50 ms', 'p99 ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark: login throughput and the latency of other requests during a
+login burst, for different password hashing pool sizes.
+
+First times one hash for a few methods/costs, to pick a
+PASSWORD_HASH_METHOD. Then, for each pool size (0 = inline, on the
+request thread), `threads` client threads log in `logins` times in total
+(8 threads, like a gthread worker) while the main thread polls the
+unread badge.
+
+Usage: python bench_password_hashing.py [logins] [threads]
+"""
+import os, sys, time, threading
+
+from bench_utils import make_bench_app, percentile, time_calls, print_table
+
+LOGINS = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+POOL_SIZES = [0, 1, 2, 4]
+METHODS = ['scrypt:32768:8:1', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:260000']
+
+
+def login_burst(app, total, threads):
+    """Log in `total` times from `threads` threads; returns (seconds, latencies in ms, status counts)."""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def worker(n):
+        client = app.test_client()
+        for _ in range(n):
+            start = time.perf_counter()
+            r = client.post('/api/v1/auth/login', json={'username': 'bench_farmer', 'password': 'Bench1234'})
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    workers = [threading.Thread(target=worker, args=(total // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    return workers, start, latencies, statuses
+
+
+def main():
+    os.environ['NOTIFICATION_DISPATCH'] = 'sync'
+    app, path = make_bench_app()
+    from werkzeug.security import generate_password_hash
+    from models import db, User
+    from auth_utils import generate_token
+    import password_hasher
+
+    cost_rows = []
+    for method in METHODS:
+        start = time.perf_counter()
+        generate_password_hash('Bench1234', method)
+        cost_rows.append((method, f'{(time.perf_counter() - start) * 1000:.1f}'))
+
+    rows = []
+    try:
+        with app.app_context():
+            user = User(username='bench_farmer', role='Client',
+                        password=generate_password_hash('Bench1234', app.config['PASSWORD_HASH_METHOD']))
+            db.session.add(user)
+            db.session.commit()
+            headers = {'Authorization': f'Bearer {generate_token(user.id)}'}
+        client = app.test_client()
+
+        def badge():
+            assert client.get('/api/v1/notifications/unread-count', headers=headers).status_code == 200
+
+        idle = time_calls(badge, 100)
+        for size in POOL_SIZES:
+            app.config['PASSWORD_HASH_WORKERS'] = size
+            password_hasher.configure(app)  # starts the pool outside the timing
+            workers, start, latencies, statuses = login_burst(app, LOGINS, THREADS)
+            during = []
+            while any(t.is_alive() for t in workers):
+                during += time_calls(badge, 5)
+            elapsed = time.perf_counter() - start
+            ok = statuses.get(200, 0)
+            rows.append((size or 'inline', f'{ok / elapsed:.1f}', f'{percentile(latencies, 50):.0f}',
+                         f'{percentile(latencies, 99):.0f}', f'{percentile(during, 50):.2f}',
+                         f'{percentile(during, 99):.2f}', len(during), statuses.get(503, 0)))
+        password_hasher.get_hasher().close()
+    finally:
+        os.remove(path)
+
+    print(f'{os.cpu_count()} CPUs\n')
+    print_table(['method', 'ms per hash'], cost_rows)
+    print(f'\n{LOGINS} logins from {THREADS} threads, {app.config["PASSWORD_HASH_METHOD"]}; '
+          f'unread badge idle p50/p99 ms {percentile(idle, 50):.2f}/{percentile(idle, 99):.2f}\n')
+    print_table(['pool', 'logins/s', 'login p50 ms', 'login p99 ms', 'badge p50 ms', 'badge p99 ms',
+                 'badge requests', '503s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark: GET /api/v1/unread-counts at 10, 1k and 10k consultations per user.
+
+Reports the number of SQL statements per request (including the auth
+lookup) and p50/p99 latency for the grouped watermark query, next to the
+old per-consultation COUNT loop answering the same question (messages
+from the other party above the read watermark). Both must agree.
+
+Usage: python bench_unread_counts.py [iterations]
+"""
+import os, sys
+from datetime import datetime
+
+from bench_utils import make_bench_app, QueryCounter, percentile, time_calls, print_table
+
+SIZES = [10, 1_000, 10_000]
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+
+def seed(db, size):
+    """One expert with `size` consultations, plus as many for another expert as noise."""
+    from models import User, Consultation, Message
+
+    db.drop_all()
+    db.create_all()
+    expert = User(username='bench_expert', password='x', role='Expert')
+    other = User(username='bench_other', password='x', role='Expert')
+    client = User(username='bench_client', password='x', role='Client')
+    db.session.add_all([expert, other, client])
+    db.session.commit()
+
+    now = datetime.utcnow()
+    consultations = []
+    for owner in (expert, other):
+        for _ in range(size):
+            consultations.append({'client_id': client.id, 'expert_id': owner.id,
+                                  'date': now, 'status': 'accepted'})
+    db.session.execute(Consultation.__table__.insert(), consultations)
+    db.session.commit()
+
+    ids = [row[0] for row in db.session.query(Consultation.id).all()]
+    messages = []
+    for cid in ids:
+        messages.append({'consultation_id': cid, 'sender_id': client.id, 'message': 'hi',
+                         'timestamp': now, 'deleted': False})
+        messages.append({'consultation_id': cid, 'sender_id': expert.id, 'message': 'hello',
+                         'timestamp': now, 'deleted': False})
+        messages.append({'consultation_id': cid, 'sender_id': client.id, 'message': 'any news?',
+                         'timestamp': now, 'deleted': False})
+    db.session.execute(Message.__table__.insert(), messages)
+    # The expert has read up to the first message of every conversation
+    db.session.execute(db.text(
+        "INSERT INTO read_receipts (consultation_id, user_id, last_read_message_id) "
+        "SELECT consultation_id, :uid, MIN(id) FROM messages GROUP BY consultation_id"
+    ), {'uid': expert.id})
+    db.session.commit()
+    return expert.id
+
+
+def legacy_unread_counts(user):
+    """The original loop, one COUNT per consultation, on watermark semantics."""
+    from models import Consultation, Message, ReadReceipt
+
+    consultations = Consultation.query.filter_by(expert_id=user.id).all()
+    result = {}
+    for consultation in consultations:
+        receipt = ReadReceipt.query.filter_by(consultation_id=consultation.id, user_id=user.id).first()
+        count = Message.query.filter(
+            Message.consultation_id == consultation.id,
+            Message.sender_id != user.id,
+            Message.id > (receipt.last_read_message_id if receipt else 0),
+        ).count()
+        if count > 0:
+            result[consultation.id] = count
+    return result
+
+
+def main():
+    app, path = make_bench_app()
+    from models import db, User
+    from auth_utils import generate_token
+
+    client = app.test_client()
+    rows = []
+    try:
+        for size in SIZES:
+            with app.app_context():
+                expert_id = seed(db, size)
+                token = generate_token(expert_id)
+                user = db.session.get(User, expert_id)
+                headers = {'Authorization': f'Bearer {token}'}
+
+                def grouped():
+                    r = client.get('/api/v1/unread-counts', headers=headers)
+                    assert r.status_code == 200, r.data
+                    return r
+
+                db.session.expunge_all()
+                with QueryCounter(db.engine) as qc:
+                    total = grouped().get_json()['total_unread']
+                samples = time_calls(grouped, ITERATIONS)
+                rows.append(('grouped', size, qc.count, total,
+                             f'{percentile(samples, 50):.2f}', f'{percentile(samples, 99):.2f}'))
+
+                legacy_iterations = max(3, ITERATIONS // max(1, size // 100))
+                with QueryCounter(db.engine) as qc:
+                    legacy_total = sum(legacy_unread_counts(user).values())
+                assert legacy_total == total, (legacy_total, total)
+                samples = time_calls(lambda: legacy_unread_counts(user), legacy_iterations)
+                rows.append(('per-consultation', size, qc.count, legacy_total,
+                             f'{percentile(samples, 50):.2f}', f'{percentile(samples, 99):.2f}'))
+                db.session.remove()
+    finally:
+        os.remove(path)
+
+    print_table(['implementation', 'consultations', 'queries', 'unread', 'p50 ms', 'p99 ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
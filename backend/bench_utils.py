@@ -0,0 +1,72 @@
+"""
+Shared helpers for the bench_*.py scripts.
+Each benchmark builds a throwaway SQLite database, seeds it and drives
+the real Flask routes through the test client.
+"""
+import os, sys, math, time, tempfile
+sys.path.insert(0, os.path.dirname(__file__))
+
+from sqlalchemy import event
+
+
+def make_bench_app():
+    """Create the app against a fresh temporary SQLite file."""
+    fd, path = tempfile.mkstemp(prefix='agromedicana-bench-', suffix='.sqlite')
+    os.close(fd)
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    return app, path
+
+
+class QueryCounter:
+    """Counts SQL statements sent to an engine while the block is active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+        return False
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def time_calls(fn, iterations):
+    """Call fn() `iterations` times, returning per-call latencies in ms."""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    line = '  '.join(str(h).ljust(w) for h, w in zip(headers, widths))
+    print(line)
+    print('-' * len(line))
+    for r in rows:
+        print('  '.join(str(c).ljust(w) for c, w in zip(r, widths)))
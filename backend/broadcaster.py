@@ -0,0 +1,187 @@
+"""
+Admin broadcasts: one notification to every user in a segment.
+
+A segment selects users by role, location and/or crops. Recipients are
+walked in user id order, CHUNK_SIZE at a time. Each chunk is one
+INSERT ... SELECT into notifications (only the new ids come back to Python)
+and one UPDATE of the matching unread counters. Users who turned the
+broadcast's type off in their notification preferences are left out of
+both and counted as skipped ('alert' reaches everyone). The broadcast's progress
+is committed in the same transaction, so a broadcast that was interrupted
+resumes after the last chunk it wrote. One bus event per chunk reaches all
+of the chunk's recipients, each with the id of their own notification.
+
+Broadcasts run on a background thread, so the request that queues one
+returns at once. To resume broadcasts after a crash (with no worker still
+delivering them), run:
+
+    python broadcaster.py [broadcast_id ...]
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func, literal, or_, select
+
+from events import publish
+from models import db, Broadcast, Notification, NotificationCounter, User
+import notification_prefs
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+CHUNK_PAUSE = 0.005  # seconds between chunks; lets request transactions get the write lock
+MAX_RUNNING = 2  # broadcasts running at once in one process
+
+SEGMENT_KEYS = ('role', 'location', 'crops')
+
+_slots = threading.BoundedSemaphore(MAX_RUNNING)
+
+
+def parse_segment(data):
+    """Validate a segment from a request. Returns (segment, error)."""
+    if data is None:
+        return {}, None
+    if not isinstance(data, dict):
+        return None, 'segment must be an object'
+    unknown = set(data) - set(SEGMENT_KEYS)
+    if unknown:
+        return None, f'unknown segment keys: {", ".join(sorted(unknown))}'
+    segment = {}
+    for key in ('role', 'location'):
+        value = data.get(key)
+        if value is not None and not isinstance(value, str):
+            return None, f'segment.{key} must be a string'
+        if value:
+            segment[key] = value.strip()
+    crops = data.get('crops')
+    if isinstance(crops, str):
+        crops = crops.split(',')
+    if crops is not None and not (isinstance(crops, list) and all(isinstance(c, str) for c in crops)):
+        return None, 'segment.crops must be a list of strings'
+    crops = [c.strip() for c in crops or [] if c.strip()]
+    if crops:
+        segment['crops'] = crops
+    return segment, None
+
+
+def segment_filter(segment):
+    """SQL condition on users for a segment. Location and crops match case-insensitively as substrings."""
+    conditions = []
+    if segment.get('role'):
+        conditions.append(User.role == segment['role'])
+    if segment.get('location'):
+        conditions.append(func.lower(User.location).contains(segment['location'].lower(), autoescape=True))
+    if segment.get('crops'):
+        conditions.append(or_(*[func.lower(User.primary_crops).contains(crop.lower(), autoescape=True)
+                                for crop in segment['crops']]))
+    return conditions
+
+
+def count_recipients(segment):
+    return db.session.query(func.count(User.id)).filter(*segment_filter(segment)).scalar()
+
+
+def start(app, broadcast_id):
+    """Run a queued broadcast on a background thread; returns the thread."""
+    thread = threading.Thread(target=run, args=(app, broadcast_id), name=f'broadcast-{broadcast_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def run(app, broadcast_id, resume=False, chunk_size=CHUNK_SIZE):
+    """Deliver a broadcast to the rest of its segment.
+
+    Only a queued broadcast is picked up, unless resume is set, which also
+    continues failed and interrupted (still 'running') ones. Returns the
+    broadcast's final status, or None if it wasn't picked up.
+    """
+    with _slots, app.app_context():
+        claimable = ['queued', 'failed', 'running'] if resume else ['queued']
+        claimed = Broadcast.query.filter(Broadcast.id == broadcast_id, Broadcast.status.in_(claimable)).update(
+            {'status': 'running', 'error': None,
+             'started_at': func.coalesce(Broadcast.started_at, datetime.utcnow())},
+            synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return None
+        broadcast = db.session.get(Broadcast, broadcast_id)
+        try:
+            _deliver(broadcast, chunk_size)
+            broadcast.status = 'done'
+        except Exception as e:
+            log.exception('broadcast %s failed', broadcast_id)
+            db.session.rollback()
+            broadcast = db.session.get(Broadcast, broadcast_id)
+            broadcast.status, broadcast.error = 'failed', str(e)[:500]
+        broadcast.finished_at = datetime.utcnow()
+        db.session.commit()
+        status = broadcast.status
+        db.session.remove()
+        return status
+
+
+def _deliver(broadcast, chunk_size):
+    conditions = segment_filter(json.loads(broadcast.segment or '{}'))
+    fields = {
+        'type': broadcast.type, 'title': broadcast.title, 'description': broadcast.description,
+        'icon': broadcast.icon, 'color': broadcast.color, 'link': broadcast.link, 'ref_id': broadcast.id,
+    }
+    table = Notification.__table__
+    last_user_id = broadcast.last_user_id or 0
+
+    while True:
+        users = db.session.execute(select(User.id, User.notification_prefs)
+                                   .where(*conditions, User.id > last_user_id)
+                                   .order_by(User.id).limit(chunk_size)).all()
+        if not users:
+            return
+        first, last_user_id = users[0][0], users[-1][0]
+        skipped = notification_prefs.opted_out(users, broadcast.type)
+        in_chunk = [*conditions, User.id.between(first, last_user_id)]
+        if skipped:
+            in_chunk.append(User.id.notin_(skipped))
+        now = datetime.utcnow()
+        values = dict(fields, read=False, count=1, created_at=now)
+        recipients = select(User.id, *[literal(v, type_=table.c[k].type).label(k) for k, v in values.items()]
+                            ).where(*in_chunk)
+        inserted = dict(db.session.execute(table.insert().from_select(['user_id', *values], recipients)
+                                           .returning(table.c.user_id, table.c.id)).all())
+        # Counters that aren't seeded yet will include these rows when they are
+        NotificationCounter.query.filter(
+            NotificationCounter.user_id.in_(select(User.id).where(*in_chunk))
+        ).update({NotificationCounter.unread: NotificationCounter.unread + 1}, synchronize_session=False)
+        Broadcast.query.filter_by(id=broadcast.id).update(
+            {'sent': Broadcast.sent + len(inserted), 'skipped': func.coalesce(Broadcast.skipped, 0) + len(skipped),
+             'last_user_id': last_user_id}, synchronize_session=False)
+        db.session.commit()
+
+        # One bus event for the chunk; each recipient's copy carries the id of their own row
+        publish(list(inserted), 'notification',
+                dict(fields, read=False, count=1, broadcast_id=broadcast.id,
+                     time='Just now', created_at=now.isoformat()),
+                per_user={user_id: {'id': row_id, 'user_id': user_id} for user_id, row_id in inserted.items()})
+        time.sleep(CHUNK_PAUSE)
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        if len(sys.argv) > 1:
+            pending = [int(arg) for arg in sys.argv[1:]]
+        else:
+            pending = [b.id for b in Broadcast.query.filter(
+                Broadcast.status.in_(['queued', 'running', 'failed'])).order_by(Broadcast.id)]
+        db.session.remove()
+    for broadcast_id in pending:
+        status = run(app, broadcast_id, resume=True)
+        with app.app_context():
+            b = db.session.get(Broadcast, broadcast_id)
+            print(f"Broadcast {broadcast_id}: {status or 'not resumable'}"
+                  + (f" ({b.sent}/{b.total} sent)" if b else ''))
@@ -0,0 +1,98 @@
+"""
+Cached chat eligibility per consultation.
+
+send_message needs to know whether a consultation is accepted and paid, who
+its participants are and the roles used to build the recipient's deep link.
+That rarely changes, so it is loaded with one query and cached per worker.
+Whoever changes the consultation status or records a payment calls
+invalidate(), which reaches every worker over the event bus.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import exists
+from sqlalchemy.orm import aliased
+
+import event_bus
+from models import db, Consultation, Payment, User
+
+GATE_TTL_SECONDS = 300  # safety net; changes are normally pushed via invalidate()
+MAX_CACHED_GATES = 10000
+
+ChatGate = namedtuple('ChatGate', ['status', 'paid', 'client_id', 'expert_id', 'client_role', 'expert_role'])
+
+_gates = OrderedDict()  # consultation_id -> (ChatGate, expires_at)
+# Bumped by every invalidation. A gate read from the database is only cached
+# if no invalidation arrived while it was being read; it may predate the change.
+_generations = {}  # consultation_id -> count of invalidations seen
+_generation = 0  # count of resyncs, which invalidate every consultation
+_lock = threading.Lock()
+
+
+def load_gate(consultation_id):
+    """Read the gate from the database in one query; None if the consultation doesn't exist."""
+    client, expert = aliased(User), aliased(User)
+    row = db.session.query(
+        Consultation.status,
+        exists().where(Payment.consultation_id == Consultation.id),
+        Consultation.client_id,
+        Consultation.expert_id,
+        client.role,
+        expert.role,
+    ).outerjoin(client, client.id == Consultation.client_id
+    ).outerjoin(expert, expert.id == Consultation.expert_id
+    ).filter(Consultation.id == consultation_id).first()
+    return ChatGate(*row) if row else None
+
+
+def get_gate(consultation_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _gates.get(consultation_id)
+        if entry and entry[1] > now:
+            _gates.move_to_end(consultation_id)
+            return entry[0]
+        generation = (_generation, _generations.get(consultation_id, 0))
+    gate = load_gate(consultation_id)
+    if gate is not None:  # don't cache misses, SQLite may reuse the id
+        with _lock:
+            if generation != (_generation, _generations.get(consultation_id, 0)):
+                return gate  # invalidated while loading; use it for this request only
+            _gates[consultation_id] = (gate, now + GATE_TTL_SECONDS)
+            _gates.move_to_end(consultation_id)
+            while len(_gates) > MAX_CACHED_GATES:
+                _gates.popitem(last=False)
+    return gate
+
+
+def invalidate(consultation_id):
+    """Drop a consultation's cached gate in every worker. Call after committing the change."""
+    event_bus.publish('chat_gate', {'consultation_id': consultation_id})
+
+
+def _on_invalidate(event_id, payload):
+    consultation_id = payload['consultation_id']
+    with _lock:
+        _gates.pop(consultation_id, None)
+        _generations[consultation_id] = _generations.get(consultation_id, 0) + 1
+        if len(_generations) > MAX_CACHED_GATES:
+            _reset_generations()
+
+
+def _on_resync(event_id, payload):
+    with _lock:
+        _gates.clear()
+        _reset_generations()
+
+
+def _reset_generations():
+    # Forget the per-consultation counters; bumping the global one keeps loads in flight from being cached
+    global _generation
+    _generations.clear()
+    _generation += 1
+
+
+event_bus.subscribe('chat_gate', _on_invalidate)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
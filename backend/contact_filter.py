@@ -0,0 +1,252 @@
+"""
+Contact-information detection for chat messages.
+
+Farmers and experts must not move a paid consultation off-platform, so
+messages containing phone numbers, e-mail addresses, social handles or
+references to messaging apps are rejected. BLOCKED_PATTERNS is the policy;
+ContactInfoDetector compiles it once into:
+
+  * a combined alternation per family of rules (digits, '@', everything
+    else), each skipped outright when the text can't satisfy it, and
+  * a keyword automaton (a trie folded into the regex) for the plain word
+    lists such as app and social-network names.
+
+Clean text, the overwhelming majority, is accepted after that screening
+pass. Only text that trips it is checked rule by rule, so the reported
+reason is always the first matching pattern in BLOCKED_PATTERNS order,
+exactly as before.
+"""
+
+import re
+
+# Contact information detection patterns, in priority order
+BLOCKED_PATTERNS = [
+    # Phone number patterns
+    (r'\b\d{10,}\b', 'phone number'),
+    (r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b', 'phone number'),
+    (r'\b\+\d{1,3}[-\s]?\d{6,}\b', 'phone number'),
+    (r'\b0\d{2}[-\s]?\d{3}[-\s]?\d{4}\b', 'phone number'),
+    (r'\b\(?\d{3}\)?[-\s]?\d{3}[-\s]?\d{4}\b', 'phone number'),
+    (r'\b\d{3}\s\d{3}\s\d{4}\b', 'phone number'),
+    # Messaging apps and contact requests
+    (r'whatsapp|telegram|signal|viber', 'messaging app reference'),
+    (r'call\s*me|text\s*me|phone|mobile', 'contact request'),
+    # Email patterns
+    (r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', 'email address'),
+    # Social media
+    (r'@[a-zA-Z0-9_]{3,}', 'social media handle'),
+    (r'facebook|instagram|twitter|snapchat|tiktok', 'social media reference'),
+]
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+_WORD = re.compile(r'^[a-z0-9]+$')
+_DIGIT = re.compile(r'\d')
+
+# Gates: cheap necessary conditions on the whole text, checked once
+GATE_NONE, GATE_DIGIT, GATE_AT = 0, 1, 2
+
+_CATEGORY_CLASSES = {
+    sre_parse.CATEGORY_DIGIT: r'\d',
+    sre_parse.CATEGORY_SPACE: r'\s',
+    sre_parse.CATEGORY_WORD: r'\w',
+}
+
+
+def keyword_regex(words):
+    """Fold a word list into a trie-shaped regex, e.g. ['tik', 'tiktok'] -> 'tik(?:tok)?'.
+
+    Alternatives at each node start with distinct characters, so the regex
+    engine walks the trie instead of retrying every word at every offset.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        terminal = '' in node
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if terminal:
+            return ('(?:' + body + ')?') if len(branches) == 1 else body + '?'
+        return body
+
+    return build(trie)
+
+
+def _first_chars(items):
+    """Character-class fragments a match of parsed `items` can start with.
+
+    Returns (fragments, nullable), or None when the set can't be determined.
+    """
+    fragments = set()
+    for op, arg in items:
+        if op is sre_parse.AT:
+            continue  # zero-width (\b, ^, $)
+        if op is sre_parse.LITERAL:
+            fragments.add(re.escape(chr(arg)))
+            return fragments, False
+        if op is sre_parse.IN:
+            for sub_op, sub_arg in arg:
+                if sub_op is sre_parse.LITERAL:
+                    fragments.add(re.escape(chr(sub_arg)))
+                elif sub_op is sre_parse.RANGE:
+                    fragments.add(f'{re.escape(chr(sub_arg[0]))}-{re.escape(chr(sub_arg[1]))}')
+                elif sub_op is sre_parse.CATEGORY and sub_arg in _CATEGORY_CLASSES:
+                    fragments.add(_CATEGORY_CLASSES[sub_arg])
+                else:
+                    return None
+            return fragments, False
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, _, sub = arg
+            first = _first_chars(sub)
+            if first is None:
+                return None
+            fragments |= first[0]
+            if low > 0 and not first[1]:
+                return fragments, False
+            continue
+        if op is sre_parse.SUBPATTERN:
+            first = _first_chars(arg[-1])
+            if first is None:
+                return None
+            fragments |= first[0]
+            if not first[1]:
+                return fragments, False
+            continue
+        if op is sre_parse.BRANCH:
+            nullable = False
+            for branch in arg[1]:
+                first = _first_chars(branch)
+                if first is None:
+                    return None
+                fragments |= first[0]
+                nullable = nullable or first[1]
+            if not nullable:
+                return fragments, False
+            continue
+        return None
+    return fragments, True
+
+
+def start_hint(source):
+    """A '(?=[...])' prefix listing the characters a match must start with.
+
+    The regex engine skips offsets that fail a one-character class far
+    faster than it can try every alternative of a combined pattern there.
+    """
+    first = _first_chars(sre_parse.parse(source))
+    if first is None or first[1] or not first[0]:
+        return ''
+    return '(?=[' + ''.join(sorted(first[0])) + '])'
+
+
+def _mandatory(pattern, token):
+    """True if token appears in pattern outside any class, group or optional quantifier."""
+    flat = re.sub(r'\[(?:\\.|[^\]])*\]', '#', pattern)  # character classes -> placeholder
+    if re.search(r'(?<!\\)\(', flat):
+        return False
+    return re.search(re.escape(token) + r'(?![?*]|\{0)', flat) is not None
+
+
+def split_rule(pattern):
+    """Return (keywords, other branches, gate) for one BLOCKED_PATTERNS entry.
+
+    Literal words of a top-level alternation are returned separately so they
+    can go into a keyword trie. The gate records something the text must
+    contain for the rule to possibly match.
+    """
+    branches = pattern.split('|')
+    if any(b.count('(') != b.count('\\(') or b.count('[') != b.count('\\[') for b in branches):
+        # Groups or classes may contain '|': keep the pattern as written
+        branches = [pattern]
+    words = [b for b in branches if _WORD.match(b)]
+    others = [b for b in branches if not _WORD.match(b)]
+
+    gate = GATE_NONE
+    if len(branches) == 1:
+        if _mandatory(pattern, '@'):
+            gate = GATE_AT
+        elif _mandatory(pattern, r'\d'):
+            gate = GATE_DIGIT
+    return words, others, gate
+
+
+class ContactInfoDetector:
+    """Precompiled matcher for a list of (pattern, reason) rules."""
+
+    def __init__(self, patterns=BLOCKED_PATTERNS):
+        self.reasons = [reason for _, reason in patterns]
+        rules = [split_rule(pattern) for pattern, _ in patterns]
+
+        # Screening pass: one combined alternation per gate family, with all
+        # keywords of the family folded into a single trie
+        families = {}
+        for words, others, gate in rules:
+            fam_words, fam_others = families.setdefault(gate, ([], []))
+            fam_words.extend(words)
+            fam_others.extend(others)
+        screens = []
+        for gate, (words, others) in sorted(families.items()):
+            source = '|'.join(others + ([keyword_regex(words)] if words else []))
+            screens.append((gate, start_hint(source) + f'(?:{source})'))
+
+        # Attribution pass, only for text that failed screening: the rules
+        # one by one in priority order, so the reason matches the policy order
+        singles = []
+        for words, others, gate in rules:
+            source = '|'.join(others + ([keyword_regex(words)] if words else []))
+            singles.append((gate, start_hint(source) + f'(?:{source})'))
+
+        # Text is lowercased before matching, so for ASCII text the patterns
+        # can run case-sensitively (much faster in the regex engine). Other
+        # text keeps re.IGNORECASE to preserve its Unicode case folding.
+        self._screens = {
+            ascii_only: [(gate, re.compile(src, 0 if ascii_only else re.IGNORECASE).search) for gate, src in screens]
+            for ascii_only in (True, False)
+        }
+        self._singles = {
+            ascii_only: [(gate, re.compile(src, 0 if ascii_only else re.IGNORECASE).search) for gate, src in singles]
+            for ascii_only in (True, False)
+        }
+
+    def check(self, text):
+        """Return (True, reason) if text contains contact information, else (False, None)."""
+        text_lower = text.lower()
+        ascii_only = text_lower.isascii()
+        gates = (GATE_NONE,
+                 GATE_DIGIT if _DIGIT.search(text_lower) else GATE_NONE,
+                 GATE_AT if '@' in text_lower else GATE_NONE)
+        for gate, search in self._screens[ascii_only]:
+            if gate in gates and search(text_lower):
+                break
+        else:
+            return False, None
+        for index, (gate, search) in enumerate(self._singles[ascii_only]):
+            if gate in gates and search(text_lower):
+                return True, self.reasons[index]
+        return False, None
+
+    def scan_many(self, texts):
+        """Check an iterable of texts, e.g. when re-auditing stored messages.
+
+        Returns a list of (blocked, reason) tuples in input order.
+        """
+        check = self.check
+        return [check(text or '') for text in texts]
+
+
+detector = ContactInfoDetector()
+
+
+def check_for_contact_info(text):
+    """Check if text contains blocked contact information"""
+    return detector.check(text)
@@ -0,0 +1,345 @@
+"""
+Cross-worker publish/subscribe backplane for AgroMedicana.
+
+Gunicorn runs several worker processes, so anything published in one worker
+(new messages, notifications, typing signals, cache invalidations) has to
+reach the others. Code publishes to a named channel and registers handlers
+with subscribe(); the configured backend delivers every event to the
+handlers of every worker, including the one that published it.
+
+Backends, selected by EVENT_BUS_URL:
+  memory://                  in-process only (single worker, tests)
+  sqlite:////path/bus.sqlite shared file, for forked workers on one box
+  redis://host:6379/0        any server speaking the Redis protocol
+
+Every backend assigns each event an increasing integer id and exposes an
+epoch string shared by all workers, so event ids are comparable across
+processes (used for SSE Last-Event-ID resume).
+
+Publishing is best effort. Callers publish after their commit, so a bus
+failure is logged and the event dropped; it never fails the request. The
+Redis backend loses the events published while its subscriber connection
+is down. On reconnect it compares the sequence counter with the last id it
+saw and, if anything was missed, delivers a RESYNC event to this worker:
+caches drop what they hold and SSE clients are told to refetch.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+DEFAULT_URL = 'memory://'
+RESYNC = 'resync'  # local channel: events up to event_id may have been lost
+
+_handlers = defaultdict(list)  # channel -> [handler(event_id, payload)]
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def subscribe(channel, handler):
+    """Register handler(event_id, payload) for a channel in this process."""
+    _handlers[channel].append(handler)
+
+
+def _dispatch(channel, event_id, payload):
+    for handler in _handlers.get(channel, ()):
+        try:
+            handler(event_id, payload)
+        except Exception:
+            log.exception('event bus handler failed for channel %s', channel)
+
+
+def create_bus(url, on_event=_dispatch):
+    """Build a backend for url; on_event(channel, event_id, payload) receives deliveries."""
+    parsed = urlparse(url or DEFAULT_URL)
+    if parsed.scheme == 'memory':
+        return InProcessBus(on_event)
+    if parsed.scheme == 'sqlite':
+        return SQLiteBus(url[len('sqlite:///'):], on_event)
+    if parsed.scheme == 'redis':
+        return RedisBus(parsed.hostname or 'localhost', parsed.port or 6379,
+                        int((parsed.path or '/0').lstrip('/') or 0), on_event)
+    raise ValueError(f'Unsupported EVENT_BUS_URL: {url}')
+
+
+def configure(url):
+    """Select the process-wide backend. Reconfiguring with the same url is a no-op."""
+    global _bus
+    with _bus_lock:
+        if _bus is not None and _bus.url == url:
+            return _bus
+        if _bus is not None:
+            _bus.close()
+        _bus = create_bus(url)
+        _bus.url = url
+        return _bus
+
+
+def get_bus():
+    if _bus is None:
+        configure(os.environ.get('EVENT_BUS_URL', DEFAULT_URL))
+    return _bus
+
+
+def publish(channel, payload):
+    """Publish a JSON-serialisable payload to every worker's subscribers. Never raises."""
+    try:
+        get_bus().publish(channel, payload)
+    except Exception:
+        log.exception('event bus publish failed; dropped %s event', channel)
+
+
+class InProcessBus:
+    """Delivers synchronously to this process only."""
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def publish(self, channel, payload):
+        with self._lock:
+            self._seq += 1
+            event_id = self._seq
+        self.on_event(channel, event_id, payload)
+
+    def close(self):
+        pass
+
+
+class SQLiteBus:
+    """Append-only event table in a shared SQLite file, tailed by each worker.
+
+    Publishing is one INSERT; a daemon thread per process polls for rows it
+    has not seen yet. AUTOINCREMENT keeps ids monotonic even after old rows
+    are pruned.
+    """
+
+    def __init__(self, path, on_event, poll_interval=0.05, retention_seconds=600):
+        self.path = path
+        self.on_event = on_event
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._closed = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS bus_events ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, '
+                     'payload TEXT NOT NULL, created_at REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS bus_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute("INSERT OR IGNORE INTO bus_meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+        self.epoch = conn.execute("SELECT value FROM bus_meta WHERE key = 'epoch'").fetchone()[0]
+        self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM bus_events').fetchone()[0]
+        self._ensure_poller()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)  # autocommit
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_poller(self):
+        # Threads don't survive fork(); start one per worker process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._poll_loop, name='event-bus-sqlite', daemon=True).start()
+
+    def publish(self, channel, payload):
+        self._ensure_poller()
+        conn = self._conn()
+        conn.execute('INSERT INTO bus_events (channel, payload, created_at) VALUES (?, ?, ?)',
+                     (channel, json.dumps(payload), time.time()))
+
+    def _poll_loop(self):
+        conn = self._connect()
+        last_prune = time.monotonic()
+        while not self._closed.is_set():
+            try:
+                rows = conn.execute('SELECT id, channel, payload FROM bus_events WHERE id > ? ORDER BY id LIMIT 500',
+                                    (self._last_id,)).fetchall()
+                for event_id, channel, payload in rows:
+                    self._last_id = event_id
+                    self.on_event(channel, event_id, json.loads(payload))
+                if time.monotonic() - last_prune > 30:
+                    conn.execute('DELETE FROM bus_events WHERE created_at < ?', (time.time() - self.retention_seconds,))
+                    last_prune = time.monotonic()
+                if rows:
+                    continue
+            except sqlite3.Error:
+                log.exception('event bus poll failed')
+            self._closed.wait(self.poll_interval)
+        conn.close()
+
+    def close(self):
+        self._closed.set()
+
+
+class _RespConnection:
+    """Just enough of the Redis serialization protocol (RESP2) for the bus."""
+
+    def __init__(self, host, port, db=0, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.sock.settimeout(timeout)
+        self.reader = self.sock.makefile('rb')
+        if db:
+            self.command('SELECT', db)
+
+    def send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(parts))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed')
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode()
+        if kind == b'-':
+            raise RuntimeError(body.decode())
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self.read() for _ in range(int(body))]
+        raise ConnectionError(f'unexpected RESP reply: {line!r}')
+
+    def command(self, *args):
+        self.send(*args)
+        return self.read()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBus:
+    """PUBLISH/SUBSCRIBE on one Redis channel, ids from INCR.
+
+    Two publishers can PUBLISH in a different order than they INCRed, so ids
+    may arrive slightly out of order; consumers treat them as "at least this
+    new" rather than strictly sequential.
+    """
+
+    CHANNEL = 'agromedicana:bus'
+    SEQ_KEY = 'agromedicana:bus:seq'
+    EPOCH_KEY = 'agromedicana:bus:epoch'
+
+    def __init__(self, host, port, db, on_event):
+        self.host, self.port, self.db = host, port, db
+        self.on_event = on_event
+        self._local = threading.local()
+        self._closed = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+        conn = _RespConnection(host, port, db)
+        conn.command('SETNX', self.EPOCH_KEY, uuid.uuid4().hex[:8])
+        self.epoch = conn.command('GET', self.EPOCH_KEY).decode()
+        conn.close()
+        self._ensure_listener()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = self._local.conn = _RespConnection(self.host, self.port, self.db, timeout=5)
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            ready = threading.Event()
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen_loop, args=(ready,), name='event-bus-redis', daemon=True).start()
+            ready.wait(5)
+
+    def publish(self, channel, payload):
+        self._ensure_listener()
+        for attempt in range(2):  # a pooled connection may have died since its last use
+            try:
+                conn = self._conn()
+                event_id = conn.command('INCR', self.SEQ_KEY)
+                conn.command('PUBLISH', self.CHANNEL, json.dumps({'c': channel, 'i': event_id, 'p': payload}))
+                return
+            except (OSError, ConnectionError):
+                self._local.conn = None
+                if attempt:
+                    raise
+
+    def _current_seq(self):
+        conn = _RespConnection(self.host, self.port, self.db)
+        try:
+            return int(conn.command('GET', self.SEQ_KEY) or 0)
+        finally:
+            conn.close()
+
+    def _listen_loop(self, ready):
+        backoff = 0.1
+        last_seen = None  # highest event id received
+        while not self._closed.is_set():
+            try:
+                conn = _RespConnection(self.host, self.port, self.db)
+                conn.send('SUBSCRIBE', self.CHANNEL)
+                conn.read()  # subscribe confirmation
+                # Anything published before SUBSCRIBE took effect never reaches us
+                seq = self._current_seq()
+                if last_seen is not None and seq > last_seen:
+                    log.warning('event bus redis missed events %d..%d while disconnected, resyncing',
+                                last_seen + 1, seq)
+                    self.on_event(RESYNC, seq, {'missed_from': last_seen + 1})
+                last_seen = max(last_seen or 0, seq)
+                ready.set()
+                backoff = 0.1
+                while not self._closed.is_set():
+                    reply = conn.read()
+                    if isinstance(reply, list) and reply and reply[0] == b'message':
+                        event = json.loads(reply[2])
+                        last_seen = max(last_seen, event['i'])
+                        self.on_event(event['c'], event['i'], event['p'])
+            except (OSError, ConnectionError, ValueError, RuntimeError):
+                log.warning('event bus redis connection lost, retrying in %.1fs', backoff)
+                self._closed.wait(backoff)
+                backoff = min(backoff * 2, 5)
+
+    def close(self):
+        self._closed.set()
@@ -0,0 +1,176 @@
+"""
+Real-time event hub for AgroMedicana.
+
+Routes publish small JSON events (new messages, notifications, typing and
+presence changes) addressed to one or more users; the /api/v1/events
+Server-Sent Events stream delivers them. A bounded per-user replay buffer
+lets reconnecting clients resume from their Last-Event-ID.
+
+Events travel over the event bus (event_bus.py), so every worker's hub sees
+every event with the same id, whichever worker published it.
+"""
+
+import json
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+import event_bus
+
+# Events kept per user for Last-Event-ID replay
+REPLAY_BUFFER_PER_USER = 200
+# Users with a replay buffer; least recently active users are dropped first
+MAX_BUFFERED_USERS = 10000
+
+Event = namedtuple('Event', ['seq', 'type', 'data'])
+
+
+class _UserBuffer:
+    __slots__ = ('events', 'dropped_upto')
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.dropped_upto = 0  # highest seq that fell out of the buffer
+
+
+class EventHub:
+    """Per-user replay buffers fed by the event bus.
+
+    Event ids are "<epoch>:<seq>", where seq is the bus event id and epoch
+    identifies the bus. A Last-Event-ID from another bus (e.g. before a
+    restart of the in-process backend) is detected and the client is told
+    to resync instead of silently missing events.
+    """
+
+    def __init__(self, buffer_size=REPLAY_BUFFER_PER_USER, max_users=MAX_BUFFERED_USERS):
+        self._buffer_size = buffer_size
+        self._max_users = max_users
+        self._buffers = OrderedDict()  # user_id -> _UserBuffer
+        self._seq = 0
+        self._evicted_upto = 0  # newest seq held by a user buffer that was dropped
+        self._lost_upto = 0  # events up to this seq may never have reached this worker
+        self._cond = threading.Condition()
+
+    @property
+    def epoch(self):
+        return event_bus.get_bus().epoch
+
+    def format_id(self, seq):
+        return f'{self.epoch}:{seq}'
+
+    def parse_id(self, event_id):
+        """Return the sequence number for a Last-Event-ID from this hub, else None."""
+        if not event_id or ':' not in event_id:
+            return None
+        epoch, _, seq = event_id.partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    @property
+    def last_seq(self):
+        with self._cond:
+            return self._seq
+
+    def add(self, seq, user_ids, event_type, data, per_user=None):
+        """Buffer a delivered bus event for every user in user_ids and wake streams.
+
+        per_user maps str(user_id) to fields merged into that user's copy of data.
+        """
+        with self._cond:
+            # Bus ids only ever grow, but may arrive slightly out of order (Redis)
+            self._seq = max(self._seq, seq)
+            shared = Event(seq, event_type, data)
+            for uid in user_ids:
+                own = per_user.get(str(uid)) if per_user else None
+                event = Event(seq, event_type, dict(data, **own)) if own else shared
+                buf = self._buffers.get(uid)
+                if buf is None:
+                    buf = self._buffers[uid] = _UserBuffer(self._buffer_size)
+                    if len(self._buffers) > self._max_users:
+                        _, evicted = self._buffers.popitem(last=False)
+                        if evicted.events:
+                            self._evicted_upto = max(self._evicted_upto, evicted.events[-1].seq)
+                else:
+                    self._buffers.move_to_end(uid)
+                if len(buf.events) == buf.events.maxlen:
+                    buf.dropped_upto = buf.events[0].seq
+                buf.events.append(event)
+            self._cond.notify_all()
+
+    def resync(self, seq):
+        """Events up to seq may have been lost by the bus: every stream has to resync."""
+        with self._cond:
+            self._seq = max(self._seq, seq)
+            self._lost_upto = max(self._lost_upto, seq)
+            self._cond.notify_all()
+
+    def events_since(self, user_id, last_seq):
+        """Buffered events for user_id newer than last_seq.
+
+        Returns (events, complete); complete is False when some events after
+        last_seq have already been evicted, or were lost by the bus, and the
+        client must resync.
+        """
+        with self._cond:
+            return self._events_since(user_id, last_seq)
+
+    def _events_since(self, user_id, last_seq):
+        if last_seq > self._seq or last_seq < self._lost_upto:
+            return [], False
+        buf = self._buffers.get(user_id)
+        if buf is None:
+            return [], last_seq >= self._evicted_upto
+        events = [e for e in buf.events if e.seq > last_seq]
+        return events, last_seq >= buf.dropped_upto
+
+    def wait(self, user_id, last_seq, timeout):
+        """Block until user_id has events newer than last_seq, or timeout. Returns (events, complete)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._has_events(user_id, last_seq), timeout)
+            return self._events_since(user_id, last_seq)
+
+    def _has_events(self, user_id, last_seq):
+        if last_seq < self._lost_upto:
+            return True
+        buf = self._buffers.get(user_id)
+        return bool(buf and buf.events and buf.events[-1].seq > last_seq)
+
+
+hub = EventHub()
+
+
+def publish(user_ids, event_type, data, per_user=None):
+    """Publish an event to the given users. Safe to call from any route.
+
+    per_user ({user_id: fields}) adds fields to one user's copy only, e.g.
+    the id of each recipient's own row, still as a single bus event.
+    """
+    user_ids = sorted({uid for uid in user_ids if uid})
+    if user_ids:
+        payload = {'users': user_ids, 'type': event_type, 'data': data}
+        if per_user:
+            # str keys: the payload goes through JSON on the shared buses
+            payload['per_user'] = {str(uid): fields for uid, fields in per_user.items()}
+        event_bus.publish('events', payload)
+
+
+def _on_bus_event(event_id, payload):
+    hub.add(event_id, payload['users'], payload['type'], payload['data'], payload.get('per_user'))
+
+
+def _on_resync(event_id, payload):
+    hub.resync(event_id)
+
+
+event_bus.subscribe('events', _on_bus_event)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
+
+
+def format_sse(event_id, event_type, data):
+    """Encode one event in text/event-stream framing."""
+    lines = []
+    if event_id:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
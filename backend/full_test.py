@@ -2,14 +2,15 @@
 Comprehensive AgroMedicana API Test Suite
 Tests every endpoint and functionality systematically.
 """
-import sys, os, json, time
+import sys, os, io, json, time
 sys.path.insert(0, os.path.dirname(__file__))
 
 from app import create_app
-from models import db, User, Consultation, Message, Payment, Notification, Availability
+from models import db, User, Consultation, Message, Payment, Notification, NotificationCounter, Availability, ReadReceipt, Broadcast, ImportJob, RefreshToken, ADMIN_ROLE
 from werkzeug.security import generate_password_hash
 
-app = create_app()
+# Notifications are committed inline so every check can read them straight away
+app = create_app({'NOTIFICATION_DISPATCH': 'sync'})
 client = app.test_client()
 
 PASS = 0
@@ -43,6 +44,12 @@ def ok(name, response, expected_status=200, check_fn=None):
         print(f"  ✓ {name}")
     return data
 
+class FakeResponse:
+    """Adapts a plain check to ok(), which expects a response object."""
+    status_code = 200
+    def get_json(self, silent=False):
+        return None
+
 def auth_header(token):
     return {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
 
@@ -51,23 +58,36 @@ def auth_header(token):
 # ═══════════════════════════════════════════════════════
 with app.app_context():
     # Remove test users if they exist from a previous run
-    for uname in ['testfarmer_api', 'testexpert_api']:
+    for uname in ['testfarmer_api', 'testexpert_api', 'testadmin_api']:
         u = User.query.filter_by(username=uname).first()
         if u:
             Notification.query.filter_by(user_id=u.id).delete()
+            Broadcast.query.filter_by(created_by=u.id).delete()
+            ImportJob.query.filter_by(created_by=u.id).delete()
+            NotificationCounter.query.filter_by(user_id=u.id).delete()
+            RefreshToken.query.filter_by(user_id=u.id).delete()
             Message.query.filter_by(sender_id=u.id).delete()
             Payment.query.filter_by(client_id=u.id).delete()
             Payment.query.filter_by(expert_id=u.id).delete()
             Availability.query.filter_by(expert_id=u.id).delete()
+            ReadReceipt.query.filter_by(user_id=u.id).delete()
             # Delete consultations
             for c in Consultation.query.filter((Consultation.client_id == u.id) | (Consultation.expert_id == u.id)).all():
                 Message.query.filter_by(consultation_id=c.id).delete()
                 Payment.query.filter_by(consultation_id=c.id).delete()
                 db.session.delete(c)
             db.session.delete(u)
+    imported = User.query.filter(User.username.like('testimport_%'))
+    RefreshToken.query.filter(RefreshToken.user_id.in_(imported.with_entities(User.id))).delete(synchronize_session=False)
+    imported.delete(synchronize_session=False)
     db.session.commit()
     print("Setup: cleaned previous test data\n")
 
+# Every statement the suite makes the app run is EXPLAINed at the end (section 20)
+from query_plans import QueryRecorder, full_scans
+with app.app_context():
+    query_recorder = QueryRecorder(db.engine).start()
+
 # ═══════════════════════════════════════════════════════
 print("═══ 1. AUTH — Register / Login / Profile ═══")
 # ═══════════════════════════════════════════════════════
@@ -113,6 +133,12 @@ r = client.post('/api/v1/auth/register', json={
 })
 ok("Short username rejected", r, 400)
 
+# 1d-2. Admins can't self-register
+r = client.post('/api/v1/auth/register', json={
+    'username': 'testadmin_api', 'password': 'Test1234', 'role': ADMIN_ROLE,
+})
+ok("Admin self-registration blocked", r, 403)
+
 # 1e. Register with short password should fail
 r = client.post('/api/v1/auth/register', json={
     'username': 'shortpwduser', 'password': '12345', 'role': 'Client',
@@ -163,11 +189,41 @@ r = client.put('/api/v1/auth/profile', headers=auth_header(farmer_token), json={
 })
 ok("Update farmer profile", r, 200, lambda d: d['user']['farm_size'] == '75 hectares')
 
+# 1m-2. Identity cache: authenticating a known user runs no query, profile changes refresh it
+from sqlalchemy import event as sa_event
+from auth_utils import get_principal
+
+def user_queries(fn):
+    statements = []
+    def listener(conn, cursor, statement, *args):
+        if 'FROM users' in statement:
+            statements.append(statement)
+    with app.app_context():
+        sa_event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            fn()
+        finally:
+            sa_event.remove(db.engine, 'before_cursor_execute', listener)
+    return len(statements)
+
+client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
+cached = user_queries(lambda: client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token)))
+ok("Cached identity needs no user query", FakeResponse(), 200, lambda d: cached == 0)
+client.put('/api/v1/auth/profile', headers=auth_header(farmer_token), json={'full_name': 'Renamed Farmer'})
+with app.app_context():
+    renamed = get_principal(farmer_id).full_name
+client.put('/api/v1/auth/profile', headers=auth_header(farmer_token), json={'full_name': 'Test Farmer'})
+ok("Profile update refreshes cached identity", FakeResponse(), 200, lambda d: renamed == 'Renamed Farmer')
+
 # 1n. Change password
 r = client.post('/api/v1/auth/change-password', headers=auth_header(farmer_token), json={
     'current_password': 'Test1234', 'new_password': 'NewPass567', 'confirm_password': 'NewPass567'
 })
-ok("Change password", r, 200)
+d = ok("Change password", r, 200, lambda d: d['token'])
+r = client.get('/api/v1/auth/profile', headers=auth_header(farmer_token))
+ok("Password change revokes earlier tokens", r, 401)
+r = client.get('/api/v1/auth/profile', headers=auth_header(d['token'] if d else ''))
+ok("Password change returns a working token", r, 200)
 
 # 1o. Login with new password
 r = client.post('/api/v1/auth/login', json={
@@ -176,6 +232,39 @@ r = client.post('/api/v1/auth/login', json={
 d = ok("Login with new password", r, 200)
 farmer_token = d['token'] if d else farmer_token
 
+# 1o-2. A hash made with an older method still verifies and is upgraded on login
+from password_hasher import get_hasher
+with app.app_context():
+    db.session.get(User, farmer_id).password = generate_password_hash('NewPass567', 'pbkdf2:sha256:1000')
+    db.session.commit()
+r = client.post('/api/v1/auth/login', json={'username': 'testfarmer_api', 'password': 'NewPass567'})
+ok("Login with legacy hash", r, 200)
+with app.app_context():
+    upgraded = db.session.get(User, farmer_id).password
+ok("Legacy hash upgraded on login", FakeResponse(), 200,
+   lambda d: upgraded.startswith(get_hasher().method + '$'))
+
+# 1o-3. A short method name ('scrypt') is stored expanded; the next login must not rehash again
+import password_hasher
+configured = password_hasher._hasher
+password_hasher._hasher = password_hasher.PasswordHasher('scrypt', workers=0)
+try:
+    client.post('/api/v1/auth/login', json={'username': 'testfarmer_api', 'password': 'NewPass567'})
+    with app.app_context():
+        first = db.session.get(User, farmer_id).password
+    r = client.post('/api/v1/auth/login', json={'username': 'testfarmer_api', 'password': 'NewPass567'})
+    with app.app_context():
+        second = db.session.get(User, farmer_id).password
+finally:
+    password_hasher._hasher = configured
+
+
+def not_rehashed(d):
+    assert second == first, 'second login rehashed the password'
+
+
+ok("Second login keeps the hash", r, 200, not_rehashed)
+
 # 1p. Change password wrong current
 r = client.post('/api/v1/auth/change-password', headers=auth_header(farmer_token), json={
     'current_password': 'WrongCurrent', 'new_password': 'Another123', 'confirm_password': 'Another123'
@@ -188,6 +277,40 @@ r = client.post('/api/v1/auth/change-password', headers=auth_header(farmer_token
 })
 ok("Change password confirm mismatch rejected", r, 400)
 
+# 1r. Refresh tokens: rotation, replay detection, logout
+def login_expert():
+    return client.post('/api/v1/auth/login', json={'username': 'testexpert_api', 'password': 'Test1234'}).get_json()
+
+session = login_expert()
+ok("Login returns a refresh token", FakeResponse(), 200,
+   lambda d: session['refresh_token'] and session['expires_in'] == app.config['JWT_ACCESS_MINUTES'] * 60)
+r = client.post('/api/v1/auth/refresh', json={'refresh_token': session['refresh_token']})
+d = ok("Refresh rotates the token pair", r, 200, lambda d: d['refresh_token'] != session['refresh_token'])
+rotated = d or {}
+r = client.get('/api/v1/auth/profile', headers=auth_header(rotated.get('token', '')))
+ok("Refreshed access token works", r, 200, lambda d: d['user']['username'] == 'testexpert_api')
+r = client.post('/api/v1/auth/refresh', json={'refresh_token': session['refresh_token']})
+ok("Retired refresh token retried within grace", r, 401, lambda d: d['code'] == 'REFRESH_TOKEN_ROTATED')
+app.config['REFRESH_REUSE_GRACE_SECONDS'] = 0
+r = client.post('/api/v1/auth/refresh', json={'refresh_token': session['refresh_token']})
+app.config.pop('REFRESH_REUSE_GRACE_SECONDS')
+ok("Replayed refresh token rejected", r, 401, lambda d: d['code'] == 'REFRESH_TOKEN_REUSED')
+r = client.get('/api/v1/auth/profile', headers=auth_header(rotated.get('token', '')))
+ok("Replay ends the whole session", r, 401, lambda d: d['code'] == 'TOKEN_REVOKED')
+r = client.post('/api/v1/auth/refresh', json={'refresh_token': rotated.get('refresh_token')})
+ok("Ended session can't be refreshed", r, 401, lambda d: d['code'] == 'INVALID_REFRESH_TOKEN')
+for bad in ({'refresh_token': 12345}, {'refresh_token': ['a']}, {'refresh_token': {}}, {'refresh_token': ''}, ['x']):
+    r = client.post('/api/v1/auth/refresh', json=bad)
+    ok(f"Refresh rejects {json.dumps(bad)}", r, 401, lambda d: d['code'] == 'INVALID_REFRESH_TOKEN')
+
+session = login_expert()
+r = client.post('/api/v1/auth/logout', headers=auth_header(session['token']))
+ok("Logout", r, 200)
+r = client.get('/api/v1/auth/profile', headers=auth_header(session['token']))
+ok("Logged-out access token refused", r, 401, lambda d: d['code'] == 'TOKEN_REVOKED')
+r = client.get('/api/v1/auth/profile', headers=auth_header(expert_token))
+ok("Other sessions unaffected by logout", r, 200)
+
 
 # ═══════════════════════════════════════════════════════
 print("\n═══ 2. EXPERTS & FARMERS LISTS ═══")
@@ -402,6 +525,17 @@ if consultation_id:
 if consultation_id:
     r = client.get(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token))
     ok("Get messages", r, 200, lambda d: len(d['messages']) >= 2)
+    all_msgs = r.get_json()['messages']
+
+# 6c-2. Keyset pagination: incremental polling and scrollback
+if consultation_id and len(all_msgs) >= 2:
+    first_id, last_id = all_msgs[0]['id'], all_msgs[-1]['id']
+    r = client.get(f'/api/v1/consultations/{consultation_id}/messages?after_id={first_id}', headers=auth_header(farmer_token))
+    ok("Get messages after cursor", r, 200, lambda d: all(m['id'] > first_id for m in d['messages']))
+    r = client.get(f'/api/v1/consultations/{consultation_id}/messages?after_id={last_id}', headers=auth_header(farmer_token))
+    ok("Poll with no new messages", r, 200, lambda d: d['messages'] == [])
+    r = client.get(f'/api/v1/consultations/{consultation_id}/messages?before_id={last_id}&limit=1', headers=auth_header(farmer_token))
+    ok("Get messages before cursor", r, 200, lambda d: len(d['messages']) == 1 and d['messages'][0]['id'] < last_id)
 
 # 6d. Message with contact info should be blocked
 if consultation_id:
@@ -424,6 +558,38 @@ if consultation_id:
     })
     ok("WhatsApp reference blocked", r, 403)
 
+# 6f-2. Reason follows pattern priority; non-ASCII text still checked
+if consultation_id:
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token), json={
+        'message': 'Héllo, my WhatsApp is 077 123 4567'
+    })
+    ok("Blocked reason uses first matching rule", r, 403, lambda d: 'phone number' in d['error'])
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token), json={
+        'message': 'Soil pH was 5.2, apply 200kg per hectare before the rains'
+    })
+    ok("Clean message with numbers allowed", r, 201)
+
+# 6f-3. Offline-queue batch upload is idempotent per client_key
+if consultation_id:
+    batch = {'messages': [
+        {'client_key': 'offline-1', 'message': 'The goats stopped eating yesterday'},
+        {'client_key': 'offline-2', 'message': 'Message me on WhatsApp'},
+        {'client_key': 'offline-3', 'message': 'Two have a fever as well'},
+        {'client_key': 'offline-1', 'message': 'The goats stopped eating yesterday'},
+    ]}
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages/batch', headers=auth_header(farmer_token), json=batch)
+    d = ok("Batch upload", r, 201, lambda d: [x['status'] for x in d['results']] == ['created', 'blocked', 'created', 'duplicate']
+           and d['ids']['offline-2'] is None and d['results'][3]['id'] == d['ids']['offline-1'])
+    if d:
+        first_ids = d['ids']
+        r = client.post(f'/api/v1/consultations/{consultation_id}/messages/batch', headers=auth_header(farmer_token), json=batch)
+        ok("Batch retry returns same ids", r, 200, lambda d: d['ids'] == first_ids
+           and [x['status'] for x in d['results']] == ['duplicate', 'blocked', 'duplicate', 'duplicate'])
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages/batch', headers=auth_header(farmer_token), json={
+        'messages': [{'message': 'no key'}]
+    })
+    ok("Batch item without client_key rejected", r, 400)
+
 # 6g. Message on non-accepted consultation should fail
 if consultation2_id:
     r = client.post(f'/api/v1/consultations/{consultation2_id}/messages', headers=auth_header(farmer_token), json={
@@ -442,6 +608,43 @@ if consultation_id:
         r = client.delete(f'/api/v1/messages/{msg_id}', headers=auth_header(farmer_token))
         ok("Delete own message", r, 200)
 
+# 6h-2. Full-text search, scoped to the caller's consultations
+if consultation_id:
+    r = client.get('/api/v1/messages/search?q=goats+eating', headers=auth_header(expert_token))
+    d = ok("Search messages", r, 200, lambda d: len(d['results']) >= 1
+           and '<mark>goats</mark>' in d['results'][0]['snippet'] and d['results'][0]['consultation_id'] == consultation_id)
+    r = client.get(f'/api/v1/messages/search?q=fever&consultation_id={consultation_id}', headers=auth_header(farmer_token))
+    d = ok("Search within consultation", r, 200, lambda d: len(d['results']) == 1)
+    if d and d['results']:
+        hit_id = d['results'][0]['message_id']
+        client.delete(f'/api/v1/messages/{hit_id}', headers=auth_header(farmer_token))
+        r = client.get('/api/v1/messages/search?q=fever', headers=auth_header(farmer_token))
+        ok("Deleted message leaves search", r, 200, lambda d: all(x['message_id'] != hit_id for x in d['results']))
+    r = client.get('/api/v1/messages/search?q=', headers=auth_header(farmer_token))
+    ok("Search without query rejected", r, 400)
+
+# 6h-3. The FTS table is created by ensure_schema on its own connection, never in a
+# request's transaction, where a rollback would drop it while the mode stayed cached
+import search_index
+import tempfile
+from sqlalchemy import create_engine, inspect as sa_inspect, text
+from sqlalchemy.orm import Session
+fts_engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'fts.sqlite')}")
+with Session(fts_engine) as fts_session:
+    fts_session.execute(text('CREATE TABLE scratch (id INTEGER PRIMARY KEY)'))
+    fts_session.commit()
+    fts_session.execute(text('INSERT INTO scratch (id) VALUES (1)'))  # a request's write transaction
+    mode_in_request = search_index.search_mode(fts_session)
+    fts_session.rollback()
+    mode_after_rollback = search_index.search_mode(fts_session)
+    mode_at_startup = search_index.ensure_schema(fts_session)
+    fts_tables = sa_inspect(fts_engine).get_table_names()
+    mode_later = search_index.search_mode(fts_session)
+fts_engine.dispose()
+ok("FTS mode only cached once its table is committed", FakeResponse(), 200,
+   lambda d: mode_in_request == mode_after_rollback == 'like' and mode_at_startup == mode_later
+   and (mode_at_startup != 'fts5' or search_index.FTS_TABLE in fts_tables))
+
 # 6i. Delete someone else's message should fail
 if consultation_id:
     msgs_r = client.get(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token))
@@ -461,6 +664,76 @@ if consultation_id:
         'file_url': '/uploads/cattle_photo.jpg',
     })
     ok("Send file message", r, 201, lambda d: d['message']['message_type'] == 'file')
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token), json={
+        'message': 'Lab report attached',
+        'message_type': 'file',
+        'file_name': 'report.txt',
+        'file_url': 'data:text/plain;base64,bWFpemUgcmVwb3J0',
+    })
+    d = ok("Send inline file message", r, 201)
+    inline_id = d['message']['id'] if d else None
+
+# 6k. Transcript export streams every message; attachments referenced by URL
+if consultation_id:
+    r = client.get(f'/api/v1/consultations/{consultation_id}/transcript?format=jsonl', headers=auth_header(expert_token))
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    ok("Transcript jsonl", r, 200, lambda _: len(lines) >= 3 and lines[-1]['id'] == inline_id
+       and lines[-1]['attachment'] == f'/api/v1/messages/{inline_id}/attachment')
+    r = client.get(f'/api/v1/consultations/{consultation_id}/transcript?format=jsonl&attachments=inline', headers=auth_header(expert_token))
+    ok("Transcript with inline attachments", r, 200,
+       lambda _: 'data:text/plain;base64,bWFpemUgcmVwb3J0' in r.get_data(as_text=True))
+    r = client.get(f'/api/v1/consultations/{consultation_id}/transcript?format=csv', headers=auth_header(farmer_token))
+    ok("Transcript csv", r, 200, lambda _: r.get_data(as_text=True).startswith('id,timestamp,sender_id'))
+    r = client.get(f'/api/v1/consultations/{consultation_id}/transcript?format=txt', headers=auth_header(farmer_token))
+    ok("Transcript txt", r, 200, lambda _: f'[attachment: report.txt /api/v1/messages/{inline_id}/attachment]' in r.get_data(as_text=True))
+    r = client.get(f'/api/v1/consultations/{consultation_id}/transcript?format=pdf', headers=auth_header(farmer_token))
+    ok("Transcript unknown format rejected", r, 400)
+    if inline_id:
+        r = client.get(f'/api/v1/messages/{inline_id}/attachment', headers=auth_header(expert_token))
+        ok("Download inline attachment", r, 200, lambda _: r.data == b'maize report' and r.mimetype == 'text/plain')
+
+    def send_file_message(file_url, file_name='file.bin'):
+        r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token),
+                        json={'message': 'file', 'message_type': 'file', 'file_name': file_name, 'file_url': file_url})
+        return r.get_json()['message']['id']
+
+    html_id = send_file_message('data:text/html;base64,PHNjcmlwdD5hbGVydCgxKTwvc2NyaXB0Pg==', 'page\r\nX-Evil: 1.html')
+    r = client.get(f'/api/v1/messages/{html_id}/attachment', headers=auth_header(expert_token))
+    ok("HTML attachment downloads as octet-stream", r, 200,
+       lambda _: r.mimetype == 'application/octet-stream' and r.headers['X-Content-Type-Options'] == 'nosniff'
+       and r.headers['Content-Disposition'].startswith('attachment;') and 'X-Evil' not in r.headers)
+    r = client.get(f"/api/v1/messages/{send_file_message('https://evil.example/phish')}/attachment",
+                   headers=auth_header(expert_token))
+    ok("Attachment redirect to another host refused", r, 404)
+    r = client.get(f"/api/v1/messages/{send_file_message('//evil.example/phish')}/attachment",
+                   headers=auth_header(expert_token))
+    ok("Protocol-relative attachment redirect refused", r, 404)
+    r = client.get(f"/api/v1/messages/{send_file_message('/uploads/cattle_photo.jpg')}/attachment",
+                   headers=auth_header(expert_token))
+    ok("Attachment redirect on this site", r, 302, lambda _: r.headers['Location'].endswith('/uploads/cattle_photo.jpg'))
+
+# 6l. A chat gate invalidated while it was being read from the database isn't cached
+if consultation_id:
+    import chat_gate
+    real_load_gate = chat_gate.load_gate
+
+    def load_then_invalidate(cid):
+        gate = real_load_gate(cid)
+        chat_gate._on_invalidate(None, {'consultation_id': cid})  # e.g. the consultation just closed
+        return gate
+
+    chat_gate._on_invalidate(None, {'consultation_id': consultation_id})
+    chat_gate.load_gate = load_then_invalidate
+    try:
+        with app.app_context():
+            chat_gate.get_gate(consultation_id)
+    finally:
+        chat_gate.load_gate = real_load_gate
+
+    def gate_not_cached(d):
+        assert consultation_id not in chat_gate._gates, 'stale gate cached'
+
+    ok("Gate invalidated during its load isn't cached", FakeResponse(), 200, gate_not_cached)
 
 
 # ═══════════════════════════════════════════════════════
@@ -480,6 +753,30 @@ d = ok("Get expert notifications", r, 200, lambda d: isinstance(d['notifications
 r = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
 ok("Get unread notification count", r, 200, lambda d: 'count' in d)
 
+# 7c-2. Keyset pagination and the unread counter
+r = client.get('/api/v1/notifications?per_page=1', headers=auth_header(expert_token))
+d = ok("Notifications first page", r, 200, lambda d: len(d['notifications']) == 1 and d['has_more'] and d['next_before'])
+if d and d['next_before']:
+    first = d['notifications'][0]
+    r = client.get(f"/api/v1/notifications?per_page=1&before={d['next_before']}", headers=auth_header(expert_token))
+    ok("Notifications next page", r, 200, lambda d: len(d['notifications']) == 1
+       and (d['notifications'][0]['created_at'], d['notifications'][0]['id']) < (first['created_at'], first['id']))
+r = client.get('/api/v1/notifications?before=garbage', headers=auth_header(expert_token))
+ok("Notifications bad cursor rejected", r, 400)
+with app.app_context():
+    expert_user = User.query.filter_by(username='testexpert_api').first()
+    actual_unread = Notification.query.filter_by(user_id=expert_user.id, read=False).count()
+r = client.get('/api/v1/notifications/unread-count', headers=auth_header(expert_token))
+ok("Unread counter matches COUNT", r, 200, lambda d: d['unread_count'] == actual_unread)
+
+# 7c-3. Message notifications roll up per consultation
+def rolled_up(d):
+    rolled = [n for n in d['notifications'] if n['ref_id'] == consultation_id]
+    return len(rolled) == 1 and rolled[0]['count'] >= 2 \
+        and rolled[0]['title'] == f"{rolled[0]['count']} new messages from Test Farmer"
+r = client.get('/api/v1/notifications?type=message', headers=auth_header(expert_token))
+ok("Farmer's messages coalesce into one notification", r, 200, rolled_up)
+
 # 7d. Mark one notification as read
 if farmer_notif_count > 0:
     notif_id = d['notifications'][0]['id'] if d and d['notifications'] else None
@@ -494,6 +791,8 @@ if farmer_notif_count > 0:
 # 7e. Mark all read
 r = client.put('/api/v1/notifications/mark-all-read', headers=auth_header(farmer_token))
 ok("Mark all notifications read", r, 200)
+r = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
+ok("Unread counter zero after mark-all-read", r, 200, lambda d: d['unread_count'] == 0)
 
 # 7f. Delete notification
 fr = client.get('/api/v1/notifications', headers=auth_header(farmer_token))
@@ -506,6 +805,30 @@ else:
     print("  - Skip delete notification (none to delete)")
 
 
+# 7g. Preferences: opted-out types aren't written
+r = client.put('/api/v1/notifications/preferences', headers=auth_header(expert_token), json={'message': False})
+ok("Turn off message notifications", r, 200, lambda d: d['preferences']['message'] is False and d['preferences']['payment'])
+r = client.put('/api/v1/notifications/preferences', headers=auth_header(expert_token), json={'sms': False})
+ok("Unknown preference rejected", r, 400)
+with app.app_context():
+    rows_before = Notification.query.filter_by(user_id=expert_id, type='message').count()
+    count_before = sum(n.count for n in Notification.query.filter_by(user_id=expert_id, type='message'))
+if consultation_id:
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token),
+                    json={'message': 'Are the new vaccines in stock?'})
+    ok("Message still delivered when its notification is off", r, 201)
+with app.app_context():
+    rows_after = Notification.query.filter_by(user_id=expert_id, type='message').count()
+    count_after = sum(n.count for n in Notification.query.filter_by(user_id=expert_id, type='message'))
+ok("Opted-out notification not written", FakeResponse(), 200, lambda d: (rows_after, count_after) == (rows_before, count_before))
+r = client.put('/api/v1/notifications/preferences', headers=auth_header(expert_token), json={'message': True})
+ok("Turn message notifications back on", r, 200, lambda d: d['preferences']['message'] is True)
+r = client.get('/api/v1/notifications/preferences', headers=auth_header(expert_token))
+ok("Get notification preferences", r, 200, lambda d: all(d['preferences'].values()))
+r = client.get('/api/v1/notifications/dropped', headers=auth_header(farmer_token))
+ok("Dropped counts are admin-only", r, 403)
+
+
 # ═══════════════════════════════════════════════════════
 print("\n═══ 8. UNREAD MESSAGE COUNTS ═══")
 # ═══════════════════════════════════════════════════════
@@ -518,6 +841,15 @@ ok("Get farmer unread counts", r, 200, lambda d: 'total_unread' in d)
 r = client.get('/api/v1/unread-counts', headers=auth_header(expert_token))
 ok("Get expert unread counts", r, 200, lambda d: 'total_unread' in d)
 
+# 8c. Reading the conversation advances the watermark and clears the badge
+if consultation_id:
+    client.get(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(expert_token))
+    r = client.get('/api/v1/unread-counts', headers=auth_header(expert_token))
+    ok("Unread cleared after reading", r, 200, lambda d: str(consultation_id) not in d['by_consultation'])
+    r = client.get(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token))
+    ok("Own messages show as read by recipient", r, 200,
+       lambda d: all(m['read'] for m in d['messages'] if m['sender_role'] == 'Client'))
+
 
 # ═══════════════════════════════════════════════════════
 print("\n═══ 9. PRESENCE & HEARTBEAT ═══")
@@ -532,6 +864,55 @@ if farmer_id:
     r = client.get(f'/api/v1/presence/status/{farmer_id}', headers=auth_header(farmer_token))
     ok("Check presence status", r, 200, lambda d: 'online' in d)
 
+# 9c. Heartbeats are written behind, in one batch
+from presence_store import get_store
+with app.app_context():
+    stored_before = db.session.get(User, expert_id).last_seen
+r = client.post('/api/v1/presence/heartbeat', headers=auth_header(expert_token))
+r = client.get(f'/api/v1/presence/status/{expert_id}', headers=auth_header(farmer_token))
+ok("Status served from the hot table", r, 200, lambda d: d['online'] is True)
+flushed = get_store().flush()
+with app.app_context():
+    stored_after = db.session.get(User, expert_id).last_seen
+ok("Flush writes last_seen", FakeResponse(), 200, lambda d: flushed >= 1 and stored_after
+   and (stored_before is None or stored_after > stored_before))
+
+
+# 9d. Batch presence and typing for a chat list
+r = client.post('/api/v1/presence/status:batch', headers=auth_header(farmer_token),
+                json={'user_ids': [expert_id, farmer_id, 999999]})
+ok("Batch presence status", r, 200, lambda d: d['statuses'][str(expert_id)]['online'] is True
+   and str(farmer_id) in d['statuses'])
+ok("Batch presence leaves out users the caller shares no consultation with", r, 200,
+   lambda d: '999999' not in d['statuses'])
+r = client.post('/api/v1/presence/status:batch', headers=auth_header(farmer_token), json={'user_ids': 'x'})
+ok("Batch presence rejects bad ids", r, 400)
+r = client.post('/api/v1/presence/typing', headers=auth_header(farmer_token), json={'consultation_id': 'abc'})
+ok("Typing rejects a bad consultation id", r, 400)
+if consultation_id:
+    client.post('/api/v1/presence/typing', headers=auth_header(expert_token), json={'consultation_id': consultation_id})
+    r = client.get(f'/api/v1/presence/typing?consultation_ids={consultation_id},999999', headers=auth_header(farmer_token))
+    ok("Batch typing status", r, 200, lambda d: d['typing'] == {str(consultation_id): [expert_id]})
+    r = client.get(f'/api/v1/presence/typing?consultation_ids={consultation_id}', headers=auth_header(expert_token))
+    ok("Batch typing leaves out the caller", r, 200, lambda d: d['typing'][str(consultation_id)] == [])
+    # A consultation the expert takes no part in
+    with app.app_context():
+        other = Consultation(client_id=farmer_id, topic='Not for the expert')
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+    r = client.post('/api/v1/presence/typing', headers=auth_header(expert_token), json={'consultation_id': other_id})
+    ok("Typing in someone else's consultation is refused", r, 403)
+    client.post('/api/v1/presence/typing', headers=auth_header(farmer_token), json={'consultation_id': other_id})
+    r = client.get(f'/api/v1/presence/typing?consultation_ids={other_id}', headers=auth_header(expert_token))
+    ok("Batch typing leaves out other people's consultations", r, 200, lambda d: d['typing'] == {})
+    with app.app_context():
+        Consultation.query.filter_by(id=other_id).delete()
+        db.session.commit()
+    chat_gate.invalidate(other_id)
+r = client.get('/api/v1/presence/typing?consultation_ids=1,abc', headers=auth_header(farmer_token))
+ok("Batch typing rejects bad ids", r, 400)
+
 
 # ═══════════════════════════════════════════════════════
 print("\n═══ 10. DASHBOARD DATA ═══")
@@ -556,6 +937,11 @@ if consultation_id:
         'status': 'completed'
     })
     ok("Expert completes consultation", r, 200, lambda d: d['consultation']['status'] == 'completed')
+    # The cached chat gate must be invalidated by the status change
+    r = client.post(f'/api/v1/consultations/{consultation_id}/messages', headers=auth_header(farmer_token), json={
+        'message': 'One more question about the maize'
+    })
+    ok("Messaging closed after completion", r, 403)
 
 # My-clients should now show the farmer
 r = client.get('/api/v1/my-clients', headers=auth_header(expert_token))
@@ -599,23 +985,484 @@ r = client.get('/')
 ok("Root endpoint", r, 200)
 
 
+# ═══════════════════════════════════════════════════════
+print("\n═══ 13. REAL-TIME EVENTS (SSE) ═══")
+# ═══════════════════════════════════════════════════════
+from events import hub
+
+app.config['EVENTS_STREAM_SECONDS'] = 0.3
+app.config['EVENTS_KEEPALIVE_SECONDS'] = 0.1
+
+def read_events(response):
+    """Parse a finished text/event-stream body into a list of dicts."""
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line and not line.startswith(':'))
+        if 'event' in fields:
+            fields['data'] = json.loads(fields.get('data', 'null'))
+            events.append(fields)
+    return events
+
+# 13a. Stream requires auth
+r = client.get('/api/v1/events')
+ok("Event stream without token rejected", r, 401)
+
+# 13b. Replay everything buffered for the farmer (token via query string, as EventSource sends it)
+r = client.get(f'/api/v1/events?token={farmer_token}', headers={'Last-Event-ID': f'{hub.epoch}:0'})
+farmer_events = read_events(r)
+ok("Event stream replays notifications", r, 200, lambda d: any(e['event'] == 'notification' for e in farmer_events))
+ok("Event stream replays messages", r, 200, lambda d: any(e['event'] == 'message' for e in farmer_events))
+
+# 13c. Resuming from the newest id replays nothing
+if farmer_events:
+    r = client.get('/api/v1/events', headers={**auth_header(farmer_token), 'Last-Event-ID': farmer_events[-1]['id']})
+    ok("Resume from Last-Event-ID", r, 200, lambda d: read_events(r) == [])
+
+# 13d. An id from another server process asks the client to resync
+r = client.get('/api/v1/events', headers={**auth_header(farmer_token), 'Last-Event-ID': 'stale:42'})
+ok("Unknown Last-Event-ID triggers resync", r, 200, lambda d: read_events(r)[0]['event'] == 'resync')
+
+# 13e. Typing is pushed to the other participant
+if consultation_id:
+    since = hub.format_id(hub.last_seq)
+    client.post('/api/v1/presence/typing', headers=auth_header(farmer_token), json={'consultation_id': consultation_id})
+    r = client.get('/api/v1/events', headers={**auth_header(expert_token), 'Last-Event-ID': since})
+    ok("Typing event delivered", r, 200,
+       lambda d: any(e['event'] == 'typing' and e['data']['user_id'] == farmer_id for e in read_events(r)))
+
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 14. EVENT BUS BACKENDS ═══")
+# ═══════════════════════════════════════════════════════
+import tempfile
+import event_bus
+from redis_standin import RedisStandIn
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+def check_bus_pair(label, url):
+    """Two bus instances on one backend stand in for two gunicorn workers."""
+    received = []
+    worker_a = event_bus.create_bus(url, lambda channel, event_id, payload: None)
+    worker_b = event_bus.create_bus(url, lambda channel, event_id, payload: received.append((channel, event_id, payload)))
+    worker_a.publish('typing', {'n': 1})
+    worker_a.publish('typing', {'n': 2})
+    delivered = wait_for(lambda: len(received) >= 2)
+    ok(f"{label}: event crosses workers", FakeResponse(), 200, lambda d: delivered and received[0][2] == {'n': 1})
+    ok(f"{label}: ids increase", FakeResponse(), 200, lambda d: received[0][1] < received[1][1])
+    ok(f"{label}: epoch shared", FakeResponse(), 200, lambda d: worker_a.epoch == worker_b.epoch)
+    worker_a.close()
+    worker_b.close()
+
+bus_dir = tempfile.mkdtemp()
+check_bus_pair("SQLite bus", f'sqlite:///{os.path.join(bus_dir, "bus.sqlite")}')
+standin = RedisStandIn().start()
+check_bus_pair("Redis bus", f'redis://127.0.0.1:{standin.port}/0')
+
+received = []
+worker_a = event_bus.create_bus(f'redis://127.0.0.1:{standin.port}/0', lambda channel, event_id, payload: None)
+worker_b = event_bus.create_bus(f'redis://127.0.0.1:{standin.port}/0',
+                                lambda channel, event_id, payload: received.append((channel, event_id, payload)))
+standin.drop_subscribers()
+worker_a.publish('typing', {'n': 3})  # lost: worker_b isn't subscribed right now
+resynced = wait_for(lambda: any(channel == event_bus.RESYNC for channel, _, _ in received))
+ok("Redis bus: resync after events missed while disconnected", FakeResponse(), 200, lambda d: resynced)
+unreachable = event_bus.create_bus(f'redis://127.0.0.1:{standin.port}/0')
+worker_a.close()
+worker_b.close()
+standin.stop()
+saved_bus, event_bus._bus = event_bus._bus, unreachable
+try:
+    event_bus.publish('typing', {'n': 4})  # the server is gone
+    published = True
+except Exception:
+    published = False
+finally:
+    event_bus._bus = saved_bus
+    unreachable.close()
+ok("Publish to an unreachable bus doesn't raise", FakeResponse(), 200, lambda d: published)
+
+from events import hub
+since = hub.last_seq
+hub.resync(since)
+hub_events, hub_complete = hub.wait(farmer_id, since - 1, 0)
+ok("Bus resync tells streams to refetch", FakeResponse(), 200, lambda d: not hub_complete)
+
+
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 15. WRITE-BEHIND NOTIFICATIONS ═══")
+# ═══════════════════════════════════════════════════════
+import notification_dispatcher
+from routes.notifications import create_notification
+
+queue_path = os.path.join(tempfile.mkdtemp(), 'notification_queue.sqlite')
+with app.app_context():
+    farmer_user = User.query.filter_by(username='testfarmer_api').first()
+    before_count = Notification.query.filter_by(user_id=farmer_user.id).count()
+    # Queued by a process that died before its dispatcher ran
+    notification_dispatcher.NotificationQueue(queue_path).put({
+        'user_id': farmer_user.id, 'type': 'system', 'title': 'Left in the queue', 'description': '',
+        'icon': 'ri-notification-3-line', 'color': 'bg-teal-500', 'link': None, 'ref_id': None,
+        'read': False, 'created_at': '2024-01-01T00:00:00',
+    })
+
+app.config.update(NOTIFICATION_DISPATCH='async', NOTIFICATION_QUEUE_PATH=queue_path)
+dispatcher = notification_dispatcher.configure(app)
+with app.app_context():
+    queued = [create_notification(farmer_user.id, 'system', f'Queued {i}') for i in range(2)]
+flushed = dispatcher.flush()
+with app.app_context():
+    titles = {n.title for n in Notification.query.filter_by(user_id=farmer_user.id).all()}
+    after_count = len(Notification.query.filter_by(user_id=farmer_user.id).all())
+    actual_unread = Notification.query.filter_by(user_id=farmer_user.id, read=False).count()
+ok("Async create_notification returns immediately", FakeResponse(), 200, lambda d: queued == [None, None])
+ok("Dispatcher drains queue into notifications", FakeResponse(), 200,
+   lambda d: flushed and after_count == before_count + 3 and {'Queued 0', 'Queued 1', 'Left in the queue'} <= titles)
+r = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
+ok("Dispatcher keeps unread counter in step", r, 200, lambda d: d['unread_count'] == actual_unread)
+with app.app_context():
+    for i in range(3):
+        create_notification(farmer_user.id, 'message', 'New message from Bot', ref_id=-1,
+                            group_title='{count} new messages from Bot')
+flushed = dispatcher.flush()
+with app.app_context():
+    batched = Notification.query.filter_by(user_id=farmer_user.id, type='message', ref_id=-1).all()
+ok("Dispatcher coalesces queued events", FakeResponse(), 200, lambda d: flushed and len(batched) == 1
+   and batched[0].count == 3 and batched[0].title == '3 new messages from Bot')
+
+# A bad intent is dead-lettered; the ones behind it are still delivered
+dispatcher.max_attempts = 1
+dispatcher.queue.put({'user_id': farmer_user.id, 'type': 'system', 'title': 'Poison', 'created_at': 'not a date'})
+with app.app_context():
+    create_notification(farmer_user.id, 'system', 'Behind the poison')
+flushed = dispatcher.flush()
+dead = dispatcher.queue.dead_letters()
+with app.app_context():
+    behind = Notification.query.filter_by(user_id=farmer_user.id, title='Behind the poison').count()
+ok("Failing intent is dead-lettered", FakeResponse(), 200,
+   lambda d: len(dead) == 1 and dead[0][1]['title'] == 'Poison' and 'isoformat' in dead[0][3])
+ok("Intents behind a failing one are delivered", FakeResponse(), 200, lambda d: flushed and behind == 1)
+app.config['NOTIFICATION_DISPATCH'] = 'sync'
+notification_dispatcher.configure(app)
+
+# Per-type window override: 0 turns coalescing off
+app.config['NOTIFICATION_COALESCE_WINDOWS'] = {'message': 0}
+with app.app_context():
+    for i in range(2):
+        create_notification(farmer_user.id, 'message', 'New message from Bot', ref_id=-2)
+    separate = Notification.query.filter_by(user_id=farmer_user.id, type='message', ref_id=-2).count()
+app.config.pop('NOTIFICATION_COALESCE_WINDOWS')
+ok("Coalesce window override respected", FakeResponse(), 200, lambda d: separate == 2)
+
+# Coalescing into the notification this worker last published is one UPDATE by id
+from sqlalchemy import event as sa_event
+def record_statement(conn, cursor, statement, *args):
+    if 'notifications' in statement:
+        coalesce_statements.append(statement.split()[0])
+with app.app_context():
+    create_notification(farmer_user.id, 'message', 'New message from Bot', ref_id=-3,
+                        group_title='{count} new messages from Bot')
+    coalesce_statements = []
+    sa_event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        rolled = create_notification(farmer_user.id, 'message', 'New message from Bot', ref_id=-3,
+                                     group_title='{count} new messages from Bot')
+    finally:
+        sa_event.remove(db.engine, 'before_cursor_execute', record_statement)
+    stored = Notification.query.filter_by(user_id=farmer_user.id, type='message', ref_id=-3).all()
+def coalesced_by_id(d):
+    assert coalesce_statements == ['UPDATE'], coalesce_statements
+    assert len(stored) == 1 and stored[0].id == rolled.id and stored[0].count == rolled.count == 2
+    assert stored[0].title == rolled.title == '2 new messages from Bot'
+ok("Coalescing is one UPDATE without re-reading notifications", FakeResponse(), 200, coalesced_by_id)
+client.put(f'/api/v1/notifications/{stored[0].id}/read', headers=auth_header(farmer_token))
+with app.app_context():
+    rolled = create_notification(farmer_user.id, 'message', 'New message from Bot', ref_id=-3,
+                                 group_title='{count} new messages from Bot')
+    restarted = db.session.get(Notification, stored[0].id)
+ok("Coalescing into a notification read meanwhile restarts it", FakeResponse(), 200,
+   lambda d: rolled.id == restarted.id and restarted.count == 1 and not restarted.read)
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 16. ADMIN BROADCASTS ═══")
+# ═══════════════════════════════════════════════════════
+from auth_utils import generate_token
+
+with app.app_context():
+    admin = User(username='testadmin_api', password=generate_password_hash('Test1234'), role=ADMIN_ROLE)
+    db.session.add(admin)
+    db.session.commit()
+    admin_token = generate_token(admin.id)
+segment = {'location': 'bulawayo', 'crops': ['wheat', 'barley']}
+
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(expert_token), json={'title': 'Hi'})
+ok("Broadcast requires admin", r, 403)
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(admin_token),
+                json={'title': 'Outbreak', 'segment': {'region': 'x'}})
+ok("Broadcast rejects unknown segment keys", r, 400)
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(admin_token),
+                json={'title': 'Outbreak', 'segment': segment, 'dry_run': True})
+d = ok("Broadcast dry run counts recipients", r, 200, lambda d: d['recipients'] >= 1)
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(admin_token),
+                json={'title': 'Outbreak', 'description': ['not', 'text']})
+ok("Broadcast rejects a description that isn't a string", r, 400)
+
+seq_before_broadcast = hub.last_seq
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(admin_token), json={
+    'title': 'Fall armyworm outbreak', 'description': 'Scout your maize fields this week.', 'segment': segment,
+})
+d = ok("Broadcast queued", r, 202, lambda d: d['broadcast']['status'] in ('queued', 'running', 'done'))
+broadcast_id = d['broadcast']['id'] if d else None
+
+def broadcast_status():
+    return client.get(f'/api/v1/admin/broadcasts/{broadcast_id}', headers=auth_header(admin_token)).get_json()['broadcast']
+finished = wait_for(lambda: broadcast_status()['status'] == 'done', timeout=10)
+ok("Broadcast completes with progress", FakeResponse(), 200, lambda d: finished
+   and broadcast_status()['sent'] == broadcast_status()['total'] >= 1 and broadcast_status()['progress'] == 1.0)
+with app.app_context():
+    got_it = Notification.query.filter_by(user_id=farmer_id, type='alert', ref_id=broadcast_id).count()
+    expert_got_it = Notification.query.filter_by(user_id=expert_id, ref_id=broadcast_id, type='alert').count()
+    farmer_row = Notification.query.filter_by(user_id=farmer_id, type='alert', ref_id=broadcast_id).first()
+    actual_unread = Notification.query.filter_by(user_id=farmer_id, read=False).count()
+pushed = [e.data for e in hub.events_since(farmer_id, seq_before_broadcast)[0]
+          if e.type == 'notification' and e.data.get('broadcast_id') == broadcast_id]
+ok("Broadcast event carries the recipient's notification id", FakeResponse(), 200,
+   lambda d: farmer_row and [(p['id'], p['user_id']) for p in pushed] == [(farmer_row.id, farmer_id)])
+ok("Broadcast reaches only the segment", FakeResponse(), 200, lambda d: got_it == 1 and expert_got_it == 0)
+r = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
+ok("Broadcast keeps unread counter in step", r, 200, lambda d: d['unread_count'] == actual_unread)
+
+# A 'system' broadcast respects notification preferences; 'alert' (above) doesn't
+client.put('/api/v1/notifications/preferences', headers=auth_header(farmer_token), json={'system': False})
+r = client.post('/api/v1/admin/broadcasts', headers=auth_header(admin_token), json={
+    'title': 'Maintenance tonight', 'type': 'system', 'segment': segment,
+})
+system_id = r.get_json()['broadcast']['id']
+system_done = wait_for(lambda: client.get(f'/api/v1/admin/broadcasts/{system_id}', headers=auth_header(admin_token)
+                                          ).get_json()['broadcast']['status'] == 'done', timeout=10)
+system_broadcast = client.get(f'/api/v1/admin/broadcasts/{system_id}', headers=auth_header(admin_token)
+                              ).get_json()['broadcast']
+client.put('/api/v1/notifications/preferences', headers=auth_header(farmer_token), json={'system': True})
+with app.app_context():
+    farmer_got_system = Notification.query.filter_by(user_id=farmer_id, ref_id=system_id, type='system').count()
+ok("System broadcast skips users who turned system off", FakeResponse(), 200,
+   lambda d: system_done and farmer_got_system == 0 and system_broadcast['skipped'] >= 1
+   and system_broadcast['progress'] == 1.0)
+r = client.get('/api/v1/notifications/dropped', headers=auth_header(admin_token))
+ok("Admin sees dropped notification counts", r, 200, lambda d: d['dropped'].get('message', 0) >= 1)
+r = client.get('/api/v1/auth/hash-stats', headers=auth_header(admin_token))
+ok("Admin sees password hashing stats", r, 200, lambda d: d['completed'] >= 1 and d['rejected'] == 0)
+r = client.get('/api/v1/auth/hash-stats', headers=auth_header(farmer_token))
+ok("Hashing stats require admin", r, 403)
+r = client.get('/api/v1/auth/token-cache-stats', headers=auth_header(admin_token))
+ok("Verified tokens served from cache", r, 200, lambda d: d['hits'] > d['misses'] >= 1 and d['rejected'] >= 1
+   and d['revocation_filter']['entries'] >= 3 and d['revocation_filter']['checks'] > d['revocation_filter']['filter_hits'])
+r = client.get('/api/v1/admin/broadcasts', headers=auth_header(admin_token))
+ok("List broadcasts", r, 200, lambda d: d['broadcasts'][0]['id'] == system_id)
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 17. RETENTION ═══")
+# ═══════════════════════════════════════════════════════
+import gzip
+import retention
+from datetime import datetime, timedelta
+
+app.config['RETENTION_ARCHIVE_DIR'] = tempfile.mkdtemp()
+long_ago = datetime.utcnow() - timedelta(days=400)
+with app.app_context():
+    old_read = Notification(user_id=farmer_id, type='message', title='Old read', read=True, created_at=long_ago)
+    old_unread = Notification(user_id=farmer_id, type='message', title='Old unread', read=False, created_at=long_ago)
+    recent_read = Notification(user_id=farmer_id, type='message', title='Recent read', read=True)
+    old_deleted = Message(consultation_id=consultation_id or 0, sender_id=farmer_id, message='', deleted=True, timestamp=long_ago)
+    old_kept = Message(consultation_id=consultation_id or 0, sender_id=farmer_id, message='Still here', timestamp=long_ago)
+    # The newest message of its consultation: deleting it would free its id for reuse
+    old_deleted_newest = Message(consultation_id=-5, sender_id=farmer_id, message='', deleted=True, timestamp=long_ago)
+    db.session.add_all([old_read, old_unread, recent_read, old_deleted, old_kept, old_deleted_newest])
+    db.session.commit()
+    ids = (old_read.id, old_unread.id, recent_read.id, old_deleted.id, old_kept.id, old_deleted_newest.id)
+    unread_before = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token)).get_json()['unread_count']
+    preview = retention.run(dry_run=True)
+    report = retention.run()
+    left = [db.session.get(model, i) is not None for model, i in
+            zip((Notification, Notification, Notification, Message, Message, Message), ids)]
+    archived = {}
+    for name in os.listdir(app.config['RETENTION_ARCHIVE_DIR']):
+        with gzip.open(os.path.join(app.config['RETENTION_ARCHIVE_DIR'], name), 'rt') as f:
+            archived[name.split('-')[0]] = {json.loads(line)['id'] for line in f}
+ok("Retention dry run matches the real run", FakeResponse(), 200, lambda d: preview['notifications'] == report['notifications'] >= 1
+   and preview['messages'] == report['messages'] >= 1)
+ok("Retention removes only expired rows", FakeResponse(), 200, lambda d: left == [False, True, True, False, True, True])
+ok("Retention archives what it removes", FakeResponse(), 200, lambda d: ids[0] in archived.get('notifications', ())
+   and ids[3] in archived.get('messages', ()))
+r = client.get('/api/v1/notifications/unread-count', headers=auth_header(farmer_token))
+ok("Retention leaves unread counter alone", r, 200, lambda d: d['unread_count'] == unread_before)
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 18. TYPING STORE ═══")
+# ═══════════════════════════════════════════════════════
+from typing_store import TypingStore
+
+# A million typing events from 350k (consultation, user) pairs, one per ms:
+# only the pairs active in the last few seconds may stay in memory
+store = TypingStore()
+clock = 1_700_000_000.0
+sizes = []
+for i in range(1_000_000):
+    clock += 0.001
+    store.touch(i % 50_000, i % 7, clock)
+    if i % 100_000 == 99_999:
+        sizes.append((len(store), store.scheduled, len(store._by_consultation)))
+live_window = int((store.timeout + store.tick) / 0.001)
+ok("Typing store memory stays flat over 1M events", FakeResponse(), 200,
+   lambda d: all(max(size) <= live_window for size in sizes) and max(sizes)[0] - min(sizes)[0] < live_window // 10)
+ok("Typing entries expire", FakeResponse(), 200, lambda d: store.is_typing(49_999, 999_999 % 7, clock)
+   and not store.is_typing(0, 0, clock) and store.typing_users(0, clock + 60) == [] and len(store) == 0)
+
+budget = TypingStore(max_entries=1000)
+for i in range(10_000):
+    budget.touch(i, 1, clock)
+ok("Typing store keeps to its entry budget", FakeResponse(), 200,
+   lambda d: len(budget) == 1000 and budget.is_typing(9_999, 1, clock) and budget.scheduled <= 1000)
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 19. BULK USER IMPORT ═══")
+# ═══════════════════════════════════════════════════════
+import_csv = """username,password,full_name,phone,email,location,role
+testimport_1,Coop1234,Tariro Moyo,+263 77 111 2222,tariro@example.com,Gokwe,
+testimport_2,Coop1234,Farai Ncube,,,Gokwe,Client
+testimport_3,Coop1234,Bad Email,,not-an-email,Gokwe,
+testimport_1,Coop1234,Duplicate In File,,,Gokwe,
+testfarmer_api,Coop1234,Already Registered,,,Gokwe,
+testimport_4,Coop1234,Would Be Admin,,,Gokwe,Admin
+testimport_5,123,Short Password,,,Gokwe,
+"""
+import_url = '/api/v1/admin/users/import'
+r = client.post(import_url, headers=auth_header(farmer_token), data=import_csv, content_type='text/csv')
+ok("User import requires admin", r, 403)
+
+def finished_import(r):
+    """Poll the import job queued by r until it is done; the response with its report."""
+    job_id = r.get_json()['job']['id']
+    def job():
+        return client.get(f'{import_url}/{job_id}', headers=auth_header(admin_token)).get_json()['job']
+    wait_for(lambda: job()['status'] in ('done', 'failed'), timeout=10)
+    return ImportReport(job()['report'])
+
+class ImportReport(FakeResponse):
+    def __init__(self, report):
+        self.report = report
+    def get_json(self, silent=False):
+        return self.report
+
+r = client.post(import_url + '?dry_run=1', headers=auth_header(admin_token), data=import_csv,
+                content_type='text/csv')
+ok("Import queued as a job", r, 202, lambda d: d['job']['status'] in ('queued', 'running', 'done')
+   and d['job']['dry_run'])
+ok("Import dry run checks without writing", finished_import(r), 200,
+   lambda d: d['created'] == 2 and d['rejected'] == 5)
+with app.app_context():
+    dry_created = User.query.filter(User.username.in_([f'testimport_{i}' for i in range(1, 6)])).count()
+ok("Import dry run creates nobody", FakeResponse(), 200, lambda d: dry_created == 0)
+
+r = client.post(import_url, headers=auth_header(admin_token), data=import_csv, content_type='text/csv')
+d = ok("Import CSV", finished_import(r), 200, lambda d: d['records'] == 7 and d['created'] == 2 and d['rejected'] == 5)
+rejects = {x['line']: x['error'] for x in (d or {}).get('rejects', [])}
+ok("Import reports rejects per line", FakeResponse(), 200, lambda d: rejects == {
+    4: 'Invalid email format', 5: 'duplicate username in file', 6: 'username already exists',
+    7: 'role must be one of Client, Expert', 8: 'Password must be at least 6 characters long'})
+r = client.post('/api/v1/auth/login', json={'username': 'testimport_1', 'password': 'Coop1234'})
+ok("Imported user can log in", r, 200, lambda d: d['user']['role'] == 'Client' and d['user']['location'] == 'Gokwe')
+r = client.get(import_url + '/999999', headers=auth_header(admin_token))
+ok("Unknown import job is 404", r, 404)
+
+import_jsonl = '{"username": "testimport_6", "password": "Coop1234", "role": "Expert", "phone": 263771234567}\n' \
+               '{"username": "testimport_7", "password": "Coop1234"\n' \
+               '\n' \
+               '["testimport_8"]\n'
+r = client.post(import_url, headers=auth_header(admin_token),
+                data={'file': (io.BytesIO(import_jsonl.encode()), 'coop.jsonl')}, content_type='multipart/form-data')
+ok("Import JSON Lines upload", finished_import(r), 200,
+   lambda d: d['created'] == 1 and [x['line'] for x in d['rejects']] == [2, 4])
+with app.app_context():
+    imported_expert = User.query.filter_by(username='testimport_6').first()
+ok("Imported JSON record keeps its role", FakeResponse(), 200,
+   lambda d: imported_expert.role == 'Expert' and imported_expert.phone == '263771234567')
+
+import user_import
+with app.app_context():
+    chunked = user_import.import_users(io.BytesIO(
+        ('username,password\n' + ''.join(f'testimport_c{i},Coop1234\n' for i in range(7))).encode()), chunk_size=3)
+ok("Import commits in chunks", FakeResponse(), 200, lambda d: chunked['created'] == 7 and chunked['rejected'] == 0)
+
+# Usernames registered while the chunk is inserted, twice over: each racing row is rejected, the rest go in
+checked, lookups = user_import.existing_usernames, []
+def racing_lookup(names):
+    lookups.append(names)
+    if len(lookups) == 1:
+        return set()  # testimport_c0 slips past the check
+    if len(lookups) == 2:
+        with db.engine.begin() as conn:  # and testimport_r2 registers meanwhile
+            conn.execute(User.__table__.insert(), {'username': 'testimport_r2', 'password': 'x', 'role': 'Client'})
+    return checked(names)
+user_import.existing_usernames = racing_lookup
+try:
+    with app.app_context():
+        raced = user_import.import_users(io.BytesIO(b'username,password\ntestimport_c0,Coop1234\n'
+                                                    b'testimport_r1,Coop1234\ntestimport_r2,Coop1234\n'))
+finally:
+    user_import.existing_usernames = checked
+def raced_rows_rejected(d):
+    assert raced['created'] == 1 and raced['rejects'] == [
+        {'line': 2, 'username': 'testimport_c0', 'error': 'username already exists'},
+        {'line': 4, 'username': 'testimport_r2', 'error': 'username already exists'},
+    ], raced
+ok("Import retries a failed chunk row by row", FakeResponse(), 200, raced_rows_rejected)
+
+# ═══════════════════════════════════════════════════════
+print("\n═══ 20. QUERY PLANS ═══")
+# ═══════════════════════════════════════════════════════
+query_recorder.stop()
+with app.app_context(), db.engine.connect() as conn:
+    scans = full_scans(conn, query_recorder.statements) if db.engine.dialect.name == 'sqlite' else []
+for statement, plan in scans:
+    print('    full scan: ' + ' '.join(statement.split())[:300])
+    print('        ' + ' / '.join(plan))
+def no_scans(d):
+    assert not scans, f"{len(scans)} statements scan a whole table"
+ok(f"No full table scans in {len(query_recorder.statements)} statements", FakeResponse(), 200, no_scans)
+
 # ═══════════════════════════════════════════════════════
 # Cleanup
 # ═══════════════════════════════════════════════════════
 with app.app_context():
-    for uname in ['testfarmer_api', 'testexpert_api']:
+    for uname in ['testfarmer_api', 'testexpert_api', 'testadmin_api']:
         u = User.query.filter_by(username=uname).first()
         if u:
             Notification.query.filter_by(user_id=u.id).delete()
+            Broadcast.query.filter_by(created_by=u.id).delete()
+            ImportJob.query.filter_by(created_by=u.id).delete()
+            NotificationCounter.query.filter_by(user_id=u.id).delete()
+            RefreshToken.query.filter_by(user_id=u.id).delete()
             Message.query.filter_by(sender_id=u.id).delete()
             Payment.query.filter_by(client_id=u.id).delete()
             Payment.query.filter_by(expert_id=u.id).delete()
             Availability.query.filter_by(expert_id=u.id).delete()
+            ReadReceipt.query.filter_by(user_id=u.id).delete()
             for c in Consultation.query.filter((Consultation.client_id == u.id) | (Consultation.expert_id == u.id)).all():
                 Message.query.filter_by(consultation_id=c.id).delete()
                 Payment.query.filter_by(consultation_id=c.id).delete()
                 db.session.delete(c)
             db.session.delete(u)
+    imported = User.query.filter(User.username.like('testimport_%'))
+    RefreshToken.query.filter(RefreshToken.user_id.in_(imported.with_entities(User.id))).delete(synchronize_session=False)
+    imported.delete(synchronize_session=False)
     db.session.commit()
     print("\nCleanup: removed test data")
 
@@ -0,0 +1,29 @@
+"""
+Give an existing user the Admin role (admins can't self-register).
+
+Usage: python make_admin.py <username>
+"""
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+from app import create_app
+from models import db, User, ADMIN_ROLE
+from auth_utils import invalidate_identity, revoke_tokens
+
+if len(sys.argv) != 2:
+    sys.exit(__doc__.strip())
+
+app = create_app()
+with app.app_context():
+    user = User.query.filter_by(username=sys.argv[1]).first()
+    if user:
+        user.role = ADMIN_ROLE
+        db.session.commit()
+        invalidate_identity(user.id)
+        # Access tokens carry the role they were issued with, so end the
+        # user's sessions: the new role applies from their next login. Workers
+        # on a shared event bus refuse the old tokens at once, the others when
+        # they next rebuild their revocation filter (REBUILD_SECONDS).
+        revoke_tokens(user.id)
+        print(f"'{user.username}' is now an admin; they need to log in again.")
+    else:
+        print(f"No user found with username '{sys.argv[1]}'.")
@@ -0,0 +1,112 @@
+"""
+Build the secondary indexes declared on the models in an existing database,
+without taking the app down.
+
+db.create_all() only builds indexes for tables it creates, so databases
+created before an index was declared never get it. This script builds
+whatever is missing, one index at a time:
+  - Postgres: CREATE INDEX CONCURRENTLY, which doesn't block writes. A
+    concurrent build that failed part-way leaves an INVALID index; it is
+    dropped and built again.
+  - SQLite: a plain CREATE INDEX in its own transaction. Readers carry on
+    while it builds; writers wait (busy timeout) until it commits.
+Then it drops the indexes the models no longer declare (RETIRED_INDEXES:
+superseded by wider composites, or serving queries that are gone) and
+refreshes the planner statistics.
+
+    python migrate_indexes.py [--dry-run]
+
+migrate_schema.py runs it as its last step.
+"""
+
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(__file__))
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from models import db
+
+# Indexes replaced by composites that lead with the same column, or no longer used
+RETIRED_INDEXES = {
+    'ix_consultations_expert_id': 'consultations',  # -> ix_consultations_expert_date_status
+    'ix_consultations_client_id': 'consultations',  # -> ix_consultations_client_date
+    # Unread counts by messages.read; reads are per-user watermarks (read_receipts) now
+    'ix_messages_consultation_read_sender': 'messages',
+}
+
+SQLITE_BUSY_TIMEOUT_MS = 30_000
+
+
+def existing_indexes(engine):
+    inspector = inspect(engine)
+    return {index['name'] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+def invalid_indexes(conn):
+    """Postgres indexes left INVALID by an interrupted CREATE INDEX CONCURRENTLY."""
+    rows = conn.execute(text("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                             "WHERE NOT i.indisvalid"))
+    return {name for (name,) in rows}
+
+
+def create_statement(index, dialect):
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+    if dialect.name == 'postgresql':
+        ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1).replace(
+            'CREATE UNIQUE INDEX', 'CREATE UNIQUE INDEX CONCURRENTLY', 1)
+    return ddl
+
+
+def ensure_indexes(engine, dry_run=False, log=print):
+    """Build missing declared indexes and drop retired ones. Returns (built, dropped) index names."""
+    postgres = engine.dialect.name == 'postgresql'
+    tables = set(inspect(engine).get_table_names())
+    present = existing_indexes(engine)
+    # CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+        broken = invalid_indexes(conn) if postgres else set()
+        built, dropped = [], []
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue  # create_all() builds new tables with their indexes
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name in present and index.name not in broken:
+                    continue
+                log(f'  build {index.name} on {table.name}' + (' (replacing INVALID)' if index.name in broken else ''))
+                if dry_run:
+                    continue
+                started = time.perf_counter()
+                if index.name in broken:
+                    conn.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}')
+                conn.exec_driver_sql(create_statement(index, engine.dialect))
+                log(f'    done in {time.perf_counter() - started:.2f}s')
+                built.append((table.name, index.name))
+        for name, table_name in RETIRED_INDEXES.items():
+            if name not in present:
+                continue
+            log(f'  drop {name} on {table_name} (retired)')
+            if not dry_run:
+                conn.exec_driver_sql(f"DROP INDEX {'CONCURRENTLY ' if postgres else ''}IF EXISTS {name}")
+                dropped.append(name)
+        # Let the planner see the new indexes' selectivity
+        for table_name in sorted({table_name for table_name, _ in built}):
+            conn.exec_driver_sql(f'ANALYZE {table_name}')
+    return [name for _, name in built], dropped
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    dry_run = '--dry-run' in sys.argv
+    with app.app_context():
+        built, dropped = ensure_indexes(db.engine, dry_run=dry_run)
+    if dry_run:
+        print('Dry run: nothing changed.')
+    else:
+        print(f'Built {len(built)} index(es), dropped {len(dropped)}.')
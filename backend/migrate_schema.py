@@ -8,6 +8,8 @@ sys.path.insert(0, os.path.dirname(__file__))
 
 from app import create_app
 from models import db
+import search_index
+import migrate_indexes
 
 app = create_app()
 
@@ -24,6 +26,7 @@ with app.app_context():
             'file_name': "ALTER TABLE messages ADD COLUMN file_name VARCHAR(255)",
             'file_url': "ALTER TABLE messages ADD COLUMN file_url TEXT",
             'deleted': "ALTER TABLE messages ADD COLUMN deleted BOOLEAN DEFAULT 0",
+            'client_key': "ALTER TABLE messages ADD COLUMN client_key VARCHAR(64)",
         }
 
         for col_name, sql in new_cols.items():
@@ -33,12 +36,58 @@ with app.app_context():
             else:
                 print(f"  Column already exists: messages.{col_name}")
 
+        # Coalesced notifications carry the number of events rolled into them
+        result = conn.execute(db.text("PRAGMA table_info(notifications)"))
+        if 'count' not in {row[1] for row in result.fetchall()}:
+            conn.execute(db.text("ALTER TABLE notifications ADD COLUMN count INTEGER NOT NULL DEFAULT 1"))
+            print("  Added column: notifications.count")
+
+        # Broadcast recipients left out by their notification preferences
+        result = conn.execute(db.text("PRAGMA table_info(broadcasts)"))
+        broadcast_cols = {row[1] for row in result.fetchall()}
+        if broadcast_cols and 'skipped' not in broadcast_cols:
+            conn.execute(db.text("ALTER TABLE broadcasts ADD COLUMN skipped INTEGER DEFAULT 0"))
+            print("  Added column: broadcasts.skipped")
+
         conn.commit()
 
     # Create payments table (and any other new tables)
     db.create_all()
     print("\nAll tables ensured (payments table created if missing).")
 
+    # Seed read watermarks from the legacy messages.read flags so existing
+    # conversations don't show up as unread again.
+    with db.engine.begin() as conn:
+        for participant in ('client_id', 'expert_id'):
+            result = conn.execute(db.text(f"""
+                INSERT INTO read_receipts (consultation_id, user_id, last_read_message_id, updated_at)
+                SELECT c.id, c.{participant}, MAX(m.id), CURRENT_TIMESTAMP
+                FROM consultations c JOIN messages m ON m.consultation_id = c.id
+                WHERE c.{participant} IS NOT NULL AND m.sender_id != c.{participant} AND m.read = 1
+                  AND NOT EXISTS (SELECT 1 FROM read_receipts r
+                                  WHERE r.consultation_id = c.id AND r.user_id = c.{participant})
+                GROUP BY c.id, c.{participant}
+            """))
+            print(f"  Read watermarks seeded for {participant}: {result.rowcount}")
+
+    # Seed unread notification counters for users that don't have one yet
+    with db.engine.begin() as conn:
+        result = conn.execute(db.text("""
+            INSERT INTO notification_counters (user_id, unread)
+            SELECT n.user_id, SUM(CASE WHEN n.read THEN 0 ELSE 1 END)
+            FROM notifications n
+            WHERE NOT EXISTS (SELECT 1 FROM notification_counters nc WHERE nc.user_id = n.user_id)
+            GROUP BY n.user_id
+        """))
+        print(f"  Notification counters seeded: {result.rowcount}")
+
+    # create_all() only builds indexes for brand-new tables, so add any
+    # secondary indexes declared on the models to the existing ones.
+    migrate_indexes.ensure_indexes(db.engine)
+
+    # Full-text search index for messages (filled by backfill_search_index.py)
+    print(f"  Search index mode: {search_index.ensure_schema(db.session)}")
+
     # Verify payments table
     with db.engine.connect() as conn:
         result = conn.execute(db.text("PRAGMA table_info(payments)"))
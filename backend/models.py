@@ -1,15 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import json
 
 db = SQLAlchemy()
 
+ADMIN_ROLE = 'Admin'  # operations staff; created with make_admin.py, never self-registered
+
 
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)  # Hashed password
-    role = db.Column(db.String(20), nullable=False)  # 'Client' or 'Expert'
+    role = db.Column(db.String(20), nullable=False)  # 'Client', 'Expert' or 'Admin'
     full_name = db.Column(db.String(120), nullable=True)  # User's full name
     email = db.Column(db.String(120), nullable=True)  # Email address
     phone = db.Column(db.String(20), nullable=True)  # Phone number
@@ -26,6 +29,11 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Walking a role's users in id order (broadcast segments)
+        db.Index('ix_users_role_id', 'role', 'id'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -56,6 +64,15 @@ class Consultation(db.Model):
     topic = db.Column(db.String(255), nullable=True)
     status = db.Column(db.String(50), default='pending')  # 'pending', 'accepted', 'rejected', 'completed'
 
+    __table_args__ = (
+        # An expert's / a client's consultations newest first, and an expert's
+        # booked slots on a day (expert_id, date range, status)
+        db.Index('ix_consultations_expert_date_status', 'expert_id', 'date', 'status'),
+        db.Index('ix_consultations_client_date', 'client_id', 'date'),
+        # Latest consultations on the dashboard
+        db.Index('ix_consultations_date', 'date'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -81,8 +98,15 @@ class Message(db.Model):
     file_name = db.Column(db.String(255), nullable=True)
     file_url = db.Column(db.Text, nullable=True)  # base64 data URL or path
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    read = db.Column(db.Boolean, default=False)
+    read = db.Column(db.Boolean, default=False)  # legacy flag, read state lives in read_receipts
     deleted = db.Column(db.Boolean, default=False)
+    client_key = db.Column(db.String(64), nullable=True)  # idempotency key from the client's offline queue
+
+    __table_args__ = (
+        # Keyset pagination and watermark-based unread counts by message id
+        db.Index('ix_messages_consultation_id', 'consultation_id', 'id'),
+        db.Index('uq_messages_client_key', 'consultation_id', 'sender_id', 'client_key', unique=True),
+    )
 
     def to_dict(self):
         return {
@@ -96,9 +120,26 @@ class Message(db.Model):
             'timestamp': self.timestamp.isoformat(),
             'read': self.read,
             'deleted': self.deleted,
+            'client_key': self.client_key,
         }
 
 
+class ReadReceipt(db.Model):
+    """Read watermark: the newest message a user has seen in a consultation.
+    Messages from the other participant with a higher id are unread.
+    """
+    __tablename__ = 'read_receipts'
+    id = db.Column(db.Integer, primary_key=True)
+    consultation_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    last_read_message_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('consultation_id', 'user_id', name='uq_read_receipt'),
+    )
+
+
 class Availability(db.Model):
     """Weekly availability schedule for an expert.
     Each row = one day-of-week entry for one expert.
@@ -141,6 +182,12 @@ class Payment(db.Model):
     status = db.Column(db.String(20), default='completed')  # 'completed', 'refunded'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Expert earnings and client payment history, newest first
+        db.Index('ix_payments_expert_created', 'expert_id', 'created_at'),
+        db.Index('ix_payments_client_created', 'client_id', 'created_at'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -168,33 +215,168 @@ class Notification(db.Model):
     read = db.Column(db.Boolean, default=False)
     link = db.Column(db.String(200), nullable=True)  # optional deep-link path
     ref_id = db.Column(db.Integer, nullable=True)  # consultation_id or payment_id
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)  # bumped when events are coalesced into it
+    count = db.Column(db.Integer, nullable=False, default=1)  # events rolled into this notification
+
+    __table_args__ = (
+        # Keyset pagination of the feed (all / unread) newest first
+        db.Index('ix_notifications_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_notifications_user_read_created', 'user_id', 'read', 'created_at'),
+        # Finding the rolling notification to coalesce into
+        db.Index('ix_notifications_coalesce', 'user_id', 'type', 'ref_id', 'created_at'),
+    )
+
+    def to_dict(self, now=None):
+        return serialize_notification(self, now or datetime.utcnow())
+
+
+def relative_time(created_at, now):
+    """'Just now', '5 min ago', '2 hours ago', '3 days ago'."""
+    seconds = (now - created_at).total_seconds()
+    if seconds < 60:
+        return "Just now"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} min ago"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} hour{'s' if seconds >= 7200 else ''} ago"
+    days = int(seconds // 86400)
+    return f"{days} day{'s' if days > 1 else ''} ago"
+
+
+def serialize_notification(n, now):
+    """Notification (model instance or row with the same columns) -> dict.
+    Pass the same `now` for a whole page instead of reading the clock per row.
+    """
+    return {
+        'id': n.id,
+        'user_id': n.user_id,
+        'type': n.type,
+        'title': n.title,
+        'description': n.description or '',
+        'icon': n.icon,
+        'color': n.color,
+        'read': n.read,
+        'link': n.link,
+        'ref_id': n.ref_id,
+        'count': n.count or 1,
+        'time': relative_time(n.created_at, now),
+        'created_at': n.created_at.isoformat(),
+    }
+
+
+class NotificationCounter(db.Model):
+    """Unread notification count per user, kept in step with the notifications
+    table so the badge doesn't need a COUNT. Missing rows are seeded on read.
+    """
+    __tablename__ = 'notification_counters'
+    user_id = db.Column(db.Integer, primary_key=True)
+    unread = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Broadcast(db.Model):
+    """An admin notification sent to every user in a segment, written in chunks.
+
+    last_user_id is committed together with each chunk, so an interrupted
+    broadcast resumes after the last recipient it reached.
+    """
+    __tablename__ = 'broadcasts'
+    id = db.Column(db.Integer, primary_key=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    type = db.Column(db.String(30), nullable=False, default='alert')
+    title = db.Column(db.String(200), nullable=False)
+    description = db.Column(db.Text, nullable=True)
+    icon = db.Column(db.String(50), default='ri-alarm-warning-line')
+    color = db.Column(db.String(30), default='bg-red-500')
+    link = db.Column(db.String(200), nullable=True)
+    segment = db.Column(db.Text, nullable=True)  # JSON: {"role", "location", "crops"}
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    total = db.Column(db.Integer, default=0)  # recipients matched when queued
+    sent = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)  # recipients who turned this type off
+    last_user_id = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
 
     def to_dict(self):
-        from datetime import datetime as dt
-        now = dt.utcnow()
-        diff = now - self.created_at
-        if diff.total_seconds() < 60:
-            time_str = "Just now"
-        elif diff.total_seconds() < 3600:
-            time_str = f"{int(diff.total_seconds() // 60)} min ago"
-        elif diff.total_seconds() < 86400:
-            time_str = f"{int(diff.total_seconds() // 3600)} hour{'s' if diff.total_seconds() >= 7200 else ''} ago"
-        else:
-            days = diff.days
-            time_str = f"{days} day{'s' if days > 1 else ''} ago"
-
+        end = self.finished_at or datetime.utcnow()
+        elapsed = (end - self.started_at).total_seconds() if self.started_at else 0
         return {
             'id': self.id,
-            'user_id': self.user_id,
             'type': self.type,
             'title': self.title,
             'description': self.description or '',
-            'icon': self.icon,
-            'color': self.color,
-            'read': self.read,
-            'link': self.link,
-            'ref_id': self.ref_id,
-            'time': time_str,
-            'created_at': self.created_at.isoformat(),
+            'segment': json.loads(self.segment) if self.segment else {},
+            'status': self.status,
+            'total': self.total,
+            'sent': self.sent,
+            'skipped': self.skipped or 0,
+            'progress': round(min((self.sent + (self.skipped or 0)) / self.total, 1.0), 4) if self.total else 1.0,
+            'elapsed_seconds': round(elapsed, 3),
+            'per_second': round(self.sent / elapsed) if elapsed else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class ImportJob(db.Model):
+    """A bulk user import (user_import.py) running in the background.
+
+    report holds the import report so far, committed after each chunk.
+    """
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    format = db.Column(db.String(10), nullable=False, default='csv')
+    default_role = db.Column(db.String(20), nullable=False, default='Client')
+    dry_run = db.Column(db.Boolean, default=False)
+    path = db.Column(db.String(500), nullable=False)  # the upload, spooled to disk until the job is done
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    report = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'format': self.format,
+            'role': self.default_role,
+            'dry_run': bool(self.dry_run),
+            'status': self.status,
+            'report': json.loads(self.report) if self.report else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
         }
+
+
+class RefreshToken(db.Model):
+    """One refresh token of a login session. Only the SHA-256 of the token is stored.
+
+    Refreshing rotates the token: the row is marked revoked and a new one is
+    written with the same session_id, which access tokens carry as 'sid'.
+    """
+    __tablename__ = 'refresh_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    session_id = db.Column(db.String(32), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # retention sweep
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+
+class RevokedSession(db.Model):
+    """A revoked session, kept until the last access token issued for it has expired.
+
+    Backs the in-memory Bloom filter in revocation_filter.py.
+    """
+    __tablename__ = 'revoked_sessions'
+    session_id = db.Column(db.String(32), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
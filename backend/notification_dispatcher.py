@@ -0,0 +1,290 @@
+"""
+Write-behind dispatcher for notifications.
+
+create_notification() used to INSERT and COMMIT inline, and several routes
+call it two or three times in a row, each paying for its own commit. In
+async mode it only appends the notification to a local SQLite queue (WAL,
+no fsync per append). A worker thread in each process drains the queue
+every few milliseconds. It inserts a whole batch with one executemany in
+one transaction, updates the unread counters and publishes the events.
+Events of coalescing types are merged within the batch and rolled into
+their existing notification instead.
+
+The queue file survives crashes and restarts: rows are deleted only after
+the batch is committed to the main database, so delivery is at-least-once.
+Workers sharing the file claim rows before processing them; a claim older
+than CLAIM_TIMEOUT (its worker died) is taken over.
+
+A batch that fails is retried one intent at a time, so a single bad intent
+(a payload that no longer fits the table, a constraint violation) can't
+hold up the rest of the queue. An intent that fails again is retried with
+exponential backoff. After MAX_ATTEMPTS failures it is dead-lettered: it
+stays in the queue file with its error, is logged, and is no longer
+claimed (NotificationQueue.dead_letters / requeue_dead).
+
+Modes (NOTIFICATION_DISPATCH):
+  async  queue + background worker (production)
+  sync   insert and commit inline, as before (tests, scripts)
+"""
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+log = logging.getLogger(__name__)
+
+BATCH_WINDOW = 0.005  # seconds to gather more intents after the first one arrives
+POLL_INTERVAL = 0.5  # pick up rows queued by other processes or left by a crash
+BATCH_SIZE = 500
+CLAIM_TIMEOUT = 30  # seconds before another worker may take over a claimed row
+MAX_ATTEMPTS = 10  # failed deliveries before an intent is dead-lettered
+RETRY_BACKOFF = 2  # seconds before the first retry, doubling per attempt
+MAX_RETRY_DELAY = 300
+
+_dispatcher = None
+
+
+class NotificationQueue:
+    """Durable FIFO of notification intents in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS notification_queue ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, '
+            'claimed_by TEXT, claimed_at REAL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, retry_at REAL, error TEXT, dead_at REAL)')
+        # Queue files from before retries were tracked
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(notification_queue)')}
+        for column, ddl in (('attempts', 'INTEGER NOT NULL DEFAULT 0'), ('retry_at', 'REAL'),
+                            ('error', 'TEXT'), ('dead_at', 'REAL')):
+            if column not in columns:
+                try:
+                    conn.execute(f'ALTER TABLE notification_queue ADD COLUMN {column} {ddl}')
+                except sqlite3.OperationalError:
+                    pass  # another worker added it first
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)  # autocommit
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def put(self, intent):
+        self._conn().execute('INSERT INTO notification_queue (payload) VALUES (?)', (json.dumps(intent),))
+
+    def claim(self, owner, limit=BATCH_SIZE):
+        """Claim up to limit unclaimed (or abandoned) rows that are due; returns [(id, intent)] in order."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            'UPDATE notification_queue SET claimed_by = ?, claimed_at = ? WHERE id IN ('
+            'SELECT id FROM notification_queue WHERE dead_at IS NULL AND ('
+            '(claimed_by IS NULL AND (retry_at IS NULL OR retry_at <= ?)) OR claimed_at < ?) ORDER BY id LIMIT ?)',
+            (owner, now, now, now - CLAIM_TIMEOUT, limit))
+        rows = conn.execute('SELECT id, payload FROM notification_queue WHERE claimed_by = ? ORDER BY id',
+                            (owner,)).fetchall()
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def ack(self, ids):
+        self._conn().executemany('DELETE FROM notification_queue WHERE id = ?', [(i,) for i in ids])
+
+    def release(self, owner):
+        self._conn().execute('UPDATE notification_queue SET claimed_by = NULL WHERE claimed_by = ?', (owner,))
+
+    def fail(self, row_id, error, max_attempts=MAX_ATTEMPTS):
+        """Record a failed delivery of one claimed row. Returns True if it was dead-lettered."""
+        conn = self._conn()
+        now = time.time()
+        (attempts,) = conn.execute(
+            'UPDATE notification_queue SET attempts = attempts + 1, error = ?, claimed_by = NULL, claimed_at = NULL '
+            'WHERE id = ? RETURNING attempts', (error, row_id)).fetchone()
+        if attempts >= max_attempts:
+            conn.execute('UPDATE notification_queue SET dead_at = ? WHERE id = ?', (now, row_id))
+            return True
+        delay = min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        conn.execute('UPDATE notification_queue SET retry_at = ? WHERE id = ?', (now + delay, row_id))
+        return False
+
+    def dead_letters(self):
+        """[(id, intent, attempts, error)] of the dead-lettered rows."""
+        rows = self._conn().execute('SELECT id, payload, attempts, error FROM notification_queue '
+                                    'WHERE dead_at IS NOT NULL ORDER BY id').fetchall()
+        return [(row_id, json.loads(payload), attempts, error) for row_id, payload, attempts, error in rows]
+
+    def requeue_dead(self):
+        """Give every dead-lettered row a fresh set of attempts (after fixing the cause). Returns the count."""
+        return self._conn().execute('UPDATE notification_queue SET dead_at = NULL, attempts = 0, retry_at = NULL '
+                                    'WHERE dead_at IS NOT NULL').rowcount
+
+    def __len__(self):
+        """Rows still to deliver (dead letters excluded)."""
+        return self._conn().execute('SELECT COUNT(*) FROM notification_queue WHERE dead_at IS NULL').fetchone()[0]
+
+
+class NotificationDispatcher:
+    """Drains a NotificationQueue into the notifications table from a worker thread."""
+
+    def __init__(self, app, queue, max_attempts=MAX_ATTEMPTS):
+        self.app = app
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # Threads don't survive fork(); start one per worker process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='notification-dispatcher', daemon=True).start()
+
+    def enqueue(self, intent):
+        self._ensure_worker()
+        self.queue.put(intent)
+        self._wake.set()
+
+    def flush(self, timeout=5):
+        """Block until the queue is empty (tests, shutdown); False on timeout."""
+        self._ensure_worker()
+        deadline = time.monotonic() + timeout
+        while len(self.queue):
+            if time.monotonic() > deadline:
+                return False
+            self._wake.set()
+            time.sleep(BATCH_WINDOW)
+        return True
+
+    def _run(self):
+        owner = f'{os.getpid()}:{threading.get_ident()}'
+        while not self._closed.is_set():
+            if self._wake.wait(POLL_INTERVAL):
+                time.sleep(BATCH_WINDOW)  # let the rest of the request's intents arrive
+            self._wake.clear()
+            try:
+                while True:
+                    batch = self.queue.claim(owner)
+                    if not batch:
+                        break
+                    try:
+                        self._deliver(batch)
+                        continue
+                    except Exception as e:
+                        error = e
+                    if len(batch) == 1:
+                        self._failed(*batch[0], error)
+                    else:
+                        log.warning('notification batch of %d failed; delivering one by one', len(batch),
+                                    exc_info=error)
+                        self._deliver_each(batch)
+            except Exception:
+                log.exception('notification dispatch failed; will retry')
+                try:
+                    self.queue.release(owner)
+                except sqlite3.Error:
+                    pass
+                self._closed.wait(POLL_INTERVAL)
+
+    def _deliver_each(self, batch):
+        # Isolate the intents that fail, so the rest of the batch goes through
+        for row_id, intent in batch:
+            try:
+                self._deliver([(row_id, intent)])
+            except Exception as e:
+                self._failed(row_id, intent, e)
+
+    def _failed(self, row_id, intent, error):
+        if self.queue.fail(row_id, repr(error), self.max_attempts):
+            log.error('notification intent %s dead-lettered after %d attempts: %r', row_id,
+                      self.max_attempts, intent, exc_info=error)
+        else:
+            log.warning('notification intent %s failed; will retry', row_id, exc_info=error)
+
+    def _deliver(self, batch):
+        from models import db, Notification, serialize_notification
+        from routes.notifications import (add_notification, adjust_unread, coalesce_window, notification_title,
+                                          publish_notification)
+
+        plain, rolled = [], {}
+        with self.app.app_context():
+            for _, intent in batch:
+                row = dict(intent, created_at=datetime.fromisoformat(intent['created_at']))
+                group_title = row.pop('group_title', None)
+                row.setdefault('count', 1)  # intents queued before coalescing existed
+                if row.get('ref_id') is not None and coalesce_window(row['type']):
+                    # Merge events for the same notification within the batch first
+                    key = (row['user_id'], row['type'], row['ref_id'])
+                    previous = rolled.pop(key, None)
+                    if previous:
+                        row['count'] += previous[0]['count']
+                    rolled[key] = (row, group_title)
+                else:
+                    row['title'] = notification_title(row['title'], group_title, row['count'])
+                    plain.append(row)
+
+            table = Notification.__table__
+            new_ids = []
+            if plain:
+                # One executemany (batched VALUES ... RETURNING) for the plain inserts
+                new_ids = db.session.execute(table.insert().returning(table.c.id), plain).scalars().all()
+                for user_id, count in Counter(row['user_id'] for row in plain).items():
+                    adjust_unread(user_id, count)
+            touched = []
+            for row, group_title in rolled.values():
+                fields = {k: v for k, v in row.items() if k not in ('count', 'created_at', 'read')}
+                touched.append(add_notification(fields, group_title=group_title, count=row['count'],
+                                                now=row['created_at']))
+            db.session.flush()
+            now = datetime.utcnow()
+            payloads = [serialize_notification(SimpleNamespace(id=new_id, **row), now)
+                        for row, new_id in zip(plain, new_ids)]
+            payloads += [serialize_notification(n, now) for n in touched]
+            db.session.commit()
+        self.queue.ack([row_id for row_id, _ in batch])
+
+        for payload in payloads:
+            publish_notification(payload)
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+
+
+def configure(app):
+    """Set up dispatching for app from NOTIFICATION_DISPATCH / NOTIFICATION_QUEUE_PATH."""
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.close()
+        _dispatcher = None
+    if app.config.get('NOTIFICATION_DISPATCH', 'sync') == 'async':
+        _dispatcher = NotificationDispatcher(app, NotificationQueue(app.config['NOTIFICATION_QUEUE_PATH']))
+    return _dispatcher
+
+
+@atexit.register
+def _drain_on_exit():
+    if _dispatcher is not None:
+        _dispatcher.flush(timeout=2)
+
+
+def get_dispatcher():
+    """The active dispatcher, or None in sync mode."""
+    return _dispatcher
@@ -0,0 +1,118 @@
+"""
+Per-user notification preferences, compiled to a bitmask and cached.
+
+User.notification_prefs holds JSON like {"message": false, "payment": true}:
+one flag per notification type, missing types enabled. create_notification
+checks it before writing anything, so an opted-out notification costs a
+dict lookup rather than an INSERT. Each worker caches the compiled masks.
+Whoever changes a user's preferences calls invalidate(), which reaches
+every worker over the event bus.
+
+Admin broadcasts of type 'alert' are operational advisories, e.g. outbreak
+warnings, and are always delivered. Other broadcasts write notifications in
+bulk, not through create_notification; they drop the opted-out users of
+each chunk with opted_out().
+"""
+
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import event_bus
+from models import db, User
+
+NOTIFICATION_TYPES = ('consultation', 'payment', 'message', 'system', 'alert')
+TYPE_BITS = {type: 1 << i for i, type in enumerate(NOTIFICATION_TYPES)}
+ALL_TYPES = (1 << len(NOTIFICATION_TYPES)) - 1
+ALWAYS_DELIVERED = TYPE_BITS['alert']
+
+MASK_TTL_SECONDS = 300  # safety net; changes are normally pushed via invalidate()
+MAX_CACHED_MASKS = 50000
+
+_masks = OrderedDict()  # user_id -> (mask, expires_at)
+_lock = threading.Lock()
+_dropped = Counter()  # type -> notifications suppressed in this worker
+
+
+def compile_prefs(raw):
+    """notification_prefs JSON -> bitmask of enabled types. Bad or missing JSON enables everything."""
+    try:
+        prefs = json.loads(raw) if raw else {}
+    except (TypeError, ValueError):
+        prefs = {}
+    if not isinstance(prefs, dict):
+        prefs = {}
+    mask = ALL_TYPES
+    for type, bit in TYPE_BITS.items():
+        if prefs.get(type) is False:
+            mask &= ~bit
+    return mask | ALWAYS_DELIVERED
+
+
+def expand(mask):
+    """Bitmask -> {type: enabled}, as served by the preferences API."""
+    return {type: bool(mask & bit) for type, bit in TYPE_BITS.items()}
+
+
+def get_mask(user_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _masks.get(user_id)
+        if entry and entry[1] > now:
+            _masks.move_to_end(user_id)
+            return entry[0]
+    mask = compile_prefs(db.session.query(User.notification_prefs).filter_by(id=user_id).scalar())
+    with _lock:
+        _masks[user_id] = (mask, now + MASK_TTL_SECONDS)
+        _masks.move_to_end(user_id)
+        while len(_masks) > MAX_CACHED_MASKS:
+            _masks.popitem(last=False)
+    return mask
+
+
+def allows(user_id, type):
+    """Whether user_id wants notifications of this type. Counts the ones it drops."""
+    bit = TYPE_BITS.get(type)
+    if bit is None or get_mask(user_id) & bit:
+        return True
+    with _lock:
+        _dropped[type] += 1
+    return False
+
+
+def opted_out(users, type):
+    """Ids among (user_id, notification_prefs JSON) pairs that turned type off. Counts them as dropped."""
+    bit = TYPE_BITS.get(type)
+    if bit is None:
+        return []
+    ids = [user_id for user_id, raw in users if raw and not compile_prefs(raw) & bit]
+    if ids:
+        with _lock:
+            _dropped[type] += len(ids)
+    return ids
+
+
+def dropped_counts():
+    """Notifications suppressed by preferences in this worker, per type."""
+    with _lock:
+        return dict(_dropped)
+
+
+def invalidate(user_id):
+    """Drop a user's cached mask in every worker. Call after committing the change."""
+    event_bus.publish('notification_prefs', {'user_id': user_id})
+
+
+def _on_invalidate(event_id, payload):
+    with _lock:
+        _masks.pop(payload['user_id'], None)
+
+
+def _on_resync(event_id, payload):
+    with _lock:
+        _masks.clear()
+
+
+event_bus.subscribe('notification_prefs', _on_invalidate)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
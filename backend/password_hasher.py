@@ -0,0 +1,199 @@
+"""
+Password hashing on a bounded process pool.
+
+generate_password_hash/check_password_hash run a deliberately slow KDF
+(tens of milliseconds). Called inline, a burst of logins keeps a
+gunicorn worker's CPU busy and its other threads, serving chat
+traffic, wait. The hashes now run on a small process pool of
+PASSWORD_HASH_WORKERS processes. A request thread only waits on the
+result, and at most PASSWORD_HASH_MAX_PENDING hashes may be queued or
+running per worker. Beyond that, HashBusy is raised and the route
+answers 503 with Retry-After.
+
+PASSWORD_HASH_METHOD sets the algorithm and its cost in werkzeug's
+notation (e.g. 'scrypt', 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000').
+Stored hashes made with other parameters still verify, and they are
+rehashed on the next successful login (needs_rehash).
+
+configure() starts the pool while create_app runs, before the event bus,
+dispatcher and flush threads exist. The pool forks its processes, and
+fork() copies only the calling thread: a lock another thread held at that
+moment would stay locked in the child.
+
+PASSWORD_HASH_WORKERS = 0 hashes inline (scripts, tests).
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'  # werkzeug's default, spelled out as it appears in stored hashes
+DEFAULT_WORKERS = 2
+MAX_PENDING = 32  # hashes queued or running per worker process
+HASH_TIMEOUT = 30  # seconds
+
+_hasher = None
+
+
+class HashBusy(Exception):
+    """Too many password hashes in flight; ask the client to retry shortly."""
+
+
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_METHOD, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._prefix = None  # stored-hash prefix of self.method, e.g. 'scrypt:32768:8:1'
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._peak_pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def hash_many(self, passwords):
+        """Hash a batch (bulk imports), split across the pool's processes.
+
+        Each slice takes one pending slot, so a batch can't crowd out logins.
+        """
+        passwords = list(passwords)
+        if not passwords:
+            return []
+        if self.workers <= 0:
+            return [self.hash(password) for password in passwords]
+        size = -(-len(passwords) // self.workers)
+        chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+        with self._lock:
+            if self._pending + len(chunks) > self.max_pending:
+                self._rejected += 1
+                raise HashBusy()
+            self._pending += len(chunks)
+            self._peak_pending = max(self._peak_pending, self._pending)
+        started = time.perf_counter()
+        try:
+            futures = [self._pool().submit(_hash_chunk, chunk, self.method) for chunk in chunks]
+            return [pwhash for future in futures for pwhash in future.result(timeout=HASH_TIMEOUT * size)]
+        finally:
+            with self._lock:
+                self._pending -= len(chunks)
+                self._completed += len(passwords)
+                self._busy_seconds += (time.perf_counter() - started) * len(chunks)
+
+    def start(self):
+        """Start the pool processes now and learn the prefix this method's hashes carry."""
+        if self.workers > 0:
+            sample = self._pool().submit(generate_password_hash, '', self.method).result(timeout=HASH_TIMEOUT)
+        else:
+            sample = generate_password_hash('', self.method)
+        self._prefix = sample.split('$', 1)[0]
+        return self
+
+    def needs_rehash(self, pwhash):
+        """True if pwhash wasn't made with the configured method and cost."""
+        if self._prefix is None:
+            # werkzeug stores the expanded method: 'scrypt' -> 'scrypt:32768:8:1'
+            self._prefix = self.hash('').split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {
+                'method': self.method,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'peak_pending': self._peak_pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_ms': round(self._busy_seconds / self._completed * 1000, 2) if self._completed else None,
+            }
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise HashBusy()
+            self._pending += 1
+            self._peak_pending = max(self._peak_pending, self._pending)
+        started = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            return self._pool().submit(fn, *args).result(timeout=HASH_TIMEOUT)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._completed += 1
+                self._busy_seconds += time.perf_counter() - started
+
+    def _pool(self):
+        # A pool doesn't survive fork(); make one per worker process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # fork is only safe while this is the process's one thread (see start());
+                    # otherwise fork from a clean server process. Not spawn for the former:
+                    # it would re-run the main script (gunicorn, full_test.py) in every child
+                    single = threading.active_count() == 1
+                    context = multiprocessing.get_context('fork' if single else 'forkserver')
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._pid = None
+
+
+def _hash_chunk(passwords, method):
+    return [generate_password_hash(password, method) for password in passwords]
+
+
+def configure(app):
+    """Set up hashing for app from PASSWORD_HASH_METHOD / _WORKERS / _MAX_PENDING."""
+    global _hasher
+    if _hasher is not None:
+        _hasher.close()
+    _hasher = PasswordHasher(
+        method=app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+        workers=int(app.config.get('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)),
+        max_pending=int(app.config.get('PASSWORD_HASH_MAX_PENDING', MAX_PENDING)),
+    ).start()
+    return _hasher
+
+
+def get_hasher():
+    global _hasher
+    if _hasher is None:
+        _hasher = PasswordHasher()
+    return _hasher
+
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+
+def verify_password(pwhash, password):
+    return get_hasher().verify(pwhash, password)
+
+
+@atexit.register
+def _shutdown():
+    if _hasher is not None:
+        _hasher.close()
@@ -0,0 +1,160 @@
+"""
+Write-behind presence heartbeats.
+
+Every open tab calls /presence/heartbeat, and that used to mean an UPDATE
+and a COMMIT of users.last_seen per call. Heartbeats now land in an
+in-memory table. A background thread in each worker writes the ones that
+worker took to users.last_seen with one executemany UPDATE every
+PRESENCE_FLUSH_SECONDS. The UPDATE only ever moves last_seen forward.
+
+Workers share the hot table over the event bus ('heartbeat' channel). A
+heartbeat is forwarded when the user hasn't been announced for
+SHARE_INTERVAL seconds, which is far finer than the 2-minute online
+window. Reads look at the hot table first and fall back to
+users.last_seen. PRESENCE_FLUSH_SECONDS = 0 writes through on every
+heartbeat, as before.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam, or_
+
+import event_bus
+
+log = logging.getLogger(__name__)
+
+SHARE_INTERVAL = 30  # seconds between bus announcements of the same user
+FORGET_AFTER = 600  # seconds before an idle user is dropped from the hot table
+
+_store = None
+
+
+class PresenceStore:
+    """Hot last-seen table, flushed to users.last_seen in batches."""
+
+    def __init__(self, app=None, flush_interval=10):
+        self.app = app
+        self.flush_interval = flush_interval
+        self._seen = {}  # user_id -> last heartbeat seen by any worker
+        self._announced = {}  # user_id -> when this worker last forwarded it on the bus
+        self._dirty = {}  # user_id -> heartbeat taken here, not yet in users.last_seen
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._pid = None
+
+    def touch(self, user_id, now=None):
+        """Record a heartbeat; returns the previous one known (hot table only), or None."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            previous = self._seen.get(user_id)
+            if previous is None or previous < now:
+                self._seen[user_id] = now
+            self._dirty[user_id] = max(now, self._dirty.get(user_id, now))
+            announced = self._announced.get(user_id)
+            share = announced is None or (now - announced).total_seconds() >= SHARE_INTERVAL
+            if share:
+                self._announced[user_id] = now
+        if share:
+            event_bus.publish('heartbeat', {'user_id': user_id, 'ts': now.isoformat()})
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_worker()
+        return previous
+
+    def last_seen(self, user_id):
+        with self._lock:
+            return self._seen.get(user_id)
+
+    def _on_heartbeat(self, event_id, payload):
+        ts = datetime.fromisoformat(payload['ts'])
+        with self._lock:
+            if self._seen.get(payload['user_id'], ts) <= ts:
+                self._seen[payload['user_id']] = ts
+
+    def flush(self):
+        """Write pending heartbeats to users.last_seen in one statement; returns how many."""
+        from models import db, User
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._dirty = self._dirty, {}
+            if not pending:
+                return 0
+            users = User.__table__
+            stmt = users.update().where(users.c.id == bindparam('uid')).where(
+                or_(users.c.last_seen.is_(None), users.c.last_seen < bindparam('ts'))
+            ).values(last_seen=bindparam('ts'))
+            try:
+                with self.app.app_context():
+                    db.session.execute(stmt, [{'uid': uid, 'ts': ts} for uid, ts in pending.items()])
+                    db.session.commit()
+            except Exception:
+                with self._lock:  # keep them for the next round
+                    for uid, ts in pending.items():
+                        self._dirty[uid] = max(ts, self._dirty.get(uid, ts))
+                raise
+            self._forget_idle()
+            return len(pending)
+
+    def _forget_idle(self):
+        cutoff = datetime.utcnow().timestamp() - FORGET_AFTER
+        with self._lock:
+            for uid in [uid for uid, ts in self._seen.items() if ts.timestamp() < cutoff]:
+                self._seen.pop(uid, None)
+                self._announced.pop(uid, None)
+
+    def _ensure_worker(self):
+        # Threads don't survive fork(); start one per worker process
+        if self._pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='presence-flush', daemon=True).start()
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('presence flush failed; will retry')
+
+    def close(self):
+        self._closed.set()
+
+
+def configure(app):
+    """Set up the presence store for app from PRESENCE_FLUSH_SECONDS."""
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = PresenceStore(app, float(app.config.get('PRESENCE_FLUSH_SECONDS', 10)))
+    return _store
+
+
+def get_store():
+    return _store
+
+
+def _on_heartbeat(event_id, payload):
+    if _store is not None:
+        _store._on_heartbeat(event_id, payload)
+
+
+@atexit.register
+def _flush_on_exit():
+    if _store is not None and _store.app is not None:
+        try:
+            _store.flush()
+        except Exception:
+            log.exception('presence flush at exit failed')
+
+
+event_bus.subscribe('heartbeat', _on_heartbeat)
@@ -0,0 +1,106 @@
+"""
+Query plan check: every statement the app sends must be answered from an index.
+
+QueryRecorder captures the distinct statements an engine executes (with
+the parameters of their first run). full_scans() replays each one under
+SQLite's EXPLAIN QUERY PLAN and returns those whose plan reads a whole
+table: a bare "SCAN <table>" step. "SCAN <table> USING INDEX" is also a
+full scan. The one exception is a scan that SQLite stops after LIMIT rows:
+the statement has a LIMIT, the scan order supplies the ORDER BY (no temp
+B-tree), and the WHERE clause doesn't test the scanned table. With such a
+test, SQLite reads on until LIMIT rows match, which is the whole table
+when few do. Virtual tables (the FTS5 search index) are answered by their
+own index.
+
+full_test.py records the whole suite, which exercises every route, and
+fails if anything scans. Statements that scan by design are listed in
+ALLOWED_SCANS with the reason. Plans are SQLite's; on Postgres the check
+is skipped.
+"""
+
+import re
+
+from sqlalchemy import event
+
+# substring of the statement -> why a full scan is acceptable there
+ALLOWED_SCANS = {
+    # Broadcast segments match free-text location/crops by substring, which no
+    # index serves; counted once per broadcast by an admin. The delivery itself
+    # walks users in id order, chunk by chunk.
+    "lower(users.location) LIKE '%'": 'broadcast segment count (admin, once per broadcast)',
+    "lower(users.primary_crops) LIKE '%'": 'broadcast segment count (admin, once per broadcast)',
+    # Retention of read notifications and deleted messages, from cron or its
+    # own thread: the dry-run counts, and the purge, which reads batches in id
+    # order. An index on (read, type, created_at) or (deleted, timestamp)
+    # would cost every notification / message INSERT to speed up one nightly
+    # job, and it isn't selective: most rows end up matching.
+    'FROM notifications WHERE notifications.read = 1 AND': 'retention of read notifications (cron)',
+    'FROM messages WHERE messages.deleted = 1 AND messages.timestamp <': 'retention of deleted messages (cron)',
+}
+
+SKIPPED = re.compile(r'^\s*(PRAGMA|EXPLAIN|CREATE|DROP|ALTER|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|VACUUM)\b', re.I)
+SCAN = re.compile(r'^SCAN (\w+)')
+
+
+class QueryRecorder:
+    """Records the distinct statements run on engine while attached."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = {}  # statement -> parameters of its first run
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if SKIPPED.match(statement) or statement in self.statements:
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        self.statements[statement] = parameters
+
+    def start(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def stop(self):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def explain(conn, statement, parameters):
+    """SQLite query plan steps of a statement, e.g. ['SEARCH messages USING INDEX ...']."""
+    raw = conn.connection.driver_connection
+    return [row[3] for row in raw.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ()).fetchall()]
+
+
+def filters_on(statement, table):
+    """True if the statement's WHERE clause tests a column of table (or alias)."""
+    where = re.split(r'\bWHERE\b', statement, maxsplit=1, flags=re.I)
+    return len(where) > 1 and re.search(rf'(?<![\w.]){table}"?\.', where[1]) is not None
+
+
+def is_full_scan(statement, plan):
+    ordered_limit = re.search(r'\bLIMIT\b', statement, re.I) and not any('USE TEMP B-TREE' in s for s in plan)
+    for step in plan:
+        if 'VIRTUAL TABLE' in step:
+            continue
+        scan = SCAN.match(step.strip())
+        if scan and not (ordered_limit and not filters_on(statement, scan.group(1))):
+            return True  # reads every row of a table or index
+    return False
+
+
+def allowed(statement):
+    statement = ' '.join(statement.split())
+    return next((reason for needle, reason in ALLOWED_SCANS.items() if needle in statement), None)
+
+
+def full_scans(conn, statements):
+    """[(statement, plan)] for every statement whose plan scans a whole table and isn't allowed."""
+    found = []
+    for statement, parameters in statements.items():
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception:
+            continue  # e.g. statements for another dialect, or a temp table that is gone
+        if is_full_scan(statement, plan) and not allowed(statement):
+            found.append((statement, plan))
+    return found
+
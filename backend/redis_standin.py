@@ -0,0 +1,122 @@
+"""
+Tiny in-process stand-in for a Redis server, for testing the Redis event-bus
+backend without installing Redis. Speaks RESP2 and implements only the
+commands the bus uses: PING, SELECT, GET, SET, SETNX, INCR, PUBLISH and
+SUBSCRIBE.
+
+Usage:
+    server = RedisStandIn()          # binds 127.0.0.1 on a free port
+    server.start()
+    url = f'redis://127.0.0.1:{server.port}/0'
+    ...
+    server.stop()
+"""
+import socket
+import socketserver
+import threading
+
+
+def _encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(_encode(v) for v in value)
+    raise TypeError(type(value))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        state = self.server.state
+        while True:
+            args = self._read_command()
+            if args is None:
+                break
+            name = args[0].upper()
+            with state['lock']:
+                if name == b'PING':
+                    reply = 'PONG'
+                elif name == b'SELECT':
+                    reply = 'OK'
+                elif name == b'GET':
+                    reply = state['data'].get(args[1])
+                elif name == b'SET':
+                    state['data'][args[1]] = args[2]
+                    reply = 'OK'
+                elif name == b'SETNX':
+                    reply = 0 if args[1] in state['data'] else 1
+                    state['data'].setdefault(args[1], args[2])
+                elif name == b'INCR':
+                    value = int(state['data'].get(args[1], b'0')) + 1
+                    state['data'][args[1]] = str(value).encode()
+                    reply = value
+                elif name == b'PUBLISH':
+                    subscribers = list(state['subscribers'].get(args[1], ()))
+                    for sub in subscribers:
+                        try:
+                            sub.wfile.write(_encode([b'message', args[1], args[2]]))
+                        except OSError:
+                            state['subscribers'][args[1]].discard(sub)
+                    reply = len(subscribers)
+                elif name == b'SUBSCRIBE':
+                    for i, channel in enumerate(args[1:], 1):
+                        state['subscribers'].setdefault(channel, set()).add(self)
+                        self.wfile.write(_encode([b'subscribe', channel, i]))
+                    continue
+                else:
+                    reply = RuntimeError(f'unknown command {name!r}')
+            if isinstance(reply, RuntimeError):
+                self.wfile.write(b'-ERR %s\r\n' % str(reply).encode())
+            else:
+                self.wfile.write(_encode(reply))
+
+    def finish(self):
+        with self.server.state['lock']:
+            for subs in self.server.state['subscribers'].values():
+                subs.discard(self)
+        super().finish()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RedisStandIn:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = _Server((host, port), _Handler)
+        self.server.state = {'lock': threading.Lock(), 'data': {}, 'subscribers': {}}
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def drop_subscribers(self):
+        """Close every SUBSCRIBE connection, as a network blip or server restart would."""
+        with self.server.state['lock']:
+            for subs in self.server.state['subscribers'].values():
+                for sub in subs:
+                    sub.connection.shutdown(socket.SHUT_RDWR)
+                subs.clear()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
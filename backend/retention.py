@@ -0,0 +1,236 @@
+"""
+Retention job: archive and remove old notifications, deleted messages and expired sessions.
+
+Three kinds of rows are retired:
+  - read notifications older than their type's TTL (NOTIFICATION_TTL_DAYS,
+    overridable with the NOTIFICATION_RETENTION_DAYS config dict). Unread
+    ones are kept, so unread counters never change.
+  - soft-deleted messages (blanked by delete_message) older than
+    DELETED_MESSAGE_TTL_DAYS, except the newest message of a consultation,
+    whose id must not be reused (see message_condition).
+  - expired refresh tokens and session revocations (see auth_utils.py).
+
+Rows go in batches of BATCH_SIZE: one DELETE ... RETURNING per batch, with
+the returned rows appended to a gzip JSONL file under RETENTION_ARCHIVE_DIR
+before the commit. Each write transaction stays short, and there is a pause
+between batches so requests get the write lock. An archive write that fails
+rolls the batch back. A crash between the archive write and the commit can
+leave a batch archived twice, but it is never lost.
+
+Afterwards SQLite files get an incremental vacuum to return the freed pages
+to the filesystem. This needs auto_vacuum=INCREMENTAL. An existing file
+is converted once with `--convert-vacuum`, which runs a full VACUUM.
+
+Run it from cron:
+
+    python retention.py [--dry-run] [--convert-vacuum]
+
+or set RETENTION_INTERVAL_HOURS to run it on a background thread in each
+worker. Concurrent runs are safe: a row is only returned by one DELETE.
+"""
+
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, delete, exists, func, or_, select
+from sqlalchemy.orm import aliased
+
+from models import db, Message, Notification, RefreshToken, RevokedSession
+import search_index
+
+log = logging.getLogger(__name__)
+
+# Days a read notification of each type is kept
+NOTIFICATION_TTL_DAYS = {
+    'message': 30,
+    'consultation': 180,
+    'payment': 365,
+    'system': 90,
+    'alert': 30,
+}
+DEFAULT_NOTIFICATION_TTL_DAYS = 90
+DELETED_MESSAGE_TTL_DAYS = 30
+
+BATCH_SIZE = 1000
+BATCH_PAUSE = 0.02  # seconds between batches
+VACUUM_STEP_PAGES = 2000  # pages freed per incremental_vacuum call
+
+_scheduler = None
+
+
+def notification_ttls():
+    return dict(NOTIFICATION_TTL_DAYS, **(current_app.config.get('NOTIFICATION_RETENTION_DAYS') or {}))
+
+
+def notification_condition(now):
+    """Read notifications past their type's TTL."""
+    ttls = notification_ttls()
+    expired = [and_(Notification.type == type, Notification.created_at < now - timedelta(days=days))
+               for type, days in ttls.items()]
+    expired.append(and_(Notification.type.notin_(list(ttls)),
+                        Notification.created_at < now - timedelta(days=DEFAULT_NOTIFICATION_TTL_DAYS)))
+    return and_(Notification.read == True, or_(*expired))  # noqa: E712
+
+
+def message_condition(now):
+    """Soft-deleted messages past DELETED_MESSAGE_TTL_DAYS, except each consultation's newest message.
+
+    SQLite gives a new row the highest id in use plus one (messages has no
+    AUTOINCREMENT), so deleting the newest rows would hand their ids out
+    again. Read watermarks (read_receipts) and the search index compare
+    message ids, and would take the new messages as already read or indexed.
+    Keeping the newest message of every consultation, which is already
+    blanked, keeps every id that was ever handed out in use.
+    """
+    newer = aliased(Message)
+    return and_(Message.deleted == True,  # noqa: E712
+                Message.timestamp < now - timedelta(days=DELETED_MESSAGE_TTL_DAYS),
+                exists().where(newer.consultation_id == Message.consultation_id, newer.id > Message.id))
+
+
+def archive_path(table_name, today=None):
+    archive_dir = current_app.config.get('RETENTION_ARCHIVE_DIR') or os.path.join(current_app.instance_path, 'archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    return os.path.join(archive_dir, f'{table_name}-{(today or date.today()).isoformat()}.jsonl.gz')
+
+
+def _append_archive(path, rows):
+    archived_at = datetime.utcnow().isoformat()
+    # Each append is its own gzip member; gzip readers treat the file as one stream
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for row in rows:
+            record = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row._mapping.items()}
+            record['archived_at'] = archived_at
+            f.write(json.dumps(record) + '\n')
+
+
+def purge(model, condition, dry_run=False, batch_size=BATCH_SIZE, on_batch=None, order_by=None):
+    """Archive and delete every row of model matching condition, batch by batch.
+
+    Batches are taken in order_by order (default: primary key). Pass the
+    indexed column the condition ranges over, so each batch is read from
+    the index instead of a table scan. Returns the number of rows moved (or
+    that would be, with dry_run).
+    """
+    table = model.__table__
+    key = list(table.primary_key)[0]
+    if dry_run:
+        return db.session.query(func.count()).select_from(table).where(condition).scalar()
+
+    order = order_by if order_by is not None else key
+    path = archive_path(table.name)
+    moved = 0
+    while True:
+        batch = select(key).where(condition).order_by(order).limit(batch_size).scalar_subquery()
+        try:
+            rows = db.session.execute(delete(table).where(key.in_(batch)).returning(*table.c)).all()
+            if rows:
+                _append_archive(path, rows)
+                if on_batch:
+                    on_batch([row._mapping[key.name] for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(rows)
+        if len(rows) < batch_size:
+            return moved
+        time.sleep(BATCH_PAUSE)
+
+
+def vacuum(convert=False):
+    """Return free pages to the filesystem (SQLite only). Returns pages freed, or None if skipped."""
+    if db.engine.dialect.name != 'sqlite':
+        return None  # Postgres' autovacuum reuses the space
+    with db.engine.connect() as conn:
+        mode = conn.exec_driver_sql('PRAGMA auto_vacuum').scalar()
+        if mode != 2:  # not INCREMENTAL
+            if not convert:
+                log.info('auto_vacuum is not INCREMENTAL; run with --convert-vacuum once to enable it')
+                return None
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')  # applies the new mode; rewrites the whole file once
+        raw = conn.connection.driver_connection
+        freed = 0
+        while True:
+            free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            if not free:
+                return freed
+            # execute() would only step the pragma once (one page); executescript runs it to the end
+            raw.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});')
+            freed += free - conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            time.sleep(BATCH_PAUSE)
+
+
+def run(dry_run=False, convert_vacuum=False, now=None):
+    """Apply the retention policy once; returns a report dict."""
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    report = {'dry_run': dry_run}
+
+    step = time.perf_counter()
+    report['notifications'] = purge(Notification, notification_condition(now), dry_run=dry_run)
+    report['notifications_seconds'] = round(time.perf_counter() - step, 3)
+
+    step = time.perf_counter()
+    report['messages'] = purge(Message, message_condition(now), dry_run=dry_run,
+                               on_batch=lambda ids: search_index.remove_messages(db.session, ids))
+    report['messages_seconds'] = round(time.perf_counter() - step, 3)
+
+    step = time.perf_counter()
+    report['sessions'] = (purge(RefreshToken, RefreshToken.expires_at < now, dry_run=dry_run,
+                                order_by=RefreshToken.expires_at)
+                          + purge(RevokedSession, RevokedSession.expires_at < now, dry_run=dry_run,
+                                  order_by=RevokedSession.expires_at))
+    report['sessions_seconds'] = round(time.perf_counter() - step, 3)
+
+    step = time.perf_counter()
+    report['vacuum_pages'] = None if dry_run else vacuum(convert=convert_vacuum)
+    report['vacuum_seconds'] = round(time.perf_counter() - step, 3)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    log.info('retention: %s', report)
+    return report
+
+
+def configure(app):
+    """Start the periodic retention thread if RETENTION_INTERVAL_HOURS is set."""
+    global _scheduler
+    hours = float(app.config.get('RETENTION_INTERVAL_HOURS') or 0)
+    if hours <= 0 or _scheduler is not None:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(hours * 3600)
+            try:
+                with app.app_context():
+                    run()
+            except Exception:
+                log.exception('retention run failed')
+
+    _scheduler = threading.Thread(target=loop, name='retention', daemon=True)
+    _scheduler.start()
+    return _scheduler
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        report = run(dry_run='--dry-run' in sys.argv, convert_vacuum='--convert-vacuum' in sys.argv)
+    verb = 'would move' if report['dry_run'] else 'moved'
+    print(f"Notifications: {verb} {report['notifications']} ({report['notifications_seconds']}s)")
+    print(f"Deleted messages: {verb} {report['messages']} ({report['messages_seconds']}s)")
+    print(f"Expired sessions: {verb} {report['sessions']} ({report['sessions_seconds']}s)")
+    if not report['dry_run']:
+        pages = report['vacuum_pages']
+        print(f"Vacuum: {'skipped' if pages is None else f'{pages} pages freed'} ({report['vacuum_seconds']}s)")
+    print(f"Total: {report['seconds']}s")
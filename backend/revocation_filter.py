@@ -0,0 +1,157 @@
+"""
+Revoked login sessions, checked on every request without a query.
+
+Access tokens are short-lived and carry the id of their login session
+('sid'). Revoking a session (logout, password change, a replayed refresh
+token) writes it to revoked_sessions, where it stays until the session's
+last access token has expired, and announces it on the event bus
+('session_revocation'). Each worker keeps the live rows in a Bloom filter.
+A sid not in the filter, which is nearly every request, is accepted after
+a few hashes. A hit is either a revoked session or a rare false positive
+(FALSE_POSITIVE_RATE), so it is confirmed against the table.
+
+Bits can't be taken out of a Bloom filter. The filter is instead rebuilt
+from the table every REBUILD_SECONDS, which also forgets revocations that
+have expired.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime
+
+import event_bus
+from models import db, RevokedSession
+
+CAPACITY = 100_000  # revocations before the false-positive rate degrades; the rebuild resizes
+FALSE_POSITIVE_RATE = 0.001
+REBUILD_SECONDS = 300
+
+
+class BloomFilter:
+    def __init__(self, capacity=CAPACITY, error_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)  # bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class RevocationFilter:
+    """This worker's view of revoked_sessions: a Bloom filter, confirmed against the table on a hit."""
+
+    def __init__(self, rebuild_seconds=REBUILD_SECONDS):
+        self.rebuild_seconds = rebuild_seconds
+        self._bloom = None
+        self._pid = None
+        self._rebuild_at = 0
+        self._added_during_rebuild = None
+        self._lock = threading.Lock()
+        self._stats = {'checks': 0, 'filter_hits': 0, 'false_positives': 0, 'rebuilds': 0}
+
+    def is_revoked(self, session_id):
+        bloom = self._current()
+        self._stats['checks'] += 1
+        if session_id not in bloom:
+            return False
+        self._stats['filter_hits'] += 1
+        revoked = db.session.query(RevokedSession.session_id).filter(
+            RevokedSession.session_id == session_id, RevokedSession.expires_at > datetime.utcnow()
+        ).first() is not None
+        if not revoked:
+            self._stats['false_positives'] += 1
+        return revoked
+
+    def add(self, session_id):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(session_id)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(session_id)
+
+    def rebuild(self):
+        """Reload the filter from the live rows of revoked_sessions."""
+        with self._lock:
+            self._added_during_rebuild = []
+        try:
+            rows = db.session.query(RevokedSession.session_id).filter(
+                RevokedSession.expires_at > datetime.utcnow()).all()
+            bloom = BloomFilter(max(CAPACITY, 2 * len(rows)))
+            for (session_id,) in rows:
+                bloom.add(session_id)
+        finally:
+            with self._lock:
+                added, self._added_during_rebuild = self._added_during_rebuild, None
+        with self._lock:
+            # Revocations announced while the table was being read may not be in it
+            for session_id in added:
+                bloom.add(session_id)
+            self._bloom, self._pid = bloom, os.getpid()
+            self._rebuild_at = time.monotonic() + self.rebuild_seconds
+            self._stats['rebuilds'] += 1
+
+    def expire(self):
+        """Rebuild from the table on the next check."""
+        self._rebuild_at = 0
+
+    def _current(self):
+        bloom = self._bloom
+        if (bloom is None or self._pid != os.getpid() or time.monotonic() >= self._rebuild_at
+                or bloom.count > bloom.capacity):
+            self.rebuild()
+        return self._bloom
+
+    def stats(self):
+        bloom = self._bloom
+        return dict(self._stats, entries=bloom.count if bloom else 0,
+                    size_bytes=len(bloom._bits) if bloom else 0)
+
+
+_filter = RevocationFilter()
+
+
+def get_filter():
+    return _filter
+
+
+def is_revoked(session_id):
+    return _filter.is_revoked(session_id)
+
+
+def revoke(session_ids, until):
+    """Record session_ids as revoked until `until` (UTC) and tell every worker. Commits."""
+    for session_id in session_ids:
+        db.session.merge(RevokedSession(session_id=session_id, expires_at=until))
+    db.session.commit()
+    for session_id in session_ids:
+        event_bus.publish('session_revocation', {'session_id': session_id})
+
+
+def _on_revoke(event_id, payload):
+    _filter.add(payload['session_id'])
+
+
+def _on_resync(event_id, payload):
+    _filter.expire()  # revocations may have been missed; reread the table on the next check
+
+
+event_bus.subscribe('session_revocation', _on_revoke)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
@@ -1,12 +1,19 @@
 from flask import Blueprint, request, jsonify, g
-from models import db, User
-from werkzeug.security import generate_password_hash, check_password_hash
-from auth_utils import generate_token, require_auth
+from models import db, User, ADMIN_ROLE
+from password_hasher import HashBusy, get_hasher, hash_password, verify_password
+from auth_utils import (require_auth, invalidate_identity, revoke_tokens, token_cache_stats, access_minutes,
+                        start_session, refresh_session, end_sessions, RefreshError)
+import revocation_filter
 import re
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/v1/auth')
 
 
+@auth_bp.errorhandler(HashBusy)
+def hashing_busy(error):
+    return jsonify({'error': 'Server busy, please retry'}), 503, {'Retry-After': '1'}
+
+
 # Validation helpers
 def validate_email(email):
     """Basic email validation"""
@@ -52,6 +59,9 @@ def register():
     if not username or not password or not role:
         return jsonify({'error': 'username, password, and role are required'}), 400
 
+    if role == ADMIN_ROLE:
+        return jsonify({'error': 'Admin accounts cannot be self-registered'}), 403
+
     if len(username) < 3:
         return jsonify({'error': 'Username must be at least 3 characters long'}), 400
 
@@ -69,8 +79,7 @@ def register():
     if existing:
         return jsonify({'error': 'username already exists'}), 400
 
-    # Hash the password for the prototype (still not production-ready)
-    hashed = generate_password_hash(password)
+    hashed = hash_password(password)
     user = User(
         username=username,
         password=hashed,
@@ -101,19 +110,52 @@ def login():
         return jsonify({'error': 'username and password required'}), 400
 
     user = User.query.filter_by(username=username).first()
-    if not user or not check_password_hash(user.password, password):
+    if not user or not verify_password(user.password, password):
         return jsonify({'error': 'invalid credentials'}), 401
 
-    # Generate JWT token
-    token = generate_token(user.id)
-    return jsonify({'status': 'ok', 'token': token, 'user': user.to_dict()})
+    # Upgrade hashes made with an older method or cost while we have the plaintext.
+    # Best effort: if the pool is full, the upgrade waits for a later login
+    try:
+        if get_hasher().needs_rehash(user.password):
+            user.password = hash_password(password)
+            db.session.commit()
+    except HashBusy:
+        pass
+
+    token, refresh_token = start_session(user.id)
+    return jsonify({'status': 'ok', 'token': token, 'refresh_token': refresh_token,
+                    'expires_in': access_minutes() * 60, 'user': user.to_dict()})
+
+
+@auth_bp.route('/refresh', methods=['POST'])
+def refresh():
+    """Exchange a refresh token for a new access token and refresh token.
+
+    Body: {refresh_token}. The refresh token sent is retired; store the new one.
+    """
+    data = request.get_json(silent=True)
+    try:
+        token, refresh_token = refresh_session(data.get('refresh_token') if isinstance(data, dict) else None)
+    except RefreshError as e:
+        return jsonify({'error': 'Invalid refresh token', 'code': e.code}), 401
+    return jsonify({'status': 'ok', 'token': token, 'refresh_token': refresh_token,
+                    'expires_in': access_minutes() * 60})
+
+
+@auth_bp.route('/logout', methods=['POST'])
+@require_auth
+def logout():
+    """End the current session: its refresh token and access tokens stop working."""
+    if g.current_user.session_id:
+        end_sessions(g.current_user.id, g.current_user.session_id)
+    return jsonify({'status': 'ok'})
 
 
 @auth_bp.route('/profile', methods=['GET'])
 @require_auth
 def get_profile():
     """Get current user's profile"""
-    user = g.current_user
+    user = g.current_user.load()
     return jsonify({'status': 'ok', 'user': user.to_dict()})
 
 
@@ -121,7 +163,7 @@ def get_profile():
 @require_auth
 def update_profile():
     """Update current user's profile"""
-    user = g.current_user
+    user = g.current_user.load()
 
     data = request.json or {}
 
@@ -140,6 +182,7 @@ def update_profile():
             setattr(user, field, data[field])
 
     db.session.commit()
+    invalidate_identity(user.id)
 
     # Update localStorage with new user data
     return jsonify({'status': 'ok', 'user': user.to_dict(), 'message': 'Profile updated successfully'})
@@ -149,7 +192,7 @@ def update_profile():
 @require_auth
 def change_password():
     """Change user's password"""
-    user = g.current_user
+    user = g.current_user.load()
 
     data = request.json or {}
     current_password = data.get('current_password')
@@ -159,7 +202,7 @@ def change_password():
     if not current_password or not new_password:
         return jsonify({'error': 'Current password and new password are required'}), 400
 
-    if not check_password_hash(user.password, current_password):
+    if not verify_password(user.password, current_password):
         return jsonify({'error': 'Current password is incorrect'}), 401
 
     if new_password != confirm_password:
@@ -169,7 +212,30 @@ def change_password():
     if not is_valid:
         return jsonify({'error': error_msg}), 400
 
-    user.password = generate_password_hash(new_password)
+    user.password = hash_password(new_password)
     db.session.commit()
+    invalidate_identity(user.id)
+    revoke_tokens(user.id)  # signs out every session, this one included
+
+    # ...so hand this client a new session to carry on with
+    token, refresh_token = start_session(user.id)
+    return jsonify({'status': 'ok', 'message': 'Password changed successfully',
+                    'token': token, 'refresh_token': refresh_token})
+
 
-    return jsonify({'status': 'ok', 'message': 'Password changed successfully'})
+@auth_bp.route('/hash-stats', methods=['GET'])
+@require_auth
+def get_hash_stats():
+    """Admin: password hashing pool settings and counters for this worker."""
+    if g.current_user.role != ADMIN_ROLE:
+        return jsonify({'error': 'Only admins can view hashing stats'}), 403
+    return jsonify(get_hasher().stats())
+
+
+@auth_bp.route('/token-cache-stats', methods=['GET'])
+@require_auth
+def get_token_cache_stats():
+    """Admin: verified-token cache counters for this worker."""
+    if g.current_user.role != ADMIN_ROLE:
+        return jsonify({'error': 'Only admins can view token cache stats'}), 403
+    return jsonify(dict(token_cache_stats(), revocation_filter=revocation_filter.get_filter().stats()))
@@ -0,0 +1,90 @@
+from flask import Blueprint, current_app, jsonify, request, g
+from models import db, Broadcast, ADMIN_ROLE
+from auth_utils import require_auth
+import broadcaster
+import json
+
+broadcasts_bp = Blueprint('broadcasts', __name__, url_prefix='/api/v1/admin')
+
+BROADCAST_TYPES = ('alert', 'system')
+
+
+def admin_only():
+    if g.current_user.role != ADMIN_ROLE:
+        return jsonify({'error': 'Only admins can manage broadcasts'}), 403
+    return None
+
+
+@broadcasts_bp.route('/broadcasts', methods=['POST'])
+@require_auth
+def create_broadcast():
+    """Send a notification to every user in a segment.
+
+    Body: {title, description?, type?: alert|system, icon?, color?, link?,
+           segment?: {role?, location?, crops?: [...]}, dry_run?: bool}
+    Returns 202 with the queued broadcast; poll GET /admin/broadcasts/<id>
+    for progress. With dry_run only the recipient count is returned.
+    """
+    error = admin_only()
+    if error:
+        return error
+    data = request.json or {}
+    title = data.get('title') or ''
+    if not isinstance(title, str) or not title.strip():
+        return jsonify({'error': 'title is required'}), 400
+    title = title.strip()
+    if len(title) > 200:
+        return jsonify({'error': 'title must be at most 200 characters'}), 400
+    description = data.get('description') or ''
+    if not isinstance(description, str):
+        return jsonify({'error': 'description must be a string'}), 400
+    type = data.get('type', 'alert')
+    if type not in BROADCAST_TYPES:
+        return jsonify({'error': f'type must be one of: {", ".join(BROADCAST_TYPES)}'}), 400
+    segment, error = broadcaster.parse_segment(data.get('segment'))
+    if error:
+        return jsonify({'error': error}), 400
+
+    total = broadcaster.count_recipients(segment)
+    if data.get('dry_run'):
+        return jsonify({'segment': segment, 'recipients': total})
+
+    broadcast = Broadcast(
+        created_by=g.current_user.id,
+        type=type,
+        title=title,
+        description=description,
+        icon=data.get('icon') or 'ri-alarm-warning-line',
+        color=data.get('color') or 'bg-red-500',
+        link=data.get('link'),
+        segment=json.dumps(segment),
+        total=total,
+    )
+    db.session.add(broadcast)
+    db.session.commit()
+    broadcaster.start(current_app._get_current_object(), broadcast.id)
+    return jsonify({'broadcast': broadcast.to_dict()}), 202
+
+
+@broadcasts_bp.route('/broadcasts', methods=['GET'])
+@require_auth
+def list_broadcasts():
+    """Most recent broadcasts with their progress."""
+    error = admin_only()
+    if error:
+        return error
+    broadcasts = Broadcast.query.order_by(Broadcast.id.desc()).limit(50).all()
+    return jsonify({'broadcasts': [b.to_dict() for b in broadcasts]})
+
+
+@broadcasts_bp.route('/broadcasts/<int:broadcast_id>', methods=['GET'])
+@require_auth
+def get_broadcast(broadcast_id):
+    """Progress and throughput of one broadcast."""
+    error = admin_only()
+    if error:
+        return error
+    broadcast = db.session.get(Broadcast, broadcast_id)
+    if not broadcast:
+        return jsonify({'error': 'Broadcast not found'}), 404
+    return jsonify({'broadcast': broadcast.to_dict()})
@@ -4,6 +4,7 @@ from models import Consultation, User, db
 from datetime import datetime
 from auth_utils import require_auth, optional_auth
 from routes.notifications import create_notification
+from chat_gate import invalidate as invalidate_chat_gate
 
 dashboard_bp = Blueprint('dashboard', __name__, url_prefix='/api/v1')
 
@@ -175,6 +176,7 @@ def update_consultation(consultation_id):
 
     # Auto-generate notifications on status change
     if new_status and new_status != old_status:
+        invalidate_chat_gate(consultation.id)
         expert = User.query.get(consultation.expert_id) if consultation.expert_id else None
         client = User.query.get(consultation.client_id) if consultation.client_id else None
         expert_name = (expert.full_name if expert else None) or consultation.expert_name or 'Expert'
@@ -266,5 +268,6 @@ def cancel_consultation(consultation_id):
 
     db.session.delete(consultation)
     db.session.commit()
+    invalidate_chat_gate(consultation_id)
     
     return jsonify({'message': 'Consultation cancelled successfully'})
@@ -0,0 +1,70 @@
+from flask import Blueprint, Response, current_app, request, stream_with_context
+from models import db
+from auth_utils import authenticate, get_token_from_header
+from events import hub, format_sse
+import time
+
+events_bp = Blueprint('events', __name__, url_prefix='/api/v1')
+
+KEEPALIVE_SECONDS = 15  # comment line sent when nothing happened, keeps proxies from timing out
+STREAM_SECONDS = 300  # close the stream after this long; the browser reconnects with Last-Event-ID
+RETRY_MS = 3000  # reconnect delay suggested to EventSource
+
+
+@events_bp.route('/events', methods=['GET'])
+def stream_events():
+    """Server-Sent Events stream of everything addressed to the current user.
+
+    Event types: message, notification, typing, presence, resync.
+    EventSource can't set headers, so the token may also be passed as ?token=.
+    """
+    user, error = authenticate(get_token_from_header() or request.args.get('token'))
+    if error:
+        return error
+    user_id = user.id
+    # Don't pin a pooled DB connection for the lifetime of the stream
+    db.session.close()
+
+    keepalive = current_app.config.get('EVENTS_KEEPALIVE_SECONDS', KEEPALIVE_SECONDS)
+    duration = current_app.config.get('EVENTS_STREAM_SECONDS', STREAM_SECONDS)
+
+    resume_from = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_seq = hub.parse_id(resume_from)
+    if last_seq is None:
+        # Fresh connection (or one from a previous server process): start from now
+        backlog, complete = [], resume_from is None
+        last_seq = hub.last_seq
+    else:
+        backlog, complete = hub.events_since(user_id, last_seq)
+
+    def generate():
+        seq = last_seq
+        yield f'retry: {RETRY_MS}\n\n'
+        if not complete:
+            # Some events were missed; the client should refetch its lists
+            yield format_sse(hub.format_id(seq), 'resync', {})
+        for event in backlog:
+            yield format_sse(hub.format_id(event.seq), event.type, event.data)
+            seq = event.seq
+
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            events, caught_up = hub.wait(user_id, seq, min(keepalive, remaining))
+            if not caught_up:
+                seq = hub.last_seq
+                yield format_sse(hub.format_id(seq), 'resync', {})
+                continue
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                yield format_sse(hub.format_id(event.seq), event.type, event.data)
+                seq = event.seq
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # disable proxy buffering (nginx/Render)
+    })
@@ -1,39 +1,42 @@
 from flask import Blueprint, jsonify, request, g
-from models import db, Message, Consultation, User, Payment
+from models import db, Message, Consultation, User, Payment, ReadReceipt
 from auth_utils import require_auth
-from routes.notifications import create_notification
-import re
+from routes.notifications import create_notification, publish_notification
+from events import publish
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from contact_filter import check_for_contact_info, detector
+import search_index
+from chat_gate import get_gate, invalidate as invalidate_chat_gate
 
 messages_bp = Blueprint('messages', __name__, url_prefix='/api/v1')
 
-
-# Contact information detection patterns
-BLOCKED_PATTERNS = [
-    # Phone number patterns
-    (r'\b\d{10,}\b', 'phone number'),
-    (r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b', 'phone number'),
-    (r'\b\+\d{1,3}[-\s]?\d{6,}\b', 'phone number'),
-    (r'\b0\d{2}[-\s]?\d{3}[-\s]?\d{4}\b', 'phone number'),
-    (r'\b\(?\d{3}\)?[-\s]?\d{3}[-\s]?\d{4}\b', 'phone number'),
-    (r'\b\d{3}\s\d{3}\s\d{4}\b', 'phone number'),
-    # Messaging apps and contact requests
-    (r'whatsapp|telegram|signal|viber', 'messaging app reference'),
-    (r'call\s*me|text\s*me|phone|mobile', 'contact request'),
-    # Email patterns
-    (r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', 'email address'),
-    # Social media
-    (r'@[a-zA-Z0-9_]{3,}', 'social media handle'),
-    (r'facebook|instagram|twitter|snapchat|tiktok', 'social media reference'),
-]
-
-
-def check_for_contact_info(text):
-    """Check if text contains blocked contact information"""
-    text_lower = text.lower()
-    for pattern, reason in BLOCKED_PATTERNS:
-        if re.search(pattern, text_lower, re.IGNORECASE):
-            return True, reason
-    return False, None
+# Page sizes for keyset-paginated message history
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Messages accepted by one offline-queue batch upload
+MAX_BATCH_SIZE = 100
+# Message search results per page
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+
+def advance_read_watermark(consultation_id, user_id, message_id):
+    """Move a user's read watermark forward to message_id (never backwards)."""
+    updated = ReadReceipt.query.filter(
+        ReadReceipt.consultation_id == consultation_id,
+        ReadReceipt.user_id == user_id,
+        ReadReceipt.last_read_message_id < message_id,
+    ).update({'last_read_message_id': message_id}, synchronize_session=False)
+    if not updated and not ReadReceipt.query.filter_by(consultation_id=consultation_id, user_id=user_id).first():
+        db.session.add(ReadReceipt(consultation_id=consultation_id, user_id=user_id,
+                                   last_read_message_id=message_id))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request created the receipt first; advance that one instead
+        db.session.rollback()
+        advance_read_watermark(consultation_id, user_id, message_id)
 
 
 @messages_bp.route('/unread-counts', methods=['GET'])
@@ -42,28 +45,31 @@ def get_unread_counts():
     """Get unread message counts for the logged-in user"""
     user = g.current_user
     user_id = user.id
-    
-    # Get all consultations where user is involved
+
+    # Consultations where user is involved
     if user.role == 'Expert':
-        consultations = Consultation.query.filter_by(expert_id=user_id).all()
+        participant_filter = Consultation.expert_id == user_id
     else:
-        consultations = Consultation.query.filter_by(client_id=user_id).all()
-    
-    unread_by_consultation = {}
-    total_unread = 0
-    
-    for consultation in consultations:
-        # Count unread messages where sender is NOT the current user
-        unread_count = Message.query.filter(
-            Message.consultation_id == consultation.id,
-            Message.sender_id != user_id,
-            Message.read == False
-        ).count()
-        
-        if unread_count > 0:
-            unread_by_consultation[consultation.id] = unread_count
-            total_unread += unread_count
-    
+        participant_filter = Consultation.client_id == user_id
+
+    # One grouped query: messages from the other party above the user's read watermark
+    watermark = func.coalesce(ReadReceipt.last_read_message_id, 0)
+    rows = db.session.query(
+        Message.consultation_id, func.count(Message.id)
+    ).select_from(Consultation).outerjoin(
+        ReadReceipt,
+        (ReadReceipt.consultation_id == Consultation.id) & (ReadReceipt.user_id == user_id)
+    ).join(
+        Message, Message.consultation_id == Consultation.id
+    ).filter(
+        participant_filter,
+        Message.sender_id != user_id,
+        Message.id > watermark,
+    ).group_by(Message.consultation_id).all()
+
+    unread_by_consultation = {cid: count for cid, count in rows if count > 0}
+    total_unread = sum(unread_by_consultation.values())
+
     return jsonify({
         'total_unread': total_unread,
         'by_consultation': unread_by_consultation
@@ -73,7 +79,13 @@ def get_unread_counts():
 @messages_bp.route('/consultations/<int:consultation_id>/messages', methods=['GET'])
 @require_auth
 def get_messages(consultation_id):
-    """Get all messages for a consultation"""
+    """Get messages for a consultation.
+
+    Supports keyset pagination on message id:
+      ?after_id=<id>              only messages newer than <id> (incremental polling)
+      ?before_id=<id>&limit=<n>   the <n> messages just older than <id> (scrollback)
+    Without either parameter the whole history is returned.
+    """
     user = g.current_user
     user_id = user.id
     
@@ -84,27 +96,115 @@ def get_messages(consultation_id):
     # Verify user is part of this consultation
     if user_id not in [consultation.client_id, consultation.expert_id]:
         return jsonify({'error': 'Not authorized to view these messages'}), 403
+
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if before_id is not None and not limit:
+        limit = DEFAULT_PAGE_SIZE
+    if limit:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
     
-    # Mark all unread messages from the other person as read
-    Message.query.filter(
-        Message.consultation_id == consultation_id,
-        Message.sender_id != user_id,
-        Message.read == False
-    ).update({'read': True})
-    db.session.commit()
-    
-    messages = Message.query.filter_by(consultation_id=consultation_id).order_by(Message.timestamp.asc()).all()
-    
-    # Get sender usernames
+    query = Message.query.filter(Message.consultation_id == consultation_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    if before_id is not None:
+        # Walk backwards from the cursor, then flip back to chronological order
+        query = query.filter(Message.id < before_id).order_by(Message.id.desc())
+    else:
+        query = query.order_by(Message.id.asc())
+    if limit:
+        query = query.limit(limit + 1)
+    messages = query.all()
+
+    has_more = bool(limit) and len(messages) > limit
+    if has_more:
+        messages = messages[:limit]
+    if before_id is not None:
+        messages.reverse()
+
+    # Only two participants: resolve both senders in one query
+    participant_ids = [uid for uid in (consultation.client_id, consultation.expert_id) if uid]
+    senders = {
+        row.id: row for row in
+        db.session.query(User.id, User.username, User.role).filter(User.id.in_(participant_ids)).all()
+    }
+
+    # Read watermarks of both participants; only write when ours moves forward
+    watermarks = {
+        r.user_id: r.last_read_message_id for r in
+        ReadReceipt.query.filter_by(consultation_id=consultation_id).all()
+    }
+    newest_id = max((m.id for m in messages), default=0)
+    if newest_id > watermarks.get(user_id, 0):
+        advance_read_watermark(consultation_id, user_id, newest_id)
+        watermarks[user_id] = newest_id
+
     result = []
     for msg in messages:
-        sender = User.query.get(msg.sender_id)
+        sender = senders.get(msg.sender_id)
         msg_dict = msg.to_dict()
         msg_dict['sender_name'] = sender.username if sender else 'Unknown'
         msg_dict['sender_role'] = sender.role if sender else 'Unknown'
+        # A message is read once the participant who did not send it has seen it
+        reader_id = consultation.expert_id if msg.sender_id == consultation.client_id else consultation.client_id
+        msg_dict['read'] = msg.id <= watermarks.get(reader_id, 0)
         result.append(msg_dict)
     
-    return jsonify({'messages': result})
+    return jsonify({'messages': result, 'has_more': has_more})
+
+
+def check_chat_gate(consultation_id, sender_id):
+    """Return (gate, None) if sender may message in the consultation, else (None, error response)."""
+    gate = get_gate(consultation_id)
+    if not gate:
+        return None, (jsonify({'error': 'Consultation not found'}), 404)
+
+    if gate.status != 'accepted':
+        return None, (jsonify({'error': 'Consultation must be accepted before messaging'}), 403)
+
+    if not gate.paid:
+        return None, (jsonify({'error': 'Payment required before starting chat'}), 403)
+
+    if sender_id not in [gate.client_id, gate.expert_id]:
+        return None, (jsonify({'error': 'You are not part of this consultation'}), 403)
+    return gate, None
+
+
+def queue_message_notification(gate, user, consultation_id, last_text, count=1):
+    """Add the new-message notification for the OTHER party to the current transaction.
+
+    Rolls into the recipient's recent notification for this consultation
+    ("5 new messages from X") instead of adding a row per message. The
+    caller serializes the returned notification, commits and hands it to
+    publish_notification().
+    """
+    if user.id == gate.client_id:
+        recipient_id, recipient_role = gate.expert_id, gate.expert_role
+    else:
+        recipient_id, recipient_role = gate.client_id, gate.client_role
+    sender_display = user.full_name or user.username
+    preview = (last_text[:60] + '...') if len(last_text) > 60 else last_text
+    return create_notification(
+        user_id=recipient_id,
+        type='message',
+        title=f'New message from {sender_display}',
+        group_title='{count} new messages from ' + sender_display.replace('{', '{{').replace('}', '}}'),
+        count=count,
+        description=preview,
+        icon='ri-chat-3-line',
+        color='teal',
+        link='/expert-chats' if recipient_role == 'Expert' else '/chats',
+        ref_id=consultation_id,
+        commit=False,
+    )
+
+
+def _message_dict(message, user):
+    msg_dict = message.to_dict()
+    msg_dict['sender_name'] = user.username
+    msg_dict['sender_role'] = user.role
+    return msg_dict
 
 
 @messages_bp.route('/consultations/<int:consultation_id>/messages', methods=['POST'])
@@ -128,24 +228,12 @@ def send_message(consultation_id):
             'policy_violation': True
         }), 403
 
-    # Verify consultation exists and is accepted
-    consultation = Consultation.query.get(consultation_id)
-    if not consultation:
-        return jsonify({'error': 'Consultation not found'}), 404
-    
-    if consultation.status != 'accepted':
-        return jsonify({'error': 'Consultation must be accepted before messaging'}), 403
-
-    # Verify payment exists before allowing messages
-    payment = Payment.query.filter_by(consultation_id=consultation_id).first()
-    if not payment:
-        return jsonify({'error': 'Payment required before starting chat'}), 403
-
-    # Verify sender is part of the consultation
-    if sender_id not in [consultation.client_id, consultation.expert_id]:
-        return jsonify({'error': 'You are not part of this consultation'}), 403
+    # Verify consultation exists, is accepted and paid, and the sender takes part
+    gate, error = check_chat_gate(consultation_id, sender_id)
+    if error:
+        return error
 
-    # Create message
+    # Create message, and the notification in the same transaction
     message = Message(
         consultation_id=consultation_id,
         sender_id=sender_id,
@@ -155,47 +243,150 @@ def send_message(consultation_id):
         file_url=data.get('file_url'),
     )
     db.session.add(message)
+    notification = queue_message_notification(gate, user, consultation_id, message_text)
+
+    # Flush to get ids and defaults, serialize, then commit without a reload
+    db.session.flush()
+    search_index.index_messages(db.session, [message])
+    msg_dict = _message_dict(message, user)
+    notif_dict = notification.to_dict() if notification else None
     db.session.commit()
 
-    # Notify the OTHER party about the new message (throttled: max 1 per 2 min per consultation)
-    from routes.notifications import create_notification
-    from datetime import datetime, timedelta
-    recipient_id = consultation.expert_id if sender_id == consultation.client_id else consultation.client_id
-    recipient = User.query.get(recipient_id)
-    sender_display = user.full_name or user.username
-    preview = (message_text[:60] + '...') if len(message_text) > 60 else message_text
+    publish([gate.client_id, gate.expert_id], 'message', msg_dict)
+    if notif_dict:
+        publish_notification(notif_dict)
 
-    # Check if a message notification for this consultation was sent recently
-    from models import Notification
-    recent_notif = Notification.query.filter_by(
-        user_id=recipient_id,
-        type='message',
-        ref_id=consultation.id,
-    ).order_by(Notification.created_at.desc()).first()
+    return jsonify({'status': 'ok', 'message': msg_dict}), 201
 
-    should_notify = True
-    if recent_notif and recent_notif.created_at:
-        if (datetime.utcnow() - recent_notif.created_at).total_seconds() < 120:
-            should_notify = False
 
-    if should_notify:
-        create_notification(
-            user_id=recipient_id,
-            type='message',
-            title=f'New message from {sender_display}',
-            description=preview,
-            icon='ri-chat-3-line',
-            color='teal',
-            link='/expert-chats' if (recipient and recipient.role == 'Expert') else '/chats',
-            ref_id=consultation.id,
-        )
+@messages_bp.route('/consultations/<int:consultation_id>/messages/batch', methods=['POST'])
+@require_auth
+def send_message_batch(consultation_id):
+    """Upload messages queued offline, in order, in one transaction.
+
+    Body: {"messages": [{"client_key": "...", "message": "...", "message_type": ...,
+    "file_name": ..., "file_url": ...}, ...]}. client_key is generated by the
+    client and makes retries idempotent: a key already stored for this sender
+    returns the existing message instead of inserting it again.
+
+    Each item gets a result: created, duplicate or blocked (contact info).
+    Blocked items are skipped; the rest are stored. ids maps every client_key
+    to its server message id (null when blocked).
+    """
+    user = g.current_user
+    sender_id = user.id
 
-    # Return message with sender info
-    msg_dict = message.to_dict()
-    msg_dict['sender_name'] = user.username
-    msg_dict['sender_role'] = user.role
+    data = request.json or {}
+    items = data.get('messages')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'messages must be a non-empty list'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} messages per batch'}), 400
+    for item in items:
+        if not isinstance(item, dict) or not item.get('message'):
+            return jsonify({'error': 'Every item needs a message'}), 400
+        key = item.get('client_key')
+        if not isinstance(key, str) or not key or len(key) > 64:
+            return jsonify({'error': 'Every item needs a client_key of at most 64 characters'}), 400
+
+    gate, error = check_chat_gate(consultation_id, sender_id)
+    if error:
+        return error
+
+    verdicts = detector.scan_many(item['message'] for item in items)
+
+    for attempt in range(2):
+        keys = {item['client_key'] for item in items}
+        existing = dict(db.session.query(Message.client_key, Message.id).filter(
+            Message.consultation_id == consultation_id,
+            Message.sender_id == sender_id,
+            Message.client_key.in_(keys),
+        ).all())
+
+        results, created, pending = [], [], {}
+        for item, (is_blocked, reason) in zip(items, verdicts):
+            key = item['client_key']
+            if is_blocked:
+                results.append({'client_key': key, 'status': 'blocked', 'id': None,
+                                'reason': f'Message blocked: contains {reason}.'})
+            elif key in existing:
+                results.append({'client_key': key, 'status': 'duplicate', 'id': existing[key]})
+            elif key in pending:
+                # Repeated within this batch: same message as the first occurrence
+                results.append({'client_key': key, 'status': 'duplicate', 'message': pending[key]})
+            else:
+                message = Message(
+                    consultation_id=consultation_id,
+                    sender_id=sender_id,
+                    message=item['message'],
+                    message_type=item.get('message_type', 'text'),
+                    file_name=item.get('file_name'),
+                    file_url=item.get('file_url'),
+                    client_key=key,
+                )
+                pending[key] = message
+                created.append(message)
+                results.append({'client_key': key, 'status': 'created', 'message': message})
+
+        db.session.add_all(created)
+        try:
+            db.session.flush()
+            break
+        except IntegrityError:
+            # A concurrent retry of the same batch stored some keys first; re-read them
+            db.session.rollback()
+            if attempt:
+                raise
+
+    # One coalesced notification for the whole batch
+    notification = None
+    if created:
+        search_index.index_messages(db.session, created)
+        notification = queue_message_notification(gate, user, consultation_id,
+                                                  created[-1].message, count=len(created))
+        db.session.flush()
+
+    msg_dicts = [_message_dict(message, user) for message in created]
+    notif_dict = notification.to_dict() if notification else None
+    for result in results:
+        message = result.pop('message', None)
+        if message is not None:
+            result['id'] = message.id
+    db.session.commit()
 
-    return jsonify({'status': 'ok', 'message': msg_dict}), 201
+    for msg_dict in msg_dicts:
+        publish([gate.client_id, gate.expert_id], 'message', msg_dict)
+    if notif_dict:
+        publish_notification(notif_dict)
+
+    return jsonify({
+        'status': 'ok',
+        'results': results,
+        'ids': {result['client_key']: result['id'] for result in results},
+        'messages': msg_dicts,
+    }), 201 if created else 200
+
+
+@messages_bp.route('/messages/search', methods=['GET'])
+@require_auth
+def search_messages():
+    """Full-text search across the current user's consultations.
+
+    Query params: q (required), consultation_id (optional), limit (default 20,
+    max 100), offset. Results are ranked best match first; snippets are
+    HTML-escaped with matched terms wrapped in <mark>.
+    """
+    user = g.current_user
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), MAX_SEARCH_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    results = search_index.search(db.session, user.id, query,
+                                  consultation_id=request.args.get('consultation_id', type=int),
+                                  limit=limit, offset=offset)
+    return jsonify({'query': query, 'results': results, 'has_more': len(results) == limit})
 
 
 @messages_bp.route('/messages/<int:message_id>', methods=['DELETE'])
@@ -212,7 +403,13 @@ def delete_message(message_id):
     message.message = ''
     message.file_url = None
     message.file_name = None
+    search_index.remove_messages(db.session, [message.id])
     db.session.commit()
+
+    consultation = Consultation.query.get(message.consultation_id)
+    if consultation:
+        publish([consultation.client_id, consultation.expert_id], 'message_deleted',
+                {'id': message.id, 'consultation_id': message.consultation_id})
     return jsonify({'status': 'ok'})
 
 
@@ -257,6 +454,7 @@ def create_payment():
     )
     db.session.add(payment)
     db.session.commit()
+    invalidate_chat_gate(consultation_id)
 
     # Notify the expert about the payment
     if consultation.expert_id:
@@ -1,49 +1,262 @@
-from flask import Blueprint, jsonify, request, g
-from models import db, Notification
+from flask import Blueprint, current_app, has_app_context, jsonify, request, g
+from models import db, Notification, NotificationCounter, serialize_notification, ADMIN_ROLE
 from auth_utils import require_auth
+from events import publish
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from notification_dispatcher import get_dispatcher
+from collections import OrderedDict, namedtuple
+import event_bus
+import notification_prefs
+import threading
+import json
 
 notifications_bp = Blueprint('notifications', __name__, url_prefix='/api/v1')
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Columns the feed needs; selected as plain rows instead of ORM objects
+NOTIFICATION_COLUMNS = [
+    Notification.id, Notification.user_id, Notification.type, Notification.title,
+    Notification.description, Notification.icon, Notification.color, Notification.read,
+    Notification.link, Notification.ref_id, Notification.created_at, Notification.count,
+]
 
-def create_notification(user_id, type, title, description='', icon='ri-notification-3-line', color='bg-teal-500', link=None, ref_id=None):
-    """Helper: create a notification for a user. Can be called from other routes."""
-    n = Notification(
-        user_id=user_id,
-        type=type,
-        title=title,
-        description=description,
-        icon=icon,
-        color=color,
-        link=link,
-        ref_id=ref_id,
-    )
+
+# Seconds within which another event with the same (user, type, ref_id)
+# updates the existing notification instead of adding a row. 0 = never.
+# Override per type with the NOTIFICATION_COALESCE_WINDOWS config dict.
+COALESCE_WINDOWS = {
+    'message': 3600,  # "5 new messages from X", per consultation
+    'consultation': 86400,  # status changes of one consultation replace each other
+}
+
+
+MAX_ROLLING_ENTRIES = 50000
+
+# The newest notification per (user_id, type, ref_id), as last published on
+# the 'events' channel by any worker, so coalescing into it is one UPDATE by
+# id without reading the notifications table first. It is only a hint: the
+# UPDATE also checks read and count, and falls back to a query when a mark
+# as read, a delete or another worker got there first.
+Rolling = namedtuple('Rolling', ['id', 'read', 'count', 'created_at'])
+_rolling = OrderedDict()  # (user_id, type, ref_id) -> Rolling
+_rolling_lock = threading.Lock()
+
+
+def coalesce_window(type):
+    overrides = (current_app.config.get('NOTIFICATION_COALESCE_WINDOWS') or {}) if has_app_context() else {}
+    return overrides.get(type, COALESCE_WINDOWS.get(type, 0))
+
+
+def create_notification(user_id, type, title, description='', icon='ri-notification-3-line', color='bg-teal-500', link=None, ref_id=None, commit=True, group_title=None, count=1):
+    """Helper: create a notification for a user. Can be called from other routes.
+
+    Events of a coalescing type (see COALESCE_WINDOWS) roll into the user's
+    recent notification for the same type and ref_id. group_title, e.g.
+    '{count} new messages from Ann', is used once more than one event has
+    been rolled in; count is how many events this call stands for.
+
+    With commit=False the notification joins the caller's transaction; the
+    caller flushes, takes to_dict(), commits and then passes that to
+    publish_notification(). Otherwise, when the
+    write-behind dispatcher is active, the notification is queued and written
+    a few milliseconds later together with others, and None is returned.
+
+    Types the user has turned off in their preferences are dropped before
+    anything is written, also returning None.
+    """
+    if not notification_prefs.allows(user_id, type):
+        return None
+    fields = {
+        'user_id': user_id, 'type': type, 'title': title, 'description': description,
+        'icon': icon, 'color': color, 'link': link, 'ref_id': ref_id,
+    }
+    dispatcher = get_dispatcher() if commit else None
+    if dispatcher is not None:
+        dispatcher.enqueue(dict(fields, read=False, group_title=group_title, count=count,
+                                created_at=datetime.utcnow().isoformat()))
+        return None
+
+    n = add_notification(fields, group_title=group_title, count=count)
+    if commit:
+        db.session.flush()
+        data = n.to_dict()
+        db.session.commit()
+        publish_notification(data)
+    return n
+
+
+def add_notification(fields, group_title=None, count=1, now=None):
+    """Insert a notification, or coalesce it into a recent one; in the caller's transaction.
+
+    Returns the Notification that now carries the event, with the unread
+    counter already adjusted. A coalesced one is a transient copy built from
+    the values written, not a row loaded into the session.
+    """
+    now = now or datetime.utcnow()
+    window = coalesce_window(fields['type']) if fields.get('ref_id') is not None else 0
+    if window:
+        n = _coalesce(fields, group_title, count, now, window)
+        if n is not None:
+            return n
+    n = Notification(created_at=now, count=count,
+                     **dict(fields, title=notification_title(fields['title'], group_title, count)))
     db.session.add(n)
-    db.session.commit()
+    adjust_unread(fields['user_id'], 1)
     return n
 
 
+def notification_title(title, group_title, count):
+    """group_title for a notification carrying several events, else title."""
+    return group_title.format(count=count) if group_title and count > 1 else title
+
+
+def _coalesce(fields, group_title, count, now, window):
+    key = (fields['user_id'], fields['type'], fields['ref_id'])
+    with _rolling_lock:
+        latest = _rolling.get(key)
+    if latest is None or latest.created_at < now - timedelta(seconds=window) \
+            or not _roll_into(fields, latest, group_title, count, now):
+        latest = db.session.query(Notification.id, Notification.read, Notification.count).filter(
+            Notification.user_id == fields['user_id'],
+            Notification.type == fields['type'],
+            Notification.ref_id == fields['ref_id'],
+            Notification.created_at >= now - timedelta(seconds=window),
+        ).order_by(Notification.created_at.desc(), Notification.id.desc()).first()
+        if latest is None or not _roll_into(fields, latest, group_title, count, now):
+            return None
+    restarted = latest.read
+    total = count if restarted else latest.count + count
+    if restarted:
+        adjust_unread(fields['user_id'], 1)
+    # Built from known values; reloading the row would cost another query
+    return Notification(id=latest.id, read=False, count=total, created_at=now,
+                        **dict(fields, title=notification_title(fields['title'], group_title, total)))
+
+
+def _roll_into(fields, latest, group_title, count, now):
+    """One conditional UPDATE of latest; False if it was read, deleted or coalesced into meanwhile."""
+    total = count if latest.read else latest.count + count
+    # Read already: the user has seen the earlier events, start counting again
+    return Notification.query.filter_by(
+        id=latest.id, user_id=fields['user_id'], type=fields['type'], ref_id=fields['ref_id'],
+        read=latest.read, count=latest.count,
+    ).update({'description': fields['description'], 'icon': fields['icon'], 'color': fields['color'],
+              'link': fields['link'], 'created_at': now, 'read': False, 'count': total,
+              'title': notification_title(fields['title'], group_title, total)},
+             synchronize_session=False) == 1
+
+
+def _on_event(event_id, payload):
+    # Every worker learns the newest notification per key from what is published
+    data = payload.get('data') or {}
+    if payload.get('type') != 'notification' or data.get('id') is None or data.get('ref_id') is None:
+        return
+    key = (data['user_id'], data['type'], data['ref_id'])
+    latest = Rolling(data['id'], data['read'], data.get('count', 1), datetime.fromisoformat(data['created_at']))
+    with _rolling_lock:
+        _rolling[key] = latest
+        _rolling.move_to_end(key)
+        while len(_rolling) > MAX_ROLLING_ENTRIES:
+            _rolling.popitem(last=False)
+
+
+def _on_resync(event_id, payload):
+    with _rolling_lock:
+        _rolling.clear()
+
+
+event_bus.subscribe('events', _on_event)
+event_bus.subscribe(event_bus.RESYNC, _on_resync)
+
+
+def publish_notification(data):
+    """Push a committed notification, as serialized before the commit, to its user's event stream."""
+    publish([data['user_id']], 'notification', data)
+
+
+def adjust_unread(user_id, delta):
+    """Add delta to the user's unread counter, in the caller's transaction.
+
+    A user without a counter row is left alone: the row is seeded from a
+    COUNT the next time the badge is read, which already includes this change.
+    """
+    if delta:
+        NotificationCounter.query.filter_by(user_id=user_id).update(
+            {NotificationCounter.unread: NotificationCounter.unread + delta}, synchronize_session=False)
+
+
+def get_unread(user_id):
+    """O(1) unread count from the counter row, seeding it on first use."""
+    unread = db.session.query(NotificationCounter.unread).filter_by(user_id=user_id).scalar()
+    if unread is not None:
+        return max(unread, 0)
+    try:
+        db.session.execute(NotificationCounter.__table__.insert().from_select(
+            ['user_id', 'unread'],
+            db.select(db.literal(user_id), func.count(Notification.id)).where(
+                Notification.user_id == user_id, Notification.read == False)  # noqa: E712
+        ))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # seeded concurrently
+    return db.session.query(NotificationCounter.unread).filter_by(user_id=user_id).scalar() or 0
+
+
+def parse_cursor(value):
+    """'<created_at ISO>,<id>' -> (datetime, id), or None if malformed."""
+    try:
+        created_at, _, nid = value.rpartition(',')
+        return datetime.fromisoformat(created_at), int(nid)
+    except (TypeError, ValueError):
+        return None
+
+
 @notifications_bp.route('/notifications', methods=['GET'])
 @require_auth
 def get_notifications():
-    """Get all notifications for the current user, newest first."""
+    """Get notifications for the current user, newest first.
+
+    Keyset pagination: pass the next_before value of the previous page as
+    ?before=<created_at>,<id>. ?page= (offset paging) is still accepted.
+    """
     user = g.current_user
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 50, type=int)
+    per_page = max(1, min(request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
     filter_type = request.args.get('type', None)
+    before = request.args.get('before')
 
-    query = Notification.query.filter_by(user_id=user.id)
+    query = db.session.query(*NOTIFICATION_COLUMNS).filter(Notification.user_id == user.id)
     if filter_type and filter_type != 'all':
         if filter_type == 'unread':
-            query = query.filter_by(read=False)
+            query = query.filter(Notification.read == False)  # noqa: E712
         else:
-            query = query.filter_by(type=filter_type)
+            query = query.filter(Notification.type == filter_type)
 
-    notifications = query.order_by(Notification.created_at.desc()).limit(per_page).offset((page - 1) * per_page).all()
-    unread_count = Notification.query.filter_by(user_id=user.id, read=False).count()
+    if before:
+        cursor = parse_cursor(before)
+        if cursor is None:
+            return jsonify({'error': 'before must be "<created_at>,<id>"'}), 400
+        created_at, nid = cursor
+        # Row-value comparison, so the index range scan starts right at the cursor
+        query = query.filter(tuple_(Notification.created_at, Notification.id) < tuple_(created_at, nid))
+    query = query.order_by(Notification.created_at.desc(), Notification.id.desc()).limit(per_page + 1)
+    if not before and page > 1:
+        query = query.offset((page - 1) * per_page)
+    rows = query.all()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    now = datetime.utcnow()
+    last = rows[-1] if rows else None
 
     return jsonify({
-        'notifications': [n.to_dict() for n in notifications],
-        'unread_count': unread_count,
+        'notifications': [serialize_notification(row, now) for row in rows],
+        'unread_count': get_unread(user.id),
+        'has_more': has_more,
+        'next_before': f'{last.created_at.isoformat()},{last.id}' if has_more else None,
     })
 
 
@@ -52,8 +265,46 @@ def get_notifications():
 def get_unread_count():
     """Quick endpoint for badge count."""
     user = g.current_user
-    count = Notification.query.filter_by(user_id=user.id, read=False).count()
-    return jsonify({'unread_count': count})
+    return jsonify({'unread_count': get_unread(user.id)})
+
+
+@notifications_bp.route('/notifications/preferences', methods=['GET'])
+@require_auth
+def get_preferences():
+    """Which notification types the current user receives."""
+    user = g.current_user
+    return jsonify({'preferences': notification_prefs.expand(notification_prefs.compile_prefs(user.notification_prefs))})
+
+
+@notifications_bp.route('/notifications/preferences', methods=['PUT'])
+@require_auth
+def update_preferences():
+    """Turn notification types on or off. Body: {"message": false, ...}; omitted types are unchanged."""
+    user = g.current_user.load()
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Body must be an object of type: true/false'}), 400
+    unknown = set(data) - set(notification_prefs.TYPE_BITS)
+    if unknown:
+        return jsonify({'error': f'Unknown notification types: {", ".join(sorted(unknown))}'}), 400
+    if not all(isinstance(v, bool) for v in data.values()):
+        return jsonify({'error': 'Preference values must be true or false'}), 400
+
+    prefs = notification_prefs.expand(notification_prefs.compile_prefs(user.notification_prefs))
+    prefs.update(data)
+    user.notification_prefs = json.dumps(prefs)
+    db.session.commit()
+    notification_prefs.invalidate(user.id)
+    return jsonify({'preferences': notification_prefs.expand(notification_prefs.compile_prefs(user.notification_prefs))})
+
+
+@notifications_bp.route('/notifications/dropped', methods=['GET'])
+@require_auth
+def get_dropped_counts():
+    """Admin: notifications suppressed by user preferences, per type, in this worker."""
+    if g.current_user.role != ADMIN_ROLE:
+        return jsonify({'error': 'Only admins can view notification stats'}), 403
+    return jsonify({'dropped': notification_prefs.dropped_counts()})
 
 
 @notifications_bp.route('/notifications/<int:notification_id>/read', methods=['PUT'])
@@ -61,10 +312,13 @@ def get_unread_count():
 def mark_read(notification_id):
     """Mark a single notification as read."""
     user = g.current_user
-    n = Notification.query.filter_by(id=notification_id, user_id=user.id).first()
-    if not n:
+    # Conditional UPDATE so concurrent requests can't both decrement the counter
+    updated = Notification.query.filter_by(id=notification_id, user_id=user.id, read=False).update(
+        {'read': True}, synchronize_session=False)
+    if updated:
+        adjust_unread(user.id, -1)
+    elif not Notification.query.filter_by(id=notification_id, user_id=user.id).first():
         return jsonify({'error': 'Notification not found'}), 404
-    n.read = True
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -74,7 +328,8 @@ def mark_read(notification_id):
 def mark_all_read():
     """Mark all notifications as read for the current user."""
     user = g.current_user
-    Notification.query.filter_by(user_id=user.id, read=False).update({'read': True})
+    updated = Notification.query.filter_by(user_id=user.id, read=False).update({'read': True})
+    adjust_unread(user.id, -updated)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -84,9 +339,9 @@ def mark_all_read():
 def delete_notification(notification_id):
     """Delete a single notification."""
     user = g.current_user
-    n = Notification.query.filter_by(id=notification_id, user_id=user.id).first()
-    if not n:
+    if Notification.query.filter_by(id=notification_id, user_id=user.id, read=False).delete():
+        adjust_unread(user.id, -1)
+    elif not Notification.query.filter_by(id=notification_id, user_id=user.id).delete():
         return jsonify({'error': 'Notification not found'}), 404
-    db.session.delete(n)
     db.session.commit()
     return jsonify({'status': 'ok'})
@@ -1,41 +1,116 @@
 from flask import Blueprint, jsonify, request, g
-from models import db, User
+from models import db, User, Consultation
 from auth_utils import require_auth
-from datetime import datetime, timedelta
+from events import publish
+from datetime import datetime
+import event_bus
+import time
+from presence_store import get_store
+from chat_gate import get_gate
+from typing_store import TypingStore, TYPING_TIMEOUT
 
 presence_bp = Blueprint('presence', __name__, url_prefix='/api/v1')
 
-# In-memory typing status: { (consultation_id, user_id): datetime }
-_typing_map = {}
-TYPING_TIMEOUT = 4  # seconds before "typing" expires
+# Who is typing where; every worker keeps its own store, fed from the 'typing' bus channel
+typing_state = TypingStore()
+ONLINE_WINDOW = 120  # seconds since last heartbeat a user still counts as online
+MAX_BATCH_IDS = 200  # users / consultations per batch request
+
+
+def _on_typing(event_id, payload):
+    typing_state.touch(payload['consultation_id'], payload['user_id'], payload['ts'])
+
+
+def parse_ids(values):
+    """List of ints from a JSON list or 'a,b,c' string; None if malformed or too long."""
+    if isinstance(values, str):
+        values = [v for v in values.split(',') if v.strip()]
+    if not isinstance(values, list) or len(values) > MAX_BATCH_IDS:
+        return None
+    try:
+        return list(dict.fromkeys(int(v) for v in values))
+    except (TypeError, ValueError):
+        return None
+
+
+event_bus.subscribe('typing', _on_typing)
+
+
+def counterpart_ids(user_id):
+    """Users who share at least one consultation with user_id."""
+    rows = db.session.query(Consultation.client_id, Consultation.expert_id).filter(
+        (Consultation.client_id == user_id) | (Consultation.expert_id == user_id)
+    ).distinct().all()
+    return {uid for row in rows for uid in row if uid and uid != user_id}
 
 
 @presence_bp.route('/presence/heartbeat', methods=['POST'])
 @require_auth
 def heartbeat():
-    """Called periodically by the frontend to signal the user is online."""
+    """Called periodically by the frontend to signal the user is online.
+
+    Recorded in memory; users.last_seen is updated in batches (presence_store.py).
+    """
     user = g.current_user
-    user.last_seen = datetime.utcnow()
-    db.session.commit()
+    now = datetime.utcnow()
+    previous = get_store().touch(user.id, now)
+    if previous is None:
+        previous = db.session.query(User.last_seen).filter_by(id=user.id).scalar()
+    was_online = previous and (now - previous).total_seconds() < ONLINE_WINDOW
+
+    if not was_online:
+        publish(counterpart_ids(user.id), 'presence', {
+            'user_id': user.id,
+            'online': True,
+            'last_seen_utc': now.isoformat() + 'Z',
+        })
     return jsonify({'status': 'ok'})
 
 
+def last_seen_many(user_ids):
+    """{user_id: latest heartbeat or None}: the hot table first, one query for the rest."""
+    store, now = get_store(), datetime.utcnow()
+    seen = {uid: store.last_seen(uid) for uid in user_ids}
+    stale = [uid for uid, ts in seen.items() if not ts or (now - ts).total_seconds() >= ONLINE_WINDOW]
+    if stale:
+        for uid, stored in db.session.query(User.id, User.last_seen).filter(User.id.in_(stale)):
+            seen[uid] = max(filter(None, (seen[uid], stored)), default=None)
+    return seen
+
+
+def presence_dict(seen, now):
+    if not seen:
+        return {'online': False, 'last_seen_utc': None}
+    return {
+        'online': (now - seen).total_seconds() < ONLINE_WINDOW,
+        'last_seen_utc': seen.isoformat() + 'Z',
+    }
+
+
 @presence_bp.route('/presence/status/<int:user_id>', methods=['GET'])
 @require_auth
 def get_status(user_id):
     """Return online/last-seen for a given user."""
-    target = User.query.get(user_id)
-    if not target or not target.last_seen:
-        return jsonify({'online': False, 'last_seen_utc': None})
+    return jsonify(presence_dict(last_seen_many([user_id])[user_id], datetime.utcnow()))
 
-    now = datetime.utcnow()
-    diff = now - target.last_seen
-    online = diff.total_seconds() < 120
 
-    return jsonify({
-        'online': online,
-        'last_seen_utc': target.last_seen.isoformat() + 'Z'
-    })
+@presence_bp.route('/presence/status:batch', methods=['POST'])
+@require_auth
+def get_status_batch():
+    """Online/last-seen for many users at once. Body: {"user_ids": [...]}.
+
+    Returns {"statuses": {"<user_id>": {online, last_seen_utc}}} for the ids
+    that share a consultation with the caller; the others are left out.
+    Served from the hot table plus at most two queries.
+    """
+    data = request.get_json(silent=True) or {}
+    user_ids = parse_ids(data.get('user_ids'))
+    if user_ids is None:
+        return jsonify({'error': f'user_ids must be a list of at most {MAX_BATCH_IDS} ids'}), 400
+    visible = counterpart_ids(g.current_user.id) | {g.current_user.id}
+    user_ids = [uid for uid in user_ids if uid in visible]
+    now = datetime.utcnow()
+    return jsonify({'statuses': {str(uid): presence_dict(seen, now) for uid, seen in last_seen_many(user_ids).items()}})
 
 
 @presence_bp.route('/presence/typing', methods=['POST'])
@@ -43,10 +118,32 @@ def get_status(user_id):
 def set_typing():
     """Signal that the current user is typing in a consultation."""
     data = request.get_json(silent=True) or {}
-    consultation_id = data.get('consultation_id')
-    if not consultation_id:
-        return jsonify({'error': 'consultation_id required'}), 400
-    _typing_map[(int(consultation_id), g.current_user.id)] = datetime.utcnow()
+    ids = parse_ids([data['consultation_id']]) if data.get('consultation_id') else None
+    if not ids:
+        return jsonify({'error': 'consultation_id must be a consultation id'}), 400
+    me = g.current_user.id
+    gate = get_gate(ids[0])
+    if not gate:
+        return jsonify({'error': 'Consultation not found'}), 404
+    if me not in (gate.client_id, gate.expert_id):
+        return jsonify({'error': 'You are not part of this consultation'}), 403
+    key = (ids[0], me)
+    now = time.time()
+    was_typing = typing_state.is_typing(*key, now)
+    event_bus.publish('typing', {
+        'consultation_id': key[0],
+        'user_id': key[1],
+        'ts': now,
+    })
+
+    # Only push the start of a typing burst; clients expire it after TYPING_TIMEOUT
+    other_id = gate.expert_id if me == gate.client_id else gate.client_id
+    if not was_typing and other_id:
+        publish([other_id], 'typing', {
+            'consultation_id': key[0],
+            'user_id': me,
+            'expires_in': TYPING_TIMEOUT,
+        })
     return jsonify({'status': 'ok'})
 
 
@@ -54,7 +151,25 @@ def set_typing():
 @require_auth
 def get_typing(consultation_id, user_id):
     """Check if a specific user is currently typing in a consultation."""
-    ts = _typing_map.get((consultation_id, user_id))
-    if ts and (datetime.utcnow() - ts).total_seconds() < TYPING_TIMEOUT:
-        return jsonify({'typing': True})
-    return jsonify({'typing': False})
+    return jsonify({'typing': typing_state.is_typing(consultation_id, user_id)})
+
+
+@presence_bp.route('/presence/typing', methods=['GET'])
+@require_auth
+def get_typing_batch():
+    """Who is typing in each of ?consultation_ids=1,2,3 (other than the caller).
+
+    Returns {"typing": {"<consultation_id>": [user_id, ...]}} from memory, for
+    the consultations the caller takes part in (one query); others are left out.
+    """
+    consultation_ids = parse_ids(request.args.get('consultation_ids', ''))
+    if consultation_ids is None:
+        return jsonify({'error': f'consultation_ids must be at most {MAX_BATCH_IDS} comma-separated ids'}), 400
+    now, me = time.time(), g.current_user.id
+    if consultation_ids:
+        consultation_ids = [cid for (cid,) in db.session.query(Consultation.id).filter(
+            Consultation.id.in_(consultation_ids),
+            (Consultation.client_id == me) | (Consultation.expert_id == me))]
+    return jsonify({'typing': {
+        str(cid): [uid for uid in typing_state.typing_users(cid, now) if uid != me] for cid in consultation_ids
+    }})
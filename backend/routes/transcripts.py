@@ -0,0 +1,192 @@
+from flask import Blueprint, Response, current_app, g, jsonify, redirect, request, stream_with_context
+from models import db, Consultation, Message, User
+from auth_utils import require_auth
+from sqlalchemy import select
+from urllib.parse import quote, urlparse
+import base64
+import binascii
+import csv
+import io
+import json
+import re
+
+transcripts_bp = Blueprint('transcripts', __name__, url_prefix='/api/v1')
+
+TRANSCRIPT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'txt': 'text/plain',
+}
+FETCH_BATCH = 500  # rows per round trip from the server-side cursor
+CSV_COLUMNS = ['id', 'timestamp', 'sender_id', 'sender_name', 'sender_role', 'message_type',
+               'message', 'file_name', 'attachment', 'deleted']
+# Types an inline attachment keeps when downloaded; anything else (text/html,
+# image/svg+xml, ...) is sent as application/octet-stream
+ATTACHMENT_TYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'application/pdf', 'text/plain', 'text/csv',
+    'audio/mpeg', 'audio/ogg', 'audio/wav', 'video/mp4',
+}
+
+
+def attachment_url(message_id):
+    return f'/api/v1/messages/{message_id}/attachment'
+
+
+def is_allowed_redirect(url):
+    """A path on this site, or an http(s) URL on one of the ATTACHMENT_HOSTS."""
+    parsed = urlparse(url)
+    if not parsed.scheme and not parsed.netloc:
+        return url.startswith('/') and not url.startswith(('//', '/\\'))
+    hosts = current_app.config.get('ATTACHMENT_HOSTS') or ()
+    return parsed.scheme in ('http', 'https') and parsed.hostname in hosts
+
+
+def content_disposition(filename):
+    """attachment header with an ASCII fallback name and the RFC 5987 UTF-8 one."""
+    filename = re.sub(r'[\x00-\x1f\x7f]', '', filename).strip() or 'attachment'
+    fallback = filename.encode('ascii', 'replace').decode().replace('?', '_').replace('"', '').replace('\\', '')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+@transcripts_bp.route('/consultations/<int:consultation_id>/transcript', methods=['GET'])
+@require_auth
+def export_transcript(consultation_id):
+    """Stream the full chat history of a consultation.
+
+    Query params: format=jsonl|csv|txt (default jsonl), attachments=reference|inline.
+    Rows come from a server-side cursor and are written out one at a time, so
+    memory use doesn't grow with the conversation. Attachments are referenced
+    by their /messages/<id>/attachment URL unless attachments=inline.
+    """
+    user_id = g.current_user.id
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in TRANSCRIPT_FORMATS:
+        return jsonify({'error': f'format must be one of: {", ".join(TRANSCRIPT_FORMATS)}'}), 400
+    inline = request.args.get('attachments', 'reference') == 'inline'
+
+    consultation = Consultation.query.get(consultation_id)
+    if not consultation:
+        return jsonify({'error': 'Consultation not found'}), 404
+    if user_id not in [consultation.client_id, consultation.expert_id]:
+        return jsonify({'error': 'Not authorized to view these messages'}), 403
+
+    participant_ids = [uid for uid in (consultation.client_id, consultation.expert_id) if uid]
+    senders = {
+        row.id: (row.username, row.role) for row in
+        db.session.query(User.id, User.username, User.role).filter(User.id.in_(participant_ids)).all()
+    }
+    # The stream uses its own connection; don't keep the session's one checked out
+    db.session.close()
+
+    columns = [Message.id, Message.sender_id, Message.message, Message.message_type,
+               Message.file_name, Message.timestamp, Message.deleted,
+               (Message.file_url.isnot(None)).label('has_file')]
+    if inline:
+        columns.append(Message.file_url)
+    stmt = select(*columns).where(Message.consultation_id == consultation_id).order_by(Message.id)
+    write_row = {'jsonl': _jsonl_row, 'csv': _csv_writer(), 'txt': _txt_row}[fmt]
+
+    def generate():
+        if fmt == 'csv':
+            yield write_row(CSV_COLUMNS)
+        with db.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=FETCH_BATCH).execute(stmt)
+            for row in result:
+                sender_name, sender_role = senders.get(row.sender_id, ('Unknown', 'Unknown'))
+                if row.deleted:
+                    attachment = None
+                elif inline:
+                    attachment = row.file_url
+                else:
+                    attachment = attachment_url(row.id) if row.has_file else None
+                yield write_row({
+                    'id': row.id,
+                    'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+                    'sender_id': row.sender_id,
+                    'sender_name': sender_name,
+                    'sender_role': sender_role,
+                    'message_type': row.message_type or 'text',
+                    'message': row.message if not row.deleted else '',
+                    'file_name': row.file_name if not row.deleted else None,
+                    'attachment': attachment,
+                    'deleted': bool(row.deleted),
+                })
+
+    return Response(stream_with_context(generate()), mimetype=TRANSCRIPT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="consultation-{consultation_id}.{fmt}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def _jsonl_row(row):
+    return json.dumps(row) + '\n'
+
+
+def _csv_writer():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def write_row(row):
+        writer.writerow(row if isinstance(row, list) else [row[c] for c in CSV_COLUMNS])
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+    return write_row
+
+
+def _txt_row(row):
+    stamp = row['timestamp'][:16].replace('T', ' ') if row['timestamp'] else '?'
+    if row['deleted']:
+        body = '[message deleted]'
+    else:
+        body = row['message']
+        if row['attachment'] or row['file_name']:
+            body += f" [attachment: {row['file_name'] or 'file'}"
+            # Don't dump base64 data into a plain-text transcript
+            if row['attachment'] and not row['attachment'].startswith('data:'):
+                body += f" {row['attachment']}"
+            body += ']'
+    return f"[{stamp}] {row['sender_name']}: {body}\n"
+
+
+@transcripts_bp.route('/messages/<int:message_id>/attachment', methods=['GET'])
+@require_auth
+def get_attachment(message_id):
+    """Download a message attachment.
+
+    Inline data URLs are decoded and always sent as a download, with types
+    outside ATTACHMENT_TYPES as application/octet-stream. Other URLs redirect,
+    but only to a path on this site or a host in ATTACHMENT_HOSTS: the sender
+    chose the URL.
+    """
+    user_id = g.current_user.id
+    row = db.session.query(Message.file_url, Message.file_name, Message.deleted,
+                           Consultation.client_id, Consultation.expert_id
+                           ).join(Consultation, Consultation.id == Message.consultation_id
+                           ).filter(Message.id == message_id).first()
+    if not row:
+        return jsonify({'error': 'Message not found'}), 404
+    if user_id not in [row.client_id, row.expert_id]:
+        return jsonify({'error': 'Not authorized to view this attachment'}), 403
+    if row.deleted or not row.file_url:
+        return jsonify({'error': 'Message has no attachment'}), 404
+
+    if not row.file_url.startswith('data:'):
+        if not is_allowed_redirect(row.file_url):
+            return jsonify({'error': 'Attachment is stored outside the allowed hosts'}), 404
+        return redirect(row.file_url)
+    header, _, payload = row.file_url.partition(',')
+    mimetype = header[5:].split(';')[0].strip().lower()
+    if mimetype not in ATTACHMENT_TYPES:
+        mimetype = 'application/octet-stream'
+    try:
+        data = base64.b64decode(payload) if ';base64' in header else payload.encode()
+    except (binascii.Error, ValueError):
+        return jsonify({'error': 'Attachment is corrupt'}), 422
+    return Response(data, mimetype=mimetype, headers={
+        'Content-Disposition': content_disposition(row.file_name or f'attachment-{message_id}'),
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Security-Policy': "default-src 'none'; sandbox",
+    })
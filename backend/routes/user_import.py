@@ -0,0 +1,67 @@
+from flask import Blueprint, current_app, jsonify, request, g
+from models import db, ImportJob, ADMIN_ROLE
+from auth_utils import require_auth
+import user_import
+import os
+import shutil
+import tempfile
+
+user_import_bp = Blueprint('user_import', __name__, url_prefix='/api/v1/admin')
+
+
+def admin_only():
+    if g.current_user.role != ADMIN_ROLE:
+        return jsonify({'error': 'Only admins can import users'}), 403
+    return None
+
+
+@user_import_bp.route('/users/import', methods=['POST'])
+@require_auth
+def import_users():
+    """Create users in bulk from CSV or JSON Lines.
+
+    Send the file as the request body, or as the multipart field 'file'.
+    Query: format=csv|jsonl (default: from the file name or Content-Type),
+    role=Client|Expert for records without one, dry_run=1 to only check.
+    The file is streamed to disk and imported in the background: returns
+    202 with the queued job; poll GET /admin/users/import/<id> for the report.
+    """
+    error = admin_only()
+    if error:
+        return error
+
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, None, request.mimetype
+    format = request.args.get('format') or user_import.detect_format(filename, content_type)
+    if format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    role = request.args.get('role', 'Client')
+    if role not in user_import.IMPORT_ROLES:
+        return jsonify({'error': f"role must be one of {', '.join(user_import.IMPORT_ROLES)}"}), 400
+
+    upload_dir = current_app.config.get('IMPORT_UPLOAD_DIR') or os.path.join(current_app.instance_path, 'imports')
+    os.makedirs(upload_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=upload_dir, suffix=f'.{format}', delete=False) as f:
+        shutil.copyfileobj(stream, f)
+    job = ImportJob(created_by=g.current_user.id, format=format, default_role=role, path=f.name,
+                    dry_run=request.args.get('dry_run') in ('1', 'true'))
+    db.session.add(job)
+    db.session.commit()
+    user_import.start(current_app._get_current_object(), job.id)
+    return jsonify({'job': job.to_dict()}), 202
+
+
+@user_import_bp.route('/users/import/<int:job_id>', methods=['GET'])
+@require_auth
+def get_import(job_id):
+    """Status and report (so far) of one import job."""
+    error = admin_only()
+    if error:
+        return error
+    job = db.session.get(ImportJob, job_id)
+    if not job:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify({'job': job.to_dict()})
@@ -0,0 +1,200 @@
+"""
+Full-text search over consultation messages.
+
+SQLite: an FTS5 table (messages_fts) keyed by message id, written in the
+same transaction as the message itself by the send/delete routes. Existing
+databases are filled with backfill_search_index.py.
+
+PostgreSQL: a GIN index on to_tsvector('english', message), which the
+database keeps up to date by itself, queried with plainto_tsquery.
+
+If the SQLite build lacks FTS5, search degrades to a LIKE scan.
+
+create_app() runs ensure_schema(), which creates the index on a connection
+of its own and commits before the mode is cached. The mode therefore never
+claims an FTS5 table that a rolled-back request transaction took with it.
+"""
+
+import html
+import re
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+FTS_TABLE = 'messages_fts'
+SNIPPET_WORDS = 12
+# Sentinels around matched terms in raw snippets; replaced by <mark> after escaping
+_OPEN, _CLOSE = '\x02', '\x03'
+
+_modes = {}  # engine url -> 'fts5' | 'postgres' | 'like'
+
+
+def search_mode(session):
+    """'fts5', 'postgres' or 'like' for the session's database, as settled by ensure_schema()."""
+    engine = session.get_bind()
+    mode = _modes.get(str(engine.url))
+    if mode is not None:
+        return mode
+    # ensure_schema() hasn't run in this process. Don't create the table here: the
+    # caller may hold the write lock, and its transaction may yet roll back
+    if engine.dialect.name == 'postgresql':
+        mode = 'postgres'
+    elif engine.dialect.name == 'sqlite' and session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}).first():
+        mode = 'fts5'
+    else:
+        return 'like'  # not cached: ensure_schema() may still create the table
+    _modes[str(engine.url)] = mode
+    return mode
+
+
+def ensure_schema(session):
+    """Create the search index (startup, migration, backfill) on its own connection. Returns the mode."""
+    engine = session.get_bind()
+    mode = 'postgres' if engine.dialect.name == 'postgresql' else 'like'
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            try:
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                    "message, consultation_id UNINDEXED, tokenize='porter unicode61')"
+                ))
+                mode = 'fts5'
+            except OperationalError as e:
+                if 'fts5' not in str(e):
+                    raise  # e.g. database is locked: don't settle on LIKE for good
+                # SQLite compiled without FTS5
+        elif mode == 'postgres' and inspect(conn).has_table('messages'):
+            # Before create_all() on a new database there is nothing to index yet
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_messages_fts ON messages USING GIN (to_tsvector('english', message))"
+            ))
+    # Only now that the DDL is committed
+    _modes[str(engine.url)] = mode
+    return mode
+
+
+def index_messages(session, messages):
+    """Add flushed Message rows to the index, inside the caller's transaction."""
+    rows = [{'id': m.id, 'message': m.message, 'consultation_id': m.consultation_id}
+            for m in messages if m.message]
+    if rows and search_mode(session) == 'fts5':
+        # OR REPLACE: a hard-deleted message's id can be reused by SQLite
+        session.execute(text(
+            f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, message, consultation_id) VALUES (:id, :message, :consultation_id)"
+        ), rows)
+
+
+def remove_messages(session, message_ids):
+    """Drop messages from the index (deleted or archived), inside the caller's transaction."""
+    if message_ids and search_mode(session) == 'fts5':
+        session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"),
+                        [{'id': mid} for mid in message_ids])
+
+
+def backfill(session, batch_size=1000):
+    """Index every live message not in the index yet; returns the number added."""
+    if ensure_schema(session) != 'fts5':
+        return 0
+    added, last_id = 0, 0
+    while True:
+        upper = session.execute(text(
+            "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > :last ORDER BY id LIMIT :n)"
+        ), {'last': last_id, 'n': batch_size}).scalar()
+        if upper is None:
+            return added
+        result = session.execute(text(
+            f"INSERT INTO {FTS_TABLE} (rowid, message, consultation_id) "
+            "SELECT m.id, m.message, m.consultation_id FROM messages m "
+            "WHERE m.id > :last AND m.id <= :upper AND (m.deleted IS NULL OR m.deleted = 0) "
+            f"AND NOT EXISTS (SELECT 1 FROM {FTS_TABLE} f WHERE f.rowid = m.id)"
+        ), {'last': last_id, 'upper': upper})
+        session.commit()
+        added += result.rowcount
+        last_id = upper
+
+
+def _terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def _render(snippet):
+    return html.escape(snippet or '').replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def search(session, user_id, query, consultation_id=None, limit=20, offset=0):
+    """Ranked matches in the consultations user_id takes part in.
+
+    Returns dicts with message_id, consultation_id, sender_id, timestamp and
+    an HTML-escaped snippet where matched terms are wrapped in <mark>.
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+    mode = search_mode(session)
+    params = {'uid': user_id, 'limit': limit, 'offset': offset, 'cid': consultation_id}
+    scope = ("(c.client_id = :uid OR c.expert_id = :uid) AND (m.deleted IS NULL OR m.deleted = :false) "
+             "AND (:cid IS NULL OR m.consultation_id = :cid)")
+    params['false'] = False
+
+    if mode == 'fts5':
+        # Quote every term so user input can't use FTS5 query syntax
+        params['match'] = ' '.join('"%s"' % t for t in terms)
+        sql = (
+            f"SELECT m.id, m.consultation_id, m.sender_id, m.timestamp, "
+            f"snippet({FTS_TABLE}, 0, '{_OPEN}', '{_CLOSE}', '…', {SNIPPET_WORDS}) "
+            f"FROM {FTS_TABLE} JOIN messages m ON m.id = {FTS_TABLE}.rowid "
+            f"JOIN consultations c ON c.id = m.consultation_id "
+            f"WHERE {FTS_TABLE} MATCH :match AND {scope} "
+            f"ORDER BY bm25({FTS_TABLE}), m.id DESC LIMIT :limit OFFSET :offset"
+        )
+    elif mode == 'postgres':
+        params['q'] = ' '.join(terms)
+        sql = (
+            "SELECT m.id, m.consultation_id, m.sender_id, m.timestamp, "
+            "ts_headline('english', m.message, plainto_tsquery('english', :q), "
+            f"'StartSel={_OPEN}, StopSel={_CLOSE}, MaxWords={SNIPPET_WORDS * 2}, MinWords={SNIPPET_WORDS // 2}') "
+            "FROM messages m JOIN consultations c ON c.id = m.consultation_id "
+            "WHERE to_tsvector('english', m.message) @@ plainto_tsquery('english', :q) "
+            f"AND {scope} "
+            "ORDER BY ts_rank(to_tsvector('english', m.message), plainto_tsquery('english', :q)) DESC, m.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    else:
+        like_clauses = []
+        for i, term in enumerate(terms):
+            params[f't{i}'] = f'%{term}%'
+            like_clauses.append(f'LOWER(m.message) LIKE :t{i}')
+        sql = (
+            "SELECT m.id, m.consultation_id, m.sender_id, m.timestamp, m.message "
+            "FROM messages m JOIN consultations c ON c.id = m.consultation_id "
+            f"WHERE {' AND '.join(like_clauses)} AND {scope} "
+            "ORDER BY m.id DESC LIMIT :limit OFFSET :offset"
+        )
+
+    results = []
+    for mid, cid, sender_id, timestamp, snippet in session.execute(text(sql), params):
+        if mode == 'like':
+            snippet = _like_snippet(snippet, terms)
+        if isinstance(timestamp, str):
+            timestamp = timestamp.replace(' ', 'T')
+        elif timestamp is not None:
+            timestamp = timestamp.isoformat()
+        results.append({
+            'message_id': mid,
+            'consultation_id': cid,
+            'sender_id': sender_id,
+            'timestamp': timestamp,
+            'snippet': _render(snippet),
+        })
+    return results
+
+
+def _like_snippet(message, terms):
+    words = message.split()
+    lowered = [w.lower() for w in words]
+    hit = next((i for i, w in enumerate(lowered) if any(t in w for t in terms)), 0)
+    start = max(0, hit - SNIPPET_WORDS // 2)
+    window = words[start:start + SNIPPET_WORDS]
+    marked = [f'{_OPEN}{w}{_CLOSE}' if any(t in w.lower() for t in terms) else w for w in window]
+    return ('…' if start else '') + ' '.join(marked) + ('…' if start + SNIPPET_WORDS < len(words) else '')
@@ -1,10 +1,16 @@
 """
 Seed script to create default development users.
 Run this once after setting up the database.
+
+Also imports users in bulk (see user_import.py), e.g. a cooperative's farmers:
+
+    python seed_users.py import farmers.csv [--dry-run] [--role Client|Expert]
 """
+import sys
 from app import create_app
 from models import db, User
 from werkzeug.security import generate_password_hash
+import user_import
 
 app = create_app()
 
@@ -67,5 +73,26 @@ def seed_users():
         print("="*50 + "\n")
 
 
+def import_file(path, role='Client', dry_run=False):
+    def progress(report):
+        print(f"  {report['records']} records read, {report['created']} created, {report['rejected']} rejected",
+              flush=True)
+
+    with app.app_context(), open(path, 'rb') as f:
+        report = user_import.import_users(f, user_import.detect_format(path), default_role=role,
+                                          dry_run=dry_run, on_chunk=progress)
+    for r in report['rejects']:
+        print(f"line {r['line']}: {r['username'] or '-'}: {r['error']}")
+    if report['rejected'] > len(report['rejects']):
+        print(f"... and {report['rejected'] - len(report['rejects'])} more rejects")
+    verb = 'would create' if dry_run else 'created'
+    print(f"\n{report['records']} records: {verb} {report['created']}, rejected {report['rejected']} "
+          f"({report['seconds']}s)")
+
+
 if __name__ == '__main__':
-    seed_users()
+    if len(sys.argv) > 2 and sys.argv[1] == 'import':
+        role = sys.argv[sys.argv.index('--role') + 1] if '--role' in sys.argv else 'Client'
+        import_file(sys.argv[2], role=role, dry_run='--dry-run' in sys.argv)
+    else:
+        seed_users()
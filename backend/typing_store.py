@@ -0,0 +1,120 @@
+"""
+Bounded, expiring store of who is typing where.
+
+Each (consultation, user) entry expires TYPING_TIMEOUT seconds after the
+user's last keystroke event. Expiry runs off a hashed timing wheel: slot
+i holds the keys due in tick i (mod the wheel size), and the store
+advances the wheel on every call. Each entry is scheduled once. An entry
+that was refreshed in the meantime is moved to its new slot when its old
+slot comes due, so each event costs O(1) amortized and the store never
+scans. When max_entries is reached, the entry due soonest is dropped to
+make room, so memory stays bounded however many pairs have ever typed.
+
+Every worker keeps its own store, fed from the 'typing' channel of the
+event bus, which is what shares typing state across gunicorn workers
+(see event_bus.py). Timestamps are epoch seconds.
+"""
+
+import math
+import threading
+import time
+
+TYPING_TIMEOUT = 4  # seconds before "typing" expires
+TICK = 0.25  # wheel resolution in seconds
+MAX_ENTRIES = 100_000
+
+
+class TypingStore:
+    def __init__(self, timeout=TYPING_TIMEOUT, tick=TICK, max_entries=MAX_ENTRIES):
+        self.timeout = timeout
+        self.tick = tick
+        self.max_entries = max_entries
+        # Large enough that a new entry never lands in a slot that hasn't been processed yet
+        self._slots = [[] for _ in range(math.ceil(timeout / tick) + 2)]
+        self._expires = {}  # (consultation_id, user_id) -> expires_at
+        self._by_consultation = {}  # consultation_id -> {user_id}
+        self._tick = None  # last tick the wheel has been advanced to
+        self._lock = threading.Lock()
+
+    def touch(self, consultation_id, user_id, ts=None):
+        """Record a typing event at ts (default now)."""
+        ts = time.time() if ts is None else ts
+        key = (consultation_id, user_id)
+        with self._lock:
+            self._advance(ts)
+            expires_at = ts + self.timeout
+            current = self._expires.get(key)
+            if current is not None:
+                self._expires[key] = max(current, expires_at)  # its slot reschedules it lazily
+                return
+            if len(self._expires) >= self.max_entries:
+                self._evict_soonest()
+            self._expires[key] = expires_at
+            self._by_consultation.setdefault(consultation_id, set()).add(user_id)
+            self._schedule(key, expires_at)
+
+    def is_typing(self, consultation_id, user_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._advance(now)
+            expires_at = self._expires.get((consultation_id, user_id))
+        return expires_at is not None and expires_at > now
+
+    def typing_users(self, consultation_id, now=None):
+        """Ids of the users typing in a consultation at now."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._advance(now)
+            users = self._by_consultation.get(consultation_id, ())
+            return [uid for uid in users if self._expires[(consultation_id, uid)] > now]
+
+    def __len__(self):
+        return len(self._expires)
+
+    @property
+    def scheduled(self):
+        """Wheel entries, live or waiting to be dropped; bounded like len()."""
+        return sum(len(slot) for slot in self._slots)
+
+    def _schedule(self, key, expires_at):
+        due = max(int(expires_at // self.tick), self._tick + 1)
+        self._slots[due % len(self._slots)].append(key)
+
+    def _advance(self, now):
+        current = int(now // self.tick)
+        if self._tick is None:
+            self._tick = current
+            return
+        if current <= self._tick:
+            return
+        # After a long idle gap every slot is due once
+        first = max(self._tick + 1, current - len(self._slots) + 1)
+        self._tick = current
+        for t in range(first, current + 1):
+            index = t % len(self._slots)
+            due, self._slots[index] = self._slots[index], []
+            for key in due:
+                expires_at = self._expires.get(key)
+                if expires_at is None:
+                    continue
+                if expires_at <= now:
+                    self._drop(key)
+                else:
+                    self._schedule(key, expires_at)
+
+    def _evict_soonest(self):
+        for offset in range(1, len(self._slots) + 1):
+            slot = self._slots[(self._tick + offset) % len(self._slots)]
+            while slot:
+                key = slot.pop()
+                if key in self._expires:
+                    self._drop(key)
+                    return
+
+    def _drop(self, key):
+        del self._expires[key]
+        users = self._by_consultation.get(key[0])
+        if users is not None:
+            users.discard(key[1])
+            if not users:
+                del self._by_consultation[key[0]]
@@ -0,0 +1,247 @@
+"""
+Bulk user import, for onboarding a cooperative's farmers in one go.
+
+Reads CSV (with a header row) or JSON Lines, one user per record, with the
+fields /auth/register accepts. Records are streamed and handled CHUNK_SIZE
+at a time:
+  - validated with register's rules (role defaults to Client; admins can't
+    be imported);
+  - usernames checked against the rest of the file and, with one IN query
+    per chunk, against the users table;
+  - passwords hashed in parallel on the password hashing pool;
+  - inserted with one executemany INSERT and committed.
+Each chunk is its own transaction, so a large file never holds the write
+lock for long and a failure keeps the chunks already committed. A bad
+record never stops the import; it is reported with its line number.
+
+Over HTTP the upload is spooled to a file and imported by a background
+thread, as an ImportJob whose report is committed after every chunk, so
+the request returns at once and the job can be polled for progress. A job
+interrupted by a restart stays 'running'; upload the file again: the users
+it already created are rejected as existing, the rest are created.
+
+    POST /api/v1/admin/users/import    (routes/user_import.py)
+    python seed_users.py import farmers.csv [--dry-run] [--role Client]
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import db, ImportJob, User
+from password_hasher import HashBusy, get_hasher
+from routes.auth import validate_email, validate_phone, validate_password_strength
+
+CHUNK_SIZE = 500
+IMPORT_ROLES = ('Client', 'Expert')
+FIELDS = ('username', 'password', 'role', 'full_name', 'phone', 'email', 'meta',
+          'farm_name', 'farm_size', 'location', 'primary_crops')
+MAX_REPORTED_REJECTS = 1000  # rejects listed in the report; all are counted
+HASH_BUSY_RETRIES = 20  # half-second waits for room on the hashing pool
+MAX_RUNNING = 1  # import jobs running at once in one process; they share the hashing pool with logins
+
+log = logging.getLogger(__name__)
+
+_slots = threading.BoundedSemaphore(MAX_RUNNING)
+
+
+def detect_format(filename=None, content_type=None):
+    """'jsonl' for .jsonl/.ndjson files or JSON content types, else 'csv'."""
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if content_type and 'json' in content_type:
+        return 'jsonl'
+    return 'csv'
+
+
+def read_records(stream, format):
+    """Yield (line number, record dict or error message) from a binary stream."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, 'invalid JSON'
+            continue
+        yield line_no, record if isinstance(record, dict) else 'expected a JSON object'
+
+
+def validate_record(record, default_role='Client'):
+    """Clean a record into User column values. Returns (values, error message or None)."""
+    values = {}
+    for field in FIELDS:
+        value = record.get(field)
+        if value is None or value == '':
+            values[field] = None
+        elif field == 'password':
+            values[field] = str(value)
+        else:
+            values[field] = str(value).strip() or None
+    values['role'] = values['role'] or default_role
+
+    if not values['username'] or not values['password']:
+        return values, 'username and password are required'
+    if values['role'] not in IMPORT_ROLES:
+        return values, f"role must be one of {', '.join(IMPORT_ROLES)}"
+    if len(values['username']) < 3:
+        return values, 'Username must be at least 3 characters long'
+    is_valid, error_msg = validate_password_strength(values['password'])
+    if not is_valid:
+        return values, error_msg
+    if values['email'] and not validate_email(values['email']):
+        return values, 'Invalid email format'
+    if values['phone'] and not validate_phone(values['phone']):
+        return values, 'Invalid phone number format'
+    return values, None
+
+
+def existing_usernames(usernames):
+    return {name for (name,) in db.session.query(User.username).filter(User.username.in_(usernames))}
+
+
+def import_users(stream, format='csv', default_role='Client', dry_run=False, chunk_size=CHUNK_SIZE,
+                 on_chunk=None):
+    """Create the users in stream. Returns a report dict.
+
+    With dry_run everything is checked but nothing is hashed or written;
+    'created' is then the number of users that would be. on_chunk(report) is
+    called after each chunk, for progress output.
+    """
+    started = time.perf_counter()
+    report = {'dry_run': dry_run, 'records': 0, 'created': 0, 'rejected': 0, 'rejects': []}
+
+    def reject(line, username, error):
+        report['rejected'] += 1
+        if len(report['rejects']) < MAX_REPORTED_REJECTS:
+            report['rejects'].append({'line': line, 'username': username, 'error': error})
+
+    def flush(chunk):
+        report['created'] += _insert_chunk(chunk, reject, dry_run)
+        if on_chunk:
+            on_chunk(report)
+
+    seen = set()
+    chunk = []
+    for line, record in read_records(stream, format):
+        report['records'] += 1
+        if isinstance(record, str):
+            reject(line, None, record)
+            continue
+        values, error = validate_record(record, default_role)
+        if error:
+            reject(line, values['username'], error)
+            continue
+        if values['username'] in seen:
+            reject(line, values['username'], 'duplicate username in file')
+            continue
+        seen.add(values['username'])
+        chunk.append((line, values))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def start(app, job_id):
+    """Run a queued import job on a background thread; returns the thread."""
+    thread = threading.Thread(target=run, args=(app, job_id), name=f'user-import-{job_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def run(app, job_id):
+    """Import a queued job's file, saving the report after each chunk. Returns the final status."""
+    with _slots, app.app_context():
+        claimed = ImportJob.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return None
+        job = db.session.get(ImportJob, job_id)
+
+        def save(report):
+            ImportJob.query.filter_by(id=job_id).update({'report': json.dumps(report)}, synchronize_session=False)
+            db.session.commit()
+
+        try:
+            with open(job.path, 'rb') as f:
+                report = import_users(f, job.format, default_role=job.default_role, dry_run=bool(job.dry_run),
+                                      on_chunk=save)
+            job.status, job.report = 'done', json.dumps(report)
+        except Exception as e:
+            log.exception('user import %s failed', job_id)
+            db.session.rollback()
+            job = db.session.get(ImportJob, job_id)
+            job.status, job.error = 'failed', str(e)[:500]
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        status = job.status
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+        db.session.remove()
+        return status
+
+
+def _insert_chunk(chunk, reject, dry_run):
+    taken = existing_usernames([values['username'] for _, values in chunk])
+    fresh = []
+    for line, values in chunk:
+        if values['username'] in taken:
+            reject(line, values['username'], 'username already exists')
+        else:
+            fresh.append((line, values))
+    if dry_run or not fresh:
+        return len(fresh)
+
+    for (_, values), pwhash in zip(fresh, _hash_passwords([values['password'] for _, values in fresh])):
+        values['password'] = pwhash
+    try:
+        db.session.execute(User.__table__.insert(), [values for _, values in fresh])
+        db.session.commit()
+        return len(fresh)
+    except SQLAlchemyError:
+        # Someone registered one of these usernames since the check, or a row
+        # doesn't fit the table: insert one by one and reject the rows that fail
+        db.session.rollback()
+    created = 0
+    for line, values in fresh:
+        try:
+            db.session.execute(User.__table__.insert(), values)
+            db.session.commit()
+            created += 1
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            if isinstance(e, IntegrityError) and existing_usernames([values['username']]):
+                reject(line, values['username'], 'username already exists')
+            else:
+                reject(line, values['username'], f'could not be saved: {getattr(e, "orig", e)}'[:200])
+    return created
+
+
+def _hash_passwords(passwords):
+    # Logins come first: wait for the pool rather than fail the import
+    for _ in range(HASH_BUSY_RETRIES):
+        try:
+            return get_hasher().hash_many(passwords)
+        except HashBusy:
+            time.sleep(0.5)
+    return get_hasher().hash_many(passwords)
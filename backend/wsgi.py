@@ -2,6 +2,7 @@
 import os
 from app import create_app
 from models import db, User
+import search_index
 from werkzeug.security import generate_password_hash
 
 app = create_app()
@@ -10,6 +11,7 @@ with app.app_context():
     # Ensure instance directory exists for SQLite
     os.makedirs(app.instance_path, exist_ok=True)
     db.create_all()
+    search_index.ensure_schema(db.session)
 
     # Seed default test users if DB is empty
     if not User.query.filter_by(username='client1').first():
@@ -7,7 +7,7 @@ import {
   useNavigate,
   useLocation,
 } from "react-router-dom";
-import { post, getBase } from "./api/api";
+import { post, getBase, logout } from "./api/api";
 import Login from "./pages/Login";
 import Register from "./pages/Register";
 import Dashboard from "./pages/Dashboard";
@@ -46,9 +46,8 @@ function AppHeader() {
     return () => window.removeEventListener("storage", checkAuth);
   }, [location]);
 
-  const handleLogout = () => {
-    localStorage.removeItem("token");
-    localStorage.removeItem("user");
+  const handleLogout = async () => {
+    await logout();
     setIsLoggedIn(false);
     navigate("/");
   };
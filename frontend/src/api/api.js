@@ -5,47 +5,82 @@ function getHeaders(includeContentType = true) {
   if (includeContentType) {
     headers["Content-Type"] = "application/json";
   }
-  
+
   // Add JWT token from localStorage if available
   const token = localStorage.getItem("token");
   if (token) {
     headers["Authorization"] = `Bearer ${token}`;
   }
-  
+
   return headers;
 }
 
-export async function post(path, body) {
-  const res = await fetch(`${BASE}${path}`, {
+// Access tokens are short-lived; on a 401 swap the refresh token for a new
+// pair once and retry. Concurrent requests share one refresh.
+let refreshing = null;
+
+function clearSession() {
+  localStorage.removeItem("token");
+  localStorage.removeItem("refresh_token");
+  localStorage.removeItem("user");
+  window.dispatchEvent(new Event("storage"));
+}
+
+async function refreshSession() {
+  const refreshToken = localStorage.getItem("refresh_token");
+  if (!refreshToken) return false;
+  const res = await fetch(`${BASE}/api/v1/auth/refresh`, {
     method: "POST",
-    headers: getHeaders(true),
-    body: JSON.stringify(body),
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ refresh_token: refreshToken }),
   });
+  const data = await res.json().catch(() => ({}));
+  if (res.ok) {
+    localStorage.setItem("token", data.token);
+    localStorage.setItem("refresh_token", data.refresh_token);
+    return true;
+  }
+  // Another tab rotated it first and has already stored the new pair
+  if (data.code === "REFRESH_TOKEN_ROTATED" && localStorage.getItem("refresh_token") !== refreshToken) {
+    return true;
+  }
+  clearSession();
+  return false;
+}
+
+async function request(path, options, includeContentType) {
+  const send = () => fetch(`${BASE}${path}`, { ...options, headers: getHeaders(includeContentType) });
+  let res = await send();
+  if (res.status === 401 && localStorage.getItem("refresh_token")) {
+    const data = await res.clone().json().catch(() => ({}));
+    if (data.code === "INVALID_TOKEN") {
+      refreshing = refreshing || refreshSession().finally(() => { refreshing = null; });
+      if (await refreshing) res = await send();
+    }
+  }
   return res.json();
 }
 
+export async function post(path, body) {
+  return request(path, { method: "POST", body: JSON.stringify(body) }, true);
+}
+
 export async function put(path, body) {
-  const res = await fetch(`${BASE}${path}`, {
-    method: "PUT",
-    headers: getHeaders(true),
-    body: JSON.stringify(body),
-  });
-  return res.json();
+  return request(path, { method: "PUT", body: JSON.stringify(body) }, true);
 }
 
 export async function del(path) {
-  const res = await fetch(`${BASE}${path}`, {
-    method: "DELETE",
-    headers: getHeaders(false),
-  });
-  return res.json();
+  return request(path, { method: "DELETE" }, false);
 }
 
 export async function get(path) {
-  const res = await fetch(`${BASE}${path}`, {
-    headers: getHeaders(false),
-  });
-  return res.json();
+  return request(path, {}, false);
+}
+
+export async function logout() {
+  // Ends the session server-side too, so its refresh token can't be used again
+  await post("/api/v1/auth/logout", {}).catch(() => {});
+  clearSession();
 }
 
 export function getBase() {
@@ -82,15 +82,12 @@ export default function ChatPage({ consultations, user, onClose, embedded }) {
     const ids = [...new Set(consultations.map(c => otherId(c)).filter(Boolean))];
     if (ids.length === 0) return;
     const map = {};
-    await Promise.all(ids.map(async (uid) => {
-      try {
-        const res = await get(`/api/v1/presence/status/${uid}`);
-        if (res) map[uid] = {
-          online: res.online,
-          text: res.online ? "online" : formatLastSeen(res.last_seen_utc)
-        };
-      } catch (_) {}
-    }));
+    try {
+      const res = await post('/api/v1/presence/status:batch', { user_ids: ids });
+      Object.entries(res?.statuses || {}).forEach(([uid, s]) => {
+        map[uid] = { online: s.online, text: s.online ? "online" : formatLastSeen(s.last_seen_utc) };
+      });
+    } catch (_) {}
     setPresenceMap(prev => ({ ...prev, ...map }));
   }, [consultations, isExpert]);
 
@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useCallback, useRef } from "react";
 import { useNavigate } from "react-router-dom";
-import { get, put } from "../../api/api";
+import { get, put, logout } from "../../api/api";
 import { motion, AnimatePresence } from "framer-motion";
 
 const dropdownVariants = {
@@ -94,9 +94,8 @@ export default function Header({ onMenuClick, userRole, user, unreadCounts }) {
     } catch (_) {}
   };
 
-  const handleLogout = () => {
-    localStorage.removeItem("token");
-    localStorage.removeItem("user");
+  const handleLogout = async () => {
+    await logout();
     navigate("/");
   };
 
@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useCallback, useRef } from "react";
 import { useNavigate } from "react-router-dom";
-import { get, put } from "../../api/api";
+import { get, put, logout } from "../../api/api";
 import { motion, AnimatePresence } from "framer-motion";
 
 const dropdownVariants = {
@@ -112,9 +112,8 @@ export default function ExpertHeader({ onMenuClick, user }) {
     };
   };
 
-  const handleLogout = () => {
-    localStorage.removeItem("token");
-    localStorage.removeItem("user");
+  const handleLogout = async () => {
+    await logout();
     navigate("/");
   };
 
@@ -136,6 +136,11 @@ export default function ExpertSettings() {
       if (res.error) {
         setPasswordError(res.error);
       } else {
+        // Other sessions are signed out; this one continues with the new token
+        if (res.token) {
+          localStorage.setItem("token", res.token);
+          localStorage.setItem("refresh_token", res.refresh_token);
+        }
         setPasswordSuccess("Password changed successfully!");
         setPasswordData({ current_password: "", new_password: "", confirm_password: "" });
       }
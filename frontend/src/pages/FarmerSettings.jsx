@@ -258,6 +258,11 @@ export default function FarmerSettings() {
       if (res.error) {
         setPasswordError(res.error);
       } else {
+        // Other sessions are signed out; this one continues with the new token
+        if (res.token) {
+          localStorage.setItem("token", res.token);
+          localStorage.setItem("refresh_token", res.refresh_token);
+        }
         setShowPasswordModal(false);
         setPasswordData({
           current_password: "",
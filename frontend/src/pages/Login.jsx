@@ -105,6 +105,7 @@ export default function Login() {
         setError(response.error);
       } else {
         localStorage.setItem("token", response.token);
+        localStorage.setItem("refresh_token", response.refresh_token);
         localStorage.setItem("user", JSON.stringify(response.user));
         window.dispatchEvent(new Event("storage"));
         navigate("/dashboard");